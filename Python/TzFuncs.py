@@ -1,8 +1,56 @@
 from tzfpy import get_tz
 from datetime import *
+from functools import lru_cache
+import numpy as np
 import pandas as pd
 import argparse
 import pytz
+from profiler import shared as prof
+
+# Conversions are vectorized with pandas tz_localize/tz_convert
+# Local times are resolved the same way as the previous element-wise pytz localize(x,is_dst=DST) calls on pandas Timestamps:
+#   * ambiguous times (e.g., when clocks fall back) resolve to the first occurrence
+#   * nonexistent times (e.g., when clocks spring forward) are shifted using the offset after the transition if is_dst is True, otherwise the offset before
+# The timezone assumed for each lat/lon is looked up once and reused
+
+@lru_cache(maxsize=None)
+def lookupTZ(lon,lat):
+    return(get_tz(lon,lat))
+
+def utcOffset(aware):
+    # utc offset of tz aware times (int64 nanoseconds)
+    return(aware.tz_localize(None).asi8-aware.asi8)
+
+def dstOffset(utc,tz):
+    # dst offset in effect at each UTC time (int64 nanoseconds)
+    # The dst offset is the same for all times of a year sharing a utc offset, so it is only looked up once for each
+    aware = pd.DatetimeIndex(utc.view('datetime64[ns]')).tz_localize(pytz.utc).tz_convert(tz)
+    # one int64 key per year & offset (offsets are well within +/- 2**47 ns)
+    keys = aware.year.values.astype('int64')*2**48+utcOffset(aware)+2**47
+    keys,first,inverse = np.unique(keys,return_index=True,return_inverse=True)
+    dst = np.array([aware[i].dst()//timedelta(microseconds=1) for i in first],dtype='int64')*1000
+    return(dst[inverse])
+
+def localize(local,zone,is_dst):
+    # Resolve naive local times (int64 nanoseconds) to UTC
+    # Returns the UTC times and the dst offset in effect at those times (int64 nanoseconds)
+    tz = pytz.timezone(zone)
+    naive = pd.DatetimeIndex(local.view('datetime64[ns]'))
+    # Ambiguous times: always the first occurrence
+    aware = naive.tz_localize(tz,ambiguous=np.ones(local.shape,dtype=bool),nonexistent='NaT')
+    utc = aware.asi8.copy()
+    # Nonexistent times are NaT, except around some transitions that aren't on the hour (e.g., Australia/Lord_Howe), which give a UTC time that doesn't convert back to the local time
+    gap = aware.isna()
+    gap[~gap] = aware[~gap].tz_localize(None).asi8 != local[~gap]
+    if gap.any():
+        # Offsets before & after the transition (transitions are assumed to be more than 2 days apart)
+        if is_dst == True:
+            shift = pd.Timedelta(2,'D')
+        else:
+            shift = -pd.Timedelta(2,'D')
+        offset = utcOffset((naive[gap]+shift).tz_localize(pytz.utc).tz_convert(tz))
+        utc[gap] = local[gap]-offset
+    return(utc,dstOffset(utc,tz))
 
 class Tzfuncs():
     # Takes an input timezone or auto-determines a (DST aware) timezone from lat/lon coordinates
@@ -24,12 +72,12 @@ class Tzfuncs():
 
     def AssumeTZ(self,lon,lat):
         print(f'Timezone not provided, estimating for {lon}, {lat}')
-        self.Time_Zone = pytz.timezone(get_tz(lon,lat))
+        self.Time_Zone = pytz.timezone(lookupTZ(lon,lat))
         print(f'Assumed timezone is: {self.Time_Zone}')
 
+    @prof.timed('timezone')
     def convert(self,Input_Time):
-        if isinstance(Input_Time,pd.DatetimeIndex):
-            Input_Time=Input_Time.to_series()
+        Input_Time = pd.DatetimeIndex(Input_Time)
         if self.from_UTC == False:
             self.Local_Time=Input_Time
             self.to_StandardTime()
@@ -37,27 +85,30 @@ class Tzfuncs():
             self.UTC_Time=Input_Time
             self.fromUTC()
 
+    def toAware(self,utc,name):
+        return(pd.DatetimeIndex(utc.view('datetime64[ns]'),name=name).tz_localize(pytz.utc).tz_convert(self.Time_Zone))
+
     def to_StandardTime(self):
-        offset = self.Local_Time.apply(lambda x: self.Time_Zone.dst(x,is_dst=self.DST))
+        name = self.Local_Time.name
+        local = self.Local_Time.values.astype('datetime64[ns]').view('int64')
+        utc,offset = localize(local,self.Time_Zone.zone,self.DST)
         if self.DST == True:
-            self.Standard_Time = pd.DatetimeIndex(self.Local_Time-offset)
-            self.Local_Time = self.Local_Time.apply(lambda x: self.Time_Zone.localize(x,is_dst=self.DST))
+            self.Standard_Time = pd.DatetimeIndex((local-offset).view('datetime64[ns]'),name=name)
         else:
-            self.Standard_Time = pd.DatetimeIndex(self.Local_Time)
-            self.Local_Time = (self.Local_Time+offset).apply(lambda x: self.Time_Zone.localize(x,is_dst=self.DST))
+            self.Standard_Time = pd.DatetimeIndex(local.view('datetime64[ns]'),name=name)
+            utc,_ = localize(local+offset,self.Time_Zone.zone,self.DST)
+        self.Local_Time = self.toAware(utc,name)
         if self.to_UTC == True:
             self.toUTC()
-        self.Local_Time = pd.DatetimeIndex(self.Local_Time)
 
     def toUTC(self):
-        self.UTC_Time = pd.DatetimeIndex(self.Local_Time.apply(lambda x: x.astimezone(pytz.utc)))
+        self.UTC_Time = self.Local_Time.tz_convert(pytz.utc)
 
     def fromUTC(self):
-        self.UTC_Time = self.UTC_Time.apply(lambda x: pytz.utc.localize(x, is_dst=self.DST))
-        self.Local_Time = self.UTC_Time.apply(lambda x: x.astimezone(self.Time_Zone).replace(tzinfo=None))
+        self.UTC_Time = self.UTC_Time.tz_localize(pytz.utc)
+        self.Local_Time = self.UTC_Time.tz_convert(self.Time_Zone).tz_localize(None)
         self.to_UTC=False
         self.to_StandardTime()
-        self.UTC_Time = pd.DatetimeIndex(self.UTC_Time)
 
 # If called from command line ...
 if __name__ == '__main__':
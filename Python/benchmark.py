@@ -0,0 +1,332 @@
+# Benchmark the main workflows on synthetic data
+
+# For each scale, generates (in a temporary directory, unless --workDir is given):
+#   * a Database tree: sites x years x traces (float32) + clean_tv, laid out as described by dbase_metadata in config.yml
+#   * TOA5 and CR10X .dat trees (for textFileToBinary.py)
+#   * a logger-share tree of .ghg files (for dataDump.py)
+# Then times: csvFromBinary.makeCSV, binaryFromText.writeTraces, textFileToBinary.writeBinaryTraces (readGenericAscii), TzFuncs.Tzfuncs.convert, and dataDump.copyFiles
+#   * each case is run in a fresh process, so the peak memory use (RSS) of each case can be measured
+#   * generating the data is not timed
+# Results (seconds, throughput, peak RSS) are printed and saved as JSON, so runs can be compared across commits
+# Basic call from command line:
+    # py benchmark.py --scales 1 4 --output benchmark_results.json
+# Only run some of the cases:
+    # py benchmark.py --cases makeCSV copyFiles
+
+import os
+import sys
+import json
+import time
+import yaml
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+import numpy as np
+import pandas as pd
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+moduleDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,moduleDir)
+import timeGrid as tg
+import readConfig as rCfg
+
+# resource is not available on windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+cases = ['makeCSV','writeTraces','readGenericAscii','convert','copyFiles']
+
+defaultArgs = {
+    'scales':[1,4],
+    'cases':cases,
+    'sites':2,
+    'years':2,
+    'traces':16,
+    'startYear':2023,
+    'repeat':1,
+    'workDir':'None',
+    'output':'benchmark_results.json',
+    }
+
+def peakRSS():
+    # Peak resident memory (MB) of this process and its (finished) child processes
+    # On linux, VmHWM is used for this process because ru_maxrss carries over the parent's peak when a process is spawned
+    if os.path.isfile('/proc/self/status') and resource is not None:
+        with open('/proc/self/status') as f:
+            hwm = [int(l.split()[1]) for l in f if l.startswith('VmHWM')]
+        if len(hwm) > 0:
+            return(max(hwm[0],resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)/1024)
+    if resource is not None:
+        rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        # kB on linux, bytes on mac
+        if sys.platform.startswith('darwin'):
+            return(rss/1024**2)
+        return(rss/1024)
+    try:
+        import psutil
+        return(psutil.Process().memory_info().peak_wset/1024**2)
+    except (ImportError,AttributeError):
+        return(None)
+
+def traceNames(n):
+    return([f'TR_{i+1}_1_1' for i in range(n)])
+
+def makeDatabase(root,sites,years,traces,stage):
+    # Synthetic database: one clean_tv & a set of float32 traces per site/year
+    config = rCfg.set_user_configuration()
+    tsInfo = config['dbase_metadata']['timestamp']
+    trInfo = config['dbase_metadata']['traces']
+    rng = np.random.default_rng(0)
+    for siteID in sites:
+        for YYYY in years:
+            dout = os.path.join(root,str(YYYY),siteID,config['stage'][stage])
+            os.makedirs(dout,exist_ok=True)
+            tv = tg.yearDatenums(YYYY,tsInfo['resolution'],tsInfo['base'],tsInfo['base_unit'])
+            tv.astype(tsInfo['dtype']).tofile(os.path.join(dout,tsInfo['name']))
+            for trace_name in traces:
+                trace = rng.normal(10,5,tv.shape[0]).astype(trInfo['dtype'])
+                trace[rng.random(tv.shape[0])<.05] = np.nan
+                trace.tofile(os.path.join(dout,trace_name))
+
+def makeTOA5(root,nFiles,rows,columns):
+    # TOA5 files of half-hourly data, one folder per file
+    rng = np.random.default_rng(1)
+    start = pd.Timestamp('2024-01-01 00:30')
+    for k in range(nFiles):
+        dout = os.path.join(root,f'd{k}')
+        os.makedirs(dout,exist_ok=True)
+        idx = pd.date_range(start+pd.Timedelta(minutes=30*rows*k),periods=rows,freq='30min')
+        df = pd.DataFrame(rng.normal(size=(rows,len(columns))).round(4),columns=columns)
+        df.insert(0,'RECORD',np.arange(rows))
+        df.insert(0,'TIMESTAMP',idx.strftime('%Y-%m-%d %H:%M:%S'))
+        with open(os.path.join(dout,f'TOA5_BENCH.MET_{k}.dat'),'w') as f:
+            f.write('"TOA5","BENCH","CR1000X"\n')
+            f.write(','.join(f'"{c}"' for c in df.columns)+'\n')
+            f.write(','.join(['"TS"','"RN"']+['"u"']*len(columns))+'\n')
+            f.write(','.join(['""','""']+['"Smp"']*len(columns))+'\n')
+            df.to_csv(f,header=False,index=False,na_rep='NAN')
+
+def makeCR10X(root,nFiles,days):
+    # CR10X mixed-array files: half-hourly (121) and daily (122) arrays, 2400 marks midnight
+    rng = np.random.default_rng(2)
+    start = pd.Timestamp('2024-01-01 00:30')
+    for k in range(nFiles):
+        dout = os.path.join(root,f'd{k}')
+        os.makedirs(dout,exist_ok=True)
+        idx = pd.date_range(start+pd.Timedelta(days=days*k),periods=48*days,freq='30min')
+        HHMM = idx.hour*100+idx.minute
+        midnight = HHMM == 0
+        day = idx-pd.to_timedelta(midnight.astype(int),unit='D')
+        HH = pd.DataFrame({'ID':121,'YYYY':day.year,'DOY':day.dayofyear,'HHMM':np.where(midnight,2400,HHMM)})
+        values = pd.DataFrame(rng.normal(size=(idx.shape[0],8)).round(3))
+        HH = pd.concat([HH,values],axis=1)
+        Daily = HH.loc[midnight,['ID','YYYY','DOY','HHMM']].assign(ID=122,BattV=rng.normal(size=midnight.sum()).round(3))
+        df = pd.concat([HH,Daily]).sort_index(kind='stable')
+        with open(os.path.join(dout,f'CR10X_BENCH_{k}.dat'),'w') as f:
+            for row in df.itertuples(index=False):
+                f.write(','.join(str(v) for v in row if not (isinstance(v,float) and np.isnan(v)))+'\n')
+
+def asciiTasks(fn):
+    # Task definitions (as in config_files/dat_to_binary.yml) for the synthetic TOA5 and CR10X trees
+    tasks = {
+        'BENCH_met_dat':{
+            'exclude':['RECORD'],
+            'formatting':{'autoDate':'TIMESTAMP','header':[1,2,3]},
+            'recursiveSearch':{'fileExtension':'dat','fileNameMatch':'BENCH.MET','rootDir':'Datadump','subDir':'TOA5'},
+            'site':{'ID':'BENCH','lat_lon':[49.12930679,-122.9849701]},
+            'stage':'Met',
+            },
+        'BENCH_soil_dat':{
+            'exclude':['subtable'],
+            'formatting':{'header':'None','timestamp':{'date_cols':['YYYY','DOY','HHMM'],'format':'%Y%j%H%M','zFillDates':True}},
+            'recursiveSearch':{'fileExtension':'dat','fileNameMatch':'CR10X_BENCH','rootDir':'Datadump','subDir':'CR10X'},
+            'site':{'ID':'BENCH','lat_lon':[49.12930679,-122.9849701],'prefix':'SOIL_'},
+            'stage':'Met',
+            'subtables':{
+                'Daily':{'ID':122,'columns':['subtable','YYYY','DOY','HHMM','BattV_MIN']},
+                'HH':{'ID':121,'columns':['subtable','YYYY','DOY','HHMM']+[f'T_{i}' for i in range(8)]},
+                },
+            },
+        }
+    with open(fn,'w') as f:
+        yaml.safe_dump(tasks,f)
+
+def csvTask(fn,traces,stage):
+    # Request for makeCSV: all traces with a timestamp column
+    tasks = {
+        'BENCH':{
+            'stage':stage,
+            'formatting':{
+                'units_in_header':True,
+                'na_value':-9999,
+                'time_vectors':{'TIMESTAMP':{'output_name':'TIMESTAMP','fmt':'%Y-%m-%d %H:%M','units':'yyyy-mm-dd HH:MM'}},
+                },
+            'traces':{t:{'units':'u','output_name':t} for t in traces},
+            },
+        }
+    with open(fn,'w') as f:
+        yaml.safe_dump(tasks,f)
+
+def makeShare(root,nFiles,size=20000):
+    # Logger share: one folder per day of half-hourly .ghg files
+    rng = np.random.default_rng(3)
+    for t in pd.date_range('2024-01-01',periods=nFiles,freq='30min'):
+        dout = os.path.join(root,t.strftime('%Y-%m-%d'))
+        os.makedirs(dout,exist_ok=True)
+        with open(os.path.join(dout,t.strftime('%Y-%m-%dT%H%M%S')+'_BENCH.ghg'),'wb') as f:
+            f.write(rng.bytes(size))
+
+def makeInputs(workDir,scale,args):
+    # Generate all inputs for a scale, returns the parameters of each case
+    root = os.path.join(workDir,f'scale_{scale}')
+    years = list(range(args['startYear'],args['startYear']+args['years']))
+    sites = [f'SITE{i+1}' for i in range(args['sites']*scale)]
+    traces = traceNames(args['traces'])
+    stage = 'Second'
+    params = {'root':root,'sites':sites,'years':years,'traces':traces,'stage':stage}
+    if 'makeCSV' in args['cases']:
+        makeDatabase(os.path.join(root,'Database'),sites,years,traces,stage)
+        csvTask(os.path.join(root,'csv_task.yml'),traces,stage)
+    if 'writeTraces' in args['cases']:
+        # One year of half-hourly data per scale
+        idx = pd.date_range(f"{years[0]}-01-01 00:30",periods=17520*scale,freq='30min')
+        df = pd.DataFrame(np.random.default_rng(4).normal(size=(idx.shape[0],args['traces'])).round(4),columns=traces)
+        df.insert(0,'TIMESTAMP',idx)
+        with open(os.path.join(root,'writeTraces.csv'),'w') as f:
+            f.write(','.join(df.columns)+'\n'+','.join(['u']*df.shape[1])+'\n')
+            df.to_csv(f,header=False,index=False)
+    if 'readGenericAscii' in args['cases']:
+        makeTOA5(os.path.join(root,'Datadump','TOA5'),10*scale,1440,[f'TR_{i}' for i in range(10)])
+        makeCR10X(os.path.join(root,'Datadump','CR10X'),10*scale,30)
+        asciiTasks(os.path.join(root,'ascii_tasks.yml'))
+    if 'copyFiles' in args['cases']:
+        makeShare(os.path.join(root,'share'),500*scale)
+    return(params)
+
+def runCase(case,scale,params):
+    # Run one case (in a fresh process), returns the timing and throughput
+    root = params['root']
+    rows = 17520*len(params['years'])
+    with open(os.devnull,'w') as devnull, contextlib.redirect_stdout(devnull):
+        if case == 'makeCSV':
+            import csvFromBinary as cfb
+            outputPath = os.path.join(root,'csv')
+            shutil.rmtree(outputPath,ignore_errors=True)
+            T1 = time.perf_counter()
+            cfb.makeCSV(siteID=params['sites'],dateRange=[f"{params['years'][0]}-01-01 00:30",f"{params['years'][-1]+1}-01-01 00:00"],
+                        database=os.path.join(root,'Database'),outputPath=outputPath,tasks=[os.path.join(root,'csv_task.yml')])
+            seconds = time.perf_counter()-T1
+            nRows = rows*len(params['sites'])
+            throughput = {'rows/s':nRows/seconds,'values/s':nRows*len(params['traces'])/seconds}
+        elif case == 'writeTraces':
+            import binaryFromText as bft
+            database = os.path.join(root,'Database_writeTraces')
+            shutil.rmtree(database,ignore_errors=True)
+            T1 = time.perf_counter()
+            bft.writeTraces('BENCH',os.path.join(root,'writeTraces.csv'),{'parse_dates':[0],'header':[0,1]},database=database,verbose=False)
+            seconds = time.perf_counter()-T1
+            nRows = 17520*scale
+            throughput = {'rows/s':nRows/seconds,'values/s':nRows*len(params['traces'])/seconds}
+        elif case == 'readGenericAscii':
+            import textFileToBinary as t2b
+            database = os.path.join(root,'Database_ascii')
+            shutil.rmtree(database,ignore_errors=True)
+            T1 = time.perf_counter()
+            t2b.writeBinaryTraces(tasks=[os.path.join(root,'ascii_tasks.yml')],rootDir={'Datadump':os.path.join(root,'Datadump'),'Database':database})
+            seconds = time.perf_counter()-T1
+            nFiles = 20*scale
+            nRows = 10*scale*(1440+30*48)
+            throughput = {'files/s':nFiles/seconds,'rows/s':nRows/seconds}
+        elif case == 'convert':
+            import TzFuncs
+            DT = pd.date_range(f"{params['years'][0]}-01-01 00:30",periods=175200*scale,freq='30min')
+            T1 = time.perf_counter()
+            tzf = TzFuncs.Tzfuncs(Time_Zone='America/Vancouver',DST=True,to_UTC=True)
+            tzf.convert(DT)
+            seconds = time.perf_counter()-T1
+            throughput = {'timestamps/s':DT.shape[0]/seconds}
+        elif case == 'copyFiles':
+            import dataDump
+            dOut = os.path.join(root,'copy')
+            shutil.rmtree(dOut,ignore_errors=True)
+            T1 = time.perf_counter()
+            dataDump.copyFiles(dIn=os.path.join(root,'share'),dOut=dOut,fileFormat='ghg',byYear=True)
+            seconds = time.perf_counter()-T1
+            nFiles = 500*scale
+            throughput = {'files/s':nFiles/seconds,'MB/s':nFiles*20000/1024**2/seconds}
+    return({'case':case,'scale':scale,'seconds':seconds,'throughput':throughput,'peak_rss_MB':peakRSS()})
+
+def commitHash():
+    try:
+        proc = subprocess.run(['git','rev-parse','--short','HEAD'],cwd=moduleDir,capture_output=True,text=True)
+        return(proc.stdout.strip() if proc.returncode == 0 else None)
+    except OSError:
+        return(None)
+
+def runBenchmark(**kwargs):
+    # Apply defaults where not defined
+    args = defaultArgs | kwargs
+    if args['workDir'] == 'None':
+        workDir = tempfile.mkdtemp(prefix='biomet_benchmark_')
+        cleanUp = True
+    else:
+        workDir = args['workDir']
+        cleanUp = False
+    results = []
+    try:
+        for scale in args['scales']:
+            print(f'Generating inputs for scale {scale} in {workDir}')
+            params = makeInputs(workDir,scale,args)
+            for case in args['cases']:
+                for r in range(args['repeat']):
+                    # spawn gives each case a clean process (no shared caches, fresh peak RSS)
+                    with ProcessPoolExecutor(max_workers=1,mp_context=multiprocessing.get_context('spawn')) as pool:
+                        result = pool.submit(runCase,case,scale,params).result()
+                    result['repeat'] = r
+                    results.append(result)
+                    rate = ', '.join(f'{v:,.0f} {k}' for k,v in result['throughput'].items())
+                    rss = 'n/a' if result['peak_rss_MB'] is None else f"{result['peak_rss_MB']:.0f} MB"
+                    print(f"{case:>18} scale {scale:>3}: {result['seconds']:8.3f} s  {rate}  peak RSS {rss}")
+    finally:
+        if cleanUp == True:
+            shutil.rmtree(workDir,ignore_errors=True)
+    summary = {
+        'commit':commitHash(),
+        'date':pd.Timestamp.now().isoformat(),
+        'python':platform.python_version(),
+        'platform':platform.platform(),
+        'numpy':np.__version__,
+        'pandas':pd.__version__,
+        'settings':{k:args[k] for k in ['sites','years','traces','startYear','repeat']},
+        'results':results,
+        }
+    if args['output'] != 'None':
+        with open(args['output'],'w') as f:
+            json.dump(summary,f,indent=2)
+        print(f"Results saved to {args['output']}")
+    return(summary)
+
+# If called from command line ...
+if __name__ == '__main__':
+
+    CLI=argparse.ArgumentParser()
+
+    CLI.add_argument("--scales",nargs='+',type=int,default=defaultArgs['scales'])
+    CLI.add_argument("--cases",nargs='+',type=str,choices=cases,default=defaultArgs['cases'])
+    CLI.add_argument("--sites",nargs='?',type=int,default=defaultArgs['sites'])
+    CLI.add_argument("--years",nargs='?',type=int,default=defaultArgs['years'])
+    CLI.add_argument("--traces",nargs='?',type=int,default=defaultArgs['traces'])
+    CLI.add_argument("--startYear",nargs='?',type=int,default=defaultArgs['startYear'])
+    CLI.add_argument("--repeat",nargs='?',type=int,default=defaultArgs['repeat'])
+    CLI.add_argument("--workDir",nargs='?',type=str,default=defaultArgs['workDir'])
+    CLI.add_argument("--output",nargs='?',type=str,default=defaultArgs['output'])
+
+    # Parse the args and make the call
+    args = CLI.parse_args()
+    runBenchmark(**vars(args))
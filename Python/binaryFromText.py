@@ -8,11 +8,41 @@ import fnmatch
 import argparse
 import numpy as np
 import pandas as pd
+import timeGrid as tg
 import readConfig as rCfg
-from datetime import datetime,date
+import readTraces as rTr
+import traceAggregates as tA
+from profiler import shared as prof
+from concurrent.futures import ThreadPoolExecutor
 
 numerics = ['int16', 'int32', 'int64', 'float16', 'float32', 'float64']
 
+def mergeTrace(trace,fvar,mode):
+    # Merge new values (fvar) into an existing trace following the write mode
+    # trace is modified in place (can be a memmap) for nafill and repfill
+    if mode == 'nafill':
+        fill = np.isnan(trace)
+        trace[fill] = fvar[fill]
+    elif mode == 'repfill':
+        fill = ~np.isnan(fvar)
+        trace[fill] = fvar[fill]
+    elif mode == 'replace' or mode == 'overwrite':
+        trace = fvar
+    return(trace)
+
+def writeSlice(tracePath,values,i0):
+    # Write values into an existing trace starting at row i0
+    trace = np.memmap(tracePath,dtype=values.dtype,mode='r+',offset=i0*values.itemsize,shape=values.shape)
+    trace[:] = values
+    trace.flush()
+    del trace
+
+def atomicWrite(trace,tracePath):
+    # Write to a temporary file then rename, so a killed job never leaves a partially written trace
+    tmpPath = tracePath+'.tmp'
+    trace.tofile(tmpPath)
+    os.replace(tmpPath,tracePath)
+
 class writeTraces():
     def __init__(self,siteID,inputFile,inputFileMetaData,**kwargs):
         # Default arguments
@@ -23,7 +53,8 @@ class writeTraces():
             'mode':'nafill',
             'stage':'Flux',
             'tag':'',
-            'verbose':True
+            'verbose':True,
+            'threads':8
             }
         # Apply defaults where not defined
         self.kwargs = defaultKwargs | kwargs
@@ -49,57 +80,81 @@ class writeTraces():
         self.padFullYear()
 
     def padFullYear(self):
+        tsInfo = self.config['dbase_metadata']['timestamp']
         for self.y in self.df.index.year.unique():
-            self.Year = pd.DataFrame(
-                data={'TIMESTAMP':pd.date_range(
-                    start = f'{self.y}01010030',
-                    end=f'{self.y+1}01010001',
-                    freq=self.config['dbase_metadata']['timestamp']['resolution']
-                    )})
-            self.Year = self.Year.set_index('TIMESTAMP')
-            self.Year = self.Year.join(self.df)
-            epoch = datetime(1970,1,1,0,0)
-            self.Year['Floor'] = self.Year.index.floor(self.config['dbase_metadata']['timestamp']['base_unit'])
-            secsPerBase = pd.Timedelta('1'+self.config['dbase_metadata']['timestamp']['base_unit']).total_seconds()
-            self.Year['frac'] = ((self.Year.index-self.Year['Floor']).dt.seconds/secsPerBase)
-            self.Year['base'] = np.floor((self.Year.index-epoch).total_seconds()/secsPerBase+int(self.config['dbase_metadata']['timestamp']['base']))
-            self.Year[self.config['dbase_metadata']['timestamp']['name']] = self.Year['frac']+self.Year['base']
-            self.Year = self.Year.drop(columns=['Floor','frac','base'])
+            self.Year = tg.padYear(self.df,self.y,tsInfo['resolution'])
+            self.Year[tsInfo['name']] = tg.yearDatenums(self.y,tsInfo['resolution'],tsInfo['base'],tsInfo['base_unit'])
             self.write()
         
+    @prof.timed('writeTraces')
     def write(self):
         db = f"{self.config['rootDir']['database']}/{self.Year.index.year[0]}/{self.siteID}/{self.kwargs['stage']}/"
-        if self.kwargs['mode'].lower() == 'overwrite' and os.path.isdir(db):
+        mode = self.kwargs['mode'].lower()
+        if mode == 'overwrite' and os.path.isdir(db):
             print(f'Overwriting all contents of {db}')
             shutil.rmtree(db)
             os.mkdir(db)
         elif os.path.isdir(db) == False:
             print(f"{db} does not exist, creating new directory")
             os.makedirs(db)
+        # Only rows covered by the input need to be merged into existing traces
+        rows,_ = tg.gridPositions(self.df.index,self.y,self.config['dbase_metadata']['timestamp']['resolution'])
+        if rows.size > 0:
+            i0,i1 = rows.min(),rows.max()+1
+        else:
+            i0,i1 = 0,0
+        # Group traces by dtype, each group is merged as a single 2-D block (one row per trace)
+        groups = {}
         for traceName in self.Year.columns:
             if traceName == self.config["dbase_metadata"]["timestamp"]["name"]:
                 dt = self.config["dbase_metadata"]["timestamp"]["dtype"]
             else:
                 dt = self.config["dbase_metadata"]["traces"]["dtype"]
-            fvar = self.Year[traceName].astype(dt).values
-            traceName = self.charRep(traceName)
-            tracePath = f"{db}{traceName}"
-            if os.path.isfile(tracePath):
-                trace = np.fromfile(tracePath,dt)
-                if self.kwargs['verbose'] == True:
-                    print(f'{tracePath} exists, {self.kwargs["mode"]} existing file')
-            else:
-                if self.kwargs['verbose'] == True:
-                    print(f'{tracePath} does not exist, writing new file')
-                trace = np.empty(self.Year.shape[0],dtype=dt)
-                trace[:] = np.nan
-            if self.kwargs['mode'].lower() == 'nafill':
-                trace[np.isnan(trace)] = fvar[np.isnan(trace)]
-            elif self.kwargs['mode'] == 'repfill':
-                trace[~np.isnan(fvar)] = fvar[~np.isnan(fvar)]
-            elif self.kwargs['mode'] == 'replace' or self.kwargs['mode'] == 'overwrite':
-                trace = fvar
-            trace.tofile(tracePath)
+            groups.setdefault(dt,[]).append(traceName)
+        # Daily & monthly aggregates of the traces are updated after they are written (see traceAggregates.py)
+        aggregates = tA.enabled(self.config)
+        # File reads & writes are run on a thread pool
+        with ThreadPoolExecutor(max_workers=self.kwargs['threads']) as pool:
+            for dt,columns in groups.items():
+                block = np.ascontiguousarray(self.Year[columns].to_numpy(dtype=dt).T)
+                tracePaths = [f"{db}{self.charRep(traceName)}" for traceName in columns]
+                inPlace,whole = [],[]
+                for k,tracePath in enumerate(tracePaths):
+                    if os.path.isfile(tracePath):
+                        if self.kwargs['verbose'] == True:
+                            print(f'{tracePath} exists, {self.kwargs["mode"]} existing file')
+                        if mode in ['nafill','repfill'] and os.path.getsize(tracePath) == block[k].nbytes:
+                            inPlace.append(k)
+                        else:
+                            whole.append(k)
+                    else:
+                        if self.kwargs['verbose'] == True:
+                            print(f'{tracePath} does not exist, writing new file')
+                        # Merging into an empty (all NaN) trace gives the new values in every mode
+                        whole.append(k)
+                if len(inPlace) > 0 and i1 > i0:
+                    # Merge in place, reading and writing only the affected rows
+                    # The file size never changes so an interrupted write can't truncate the trace
+                    trace = np.stack(list(pool.map(lambda k: rTr.readSlice(tracePaths[k],dt,i0,i1-i0),inPlace)))
+                    mergeTrace(trace,block[inPlace,i0:i1],mode)
+                    def writeInPlace(j):
+                        stamp = tA.stampOf(tracePaths[inPlace[j]])
+                        writeSlice(tracePaths[inPlace[j]],trace[j],i0)
+                        if aggregates == True:
+                            tA.update(tracePaths[inPlace[j]],self.y,self.config['dbase_metadata'],rows=(i0,i1),stamp=stamp)
+                    list(pool.map(writeInPlace,range(len(inPlace))))
+                    prof.count('bytes_written',trace.nbytes)
+                def writeWhole(k):
+                    if os.path.isfile(tracePaths[k]):
+                        trace = mergeTrace(np.fromfile(tracePaths[k],dt),block[k],mode)
+                    else:
+                        trace = block[k]
+                    atomicWrite(trace,tracePaths[k])
+                    if aggregates == True:
+                        tA.update(tracePaths[k],self.y,self.config['dbase_metadata'],values=trace)
+                list(pool.map(writeWhole,whole))
+                prof.count('bytes_written',len(whole)*block.shape[1]*block.itemsize)
+                prof.count('traces_written',len(columns))
             
     def charRep(self,traceName):
         # Based on renameFields in fr_read_generic_data_file by @znesic, except:
@@ -186,6 +241,13 @@ if __name__ == '__main__':
         default='',
         )
 
+    CLI.add_argument(
+        "--threads", 
+        nargs='?',
+        type=int,
+        default=8,
+        )
+
     # Parse the args and make the call
     args = CLI.parse_args()
 
@@ -197,7 +259,8 @@ if __name__ == '__main__':
         'excludeCols':args.excludeCols,
         'stage':args.stage,
         'mode':args.mode,
-        'tag':args.tag
+        'tag':args.tag,
+        'threads':args.threads
         }
     
     inputFileMetaData = json.loads(args.inputFileMetaData)
@@ -3,6 +3,8 @@
 
 # Basic test-call from command line:
     # py csvFromBinary.py --siteID BBS --dateRange "2023-06-01 00:00" "2024-05-31 23:59"
+# Call for multiple sites, spreading the tasks over 4 processes
+    # py csvFromBinary.py --siteID BB BB2 BBS --dateRange "2023-06-01 00:00" "2024-05-31 23:59" --processes 4
 # Call with user defined request file (s)
     # py csvFromBinary.py --siteID BBS --dateRange "2023-06-01 00:00" "2024-05-31 23:59" --tasks C:/path_to/request1.yml C:/path_to/request2.yml
 # Can also call from other python scripts, using this general syntax:
@@ -11,15 +13,21 @@
 # Setup the config files for your environment accordingly before running
 
 import os
-import sys
+import re
 import json
 import argparse
 import numpy as np
 import pandas as pd
 import readConfig as rCfg
+import readTraces as rTr
+import exportFormats as eF
+import traceCatalog as tc
+import resampleTraces as rsT
+import traceAggregates as tA
+import validateTimestamps as vT
+from profiler import shared as prof
 from datetime import datetime,date
-
-os.chdir(os.path.split(__file__)[0])
+from concurrent.futures import ProcessPoolExecutor,as_completed
 
 template = 'config_files/csv_from_binary.yml'
 defaultDateRange = [date(datetime.now().year,1,1),datetime.now()]
@@ -32,16 +40,35 @@ defaultArgs = {
     'outputPath':'None',
     'tasks':[template],
     'stage':'None',
-    'nameTimeStamp':True
+    'nameTimeStamp':True,
+    'processes':1,
+    'catalog':False,
+    'timestamps':'fail',
+    'profile':'None'
     }
 
-# Create the csv
+# Create the csv (or columnar) files
 # args with "None" value provide option to overwrite default
+# siteID can be a single site or a list of sites
+#   * a single site returns {taskName: outputFile}
+#   * a list of sites returns {siteID: {taskName: outputFile}}
+# processes > 1 spreads the (site, task) units over a pool of worker processes
+# Each request is written as csv unless its formatting sets another output_format (parquet, feather, arrow, netcdf, see exportFormats.py)
+# A task that fails is reported and given a result of None, the remaining tasks carry on
+# catalog: use the trace catalog (see traceCatalog.py) to find which traces exist, only the requested traces are stat'ed (off by default)
+# timestamps: fail, coerce, or regenerate, what to do if a clean_tv doesn't match the time grid of its year (see validateTimestamps.py)
+# profile: path of a JSON file to save a summary of where the time was spent (see profiler.py)
 def makeCSV(**kwargs):
     # Apply defaults where not defined
     kwargs = defaultArgs | kwargs
+    if kwargs['profile'] != 'None':
+        prof.enable()
     tasks = kwargs['tasks']
     siteID = kwargs['siteID']
+    if isinstance(siteID,str):
+        sites = [siteID]
+    else:
+        sites = list(siteID)
     
     config = rCfg.set_user_configuration({'tasks':tasks})
     # Use default if user does not provide alternative
@@ -56,108 +83,230 @@ def makeCSV(**kwargs):
 
     Range_index = pd.DatetimeIndex(kwargs['dateRange'])
 
-    print(f'Generating requested files tasks for {siteID} over:', f"{Range_index.strftime(date_format='%Y-%m-%d %H:%M').values}") 
+    print(f'Generating requested files tasks for {sites} over:', f"{Range_index.strftime(date_format='%Y-%m-%d %H:%M').values}") 
     
-    # Years to process
-    Years = range(Range_index.year.min(),Range_index.year.max()+1)
-    results = {}
-    for name,task in config['tasks'].items():
-
-        if kwargs['stage'] != 'None':
-            task['stage']=config['stage'][kwargs['stage']]
-        elif task['stage'] in config['stage'].keys():
-            task['stage']=config['stage'][task['stage']]
-        # Create a dict of traces
-        traces={}
-        # Create a list of column header - unit tuples
-        # Only used if units_in_header set to True
-        columns_tuple = []
-        # Create a blank dataframe
-        df = pd.DataFrame()
-        file = f"{siteID}/{task['stage']}/{config['dbase_metadata']['timestamp']['name']}"
-        tv = np.concatenate(
-            [np.fromfile(f"{root}{YYYY}/{file}",config['dbase_metadata']['timestamp']['dtype']) for YYYY in Years],
-            axis=0)
-        
-        DT = pd.to_datetime(tv-config['dbase_metadata']['timestamp']['base'],unit=config['dbase_metadata']['timestamp']['base_unit']).round('S')
-        differences = DT.to_series().diff()
-        expected_difference = pd.Timedelta(config['dbase_metadata']['timestamp']['resolution'])
-        anomalies = ((differences != expected_difference)&(pd.isnull(differences) == False))
-        if anomalies.sum()>1:
-            ipt = input(f'Warning: timestamp file {file} appears to be corrupted.  Attempt to coerce Y/N')
-            if ipt.lower() == 'y':
-                DT_s = DT.to_series()
-                DT_s[anomalies] = pd.NaT
-                DT = pd.DatetimeIndex(DT_s.interpolate())
-            elif ipt.lower() != 'n':
-                sys.exit()
-        for time_trace,formatting in task['formatting']['time_vectors'].items():
-            traces[time_trace] = DT.floor('Min').strftime(formatting['fmt'])
-            # Add name-unit pairs to column header list
-            columns_tuple.append(
-                (formatting['output_name'],
-                formatting['units'])
-                )
-        # Loop through race list for request
-        for trace_name,trace_info in task['traces'].items():
-            # if exists (over full period) output
-            try:
-                file = f"{siteID}/{task['stage']}/{trace_name}"
-                trace = [np.fromfile(f"{root}{YYYY}/{file}",config['dbase_metadata']['traces']['dtype']) for YYYY in Years]
-                traces[trace_name]=np.concatenate(trace,axis=0)
-            # give NaN if traces does not exist
-            except:
-                print(f"{trace_name} missing, outputting NaNs")
-                traces[trace_name]=np.empty(tv.shape)*np.nan
-             # Add name-unit pairs to column header list
-            columns_tuple.append((trace_info['output_name'],trace_info['units']))
-        # dump traces to dataframe
-        df = pd.DataFrame(data=traces,index=DT)
-        # limit to requested timeframe
-        df = df.loc[((df.index>=Range_index.min())&(df.index<= Range_index.max()))]
-        # Apply optional resampling 
-        # Add units to header (preferred) or exclude (dangerous)
-        if task['formatting']['units_in_header'] == True:
-            df.columns = pd.MultiIndex.from_tuples(columns_tuple)
-        else:
-            df.columns = [c[0] for c in columns_tuple]
+    # One unit of work per site and task
+    units = [(site,name,task,config,root,outputPath,Range_index,kwargs) for site in sites for name,task in config['tasks'].items()]
+    results = {site:{name:None for name in config['tasks']} for site in sites}
+    if kwargs['processes'] > 1 and len(units) > 1:
+        with ProcessPoolExecutor(max_workers=min(kwargs['processes'],len(units))) as pool:
+            futures = {pool.submit(poolTask,prof.enabled,*unit):unit[:2] for unit in units}
+            for future in as_completed(futures):
+                site,name = futures[future]
+                results[site][name],summary = future.result()
+                prof.merge(summary)
+    else:
+        for unit in units:
+            results[unit[0]][unit[1]] = runTask(*unit)
+    if kwargs['profile'] != 'None':
+        prof.save(kwargs['profile'],{'script':'csvFromBinary','siteID':sites,'dateRange':kwargs['dateRange'],'tasks':kwargs['tasks']})
+        prof.disable()
+    # Keep the original output structure for single site calls
+    if isinstance(siteID,str):
+        results = results[siteID]
+    return(results)
+
+# Run one task in isolation so a single failure does not stop a batch
+def runTask(siteID,name,task,config,root,outputPath,Range_index,kwargs):
+    try:
+        return(exportTask(siteID,name,task,config,root,outputPath,Range_index,kwargs))
+    except Exception as e:
+        print(f'Failed to generate {name} for {siteID}: {e}')
+        return(None)
+
+# Run one task in a worker process, the profile of the worker is returned to be merged by the main process
+# (merged spans are summed over all workers, so they can add up to more than the wall time)
+def poolTask(profile,*unit):
+    if profile == True:
+        prof.enable()
+    return(runTask(*unit),prof.summary() if profile == True else None)
+
+# Create the output file for one site and task
+@prof.timed('exportTask')
+def exportTask(siteID,name,task,config,root,outputPath,Range_index,kwargs):
+    # Don't modify the request, it is shared by all sites
+    task = task.copy()
+    if kwargs['stage'] != 'None':
+        task['stage']=config['stage'][kwargs['stage']]
+    elif task['stage'] in config['stage'].keys():
+        task['stage']=config['stage'][task['stage']]
+    tsInfo = config['dbase_metadata']['timestamp']
+    resolution = pd.Timedelta(tsInfo['resolution'])
+    # Create a list of column header - unit tuples
+    # Only used if units_in_header set to True
+    columns_tuple = []
+    for formatting in task['formatting']['time_vectors'].values():
+        columns_tuple.append((formatting['output_name'],formatting['units']))
+    for trace_info in task['traces'].values():
+        columns_tuple.append((trace_info['output_name'],trace_info['units']))
+    # Traces are output as NaNs over the years where they are missing
+    # With the catalog, only the requested traces are stat'ed (once per process), the reads below only open files it lists as valid
+    slices = rTr.yearSlices(Range_index,tsInfo['resolution'])
+    years = [YYYY for YYYY,i0,n in slices if n > 0]
+    if kwargs['catalog'] == True:
+        catalog = tc.getCatalog(root,config['dbase_metadata'])
+        available = catalog.available(siteID,task['stage'],years,refresh=False,traces=task['traces'].keys())
+    else:
+        catalog = None
+        available = {}
+        for YYYY in years:
+            folder = f"{root}/{YYYY}/{siteID}/{task['stage']}"
+            available[YYYY] = set(os.listdir(folder)) if os.path.isdir(folder) else set()
+    # The timestamps over the full range, each year's clean_tv is checked against its time grid following the timestamps policy (see validateTimestamps.py)
+    DT = vT.readTimestamps(siteID,task['stage'],Range_index,root,config,kwargs['timestamps'],catalog)
+    missing = []
+    for trace_name in task['traces'].keys():
+        absent = [YYYY for YYYY in years if trace_name not in available[YYYY]]
+        if len(absent) > 0 and len(absent) == len(years):
+            missing.append(trace_name)
+            print(f"{trace_name} missing, outputting NaNs")
+        elif len(absent) > 0:
+            print(f"{trace_name} missing in {absent}, outputting NaNs for those years")
+
+    # Format filename
+    dates = Range_index.strftime('%Y%m%d%H%M')
+    if kwargs['nameTimeStamp'] == True:
+        fn = f"{siteID}_{name}_{dates[0]}_{dates[1]}"
+    else:
+        fn = f"{siteID}_{name}"
+    os.makedirs(outputPath,exist_ok=True)
+    # csv (default) or a columnar format (see exportFormats.py)
+    output_format = task['formatting'].get('output_format') or 'csv'
+    if output_format not in eF.extensions:
+        raise ValueError(f"Unknown output_format: {output_format}, expecting one of {list(eF.extensions)}")
+    dout = f"{outputPath}/{fn}{eF.extensions[output_format]}"
+    if output_format != 'csv':
+        metadata = {'siteID':siteID,'request':name,'stage':task['stage'],'na_value':task['formatting']['na_value'],
+                    'resolution':tsInfo['resolution'],'timestamp':'end of interval','dateRange':' to '.join(Range_index.astype(str))}
         if 'resample' in task['formatting']:
-            ### Finish stuff here
-            aggregation = task['formatting']['resample']['agg'].split(',')
-            # Text and numeric data must be treated differently
-            # For text dates, get the first value
-            txt = df.columns[:len(task['formatting']['time_vectors'].keys())]
-            rsmp = df[txt].resample(task['formatting']['resample']['freq']).agg('first')
-            rsmp=rsmp.T.set_index(np.repeat('', rsmp.shape[1]), append=True).T
-
-            # For numeric data, aggregate as desired
-            num = df.columns[len(task['formatting']['time_vectors'].keys()):]
-            rsmp2 = df[num].resample(task['formatting']['resample']['freq']).agg(aggregation)
-            df = rsmp.join(rsmp2)
-            # Drop aggregation defs if excluding units    
-            if task['formatting']['units_in_header'] == False:
-                df.columns = df.columns.get_level_values(0)
-
-        # Set specified NaN value or drop from dataset
-        if task['formatting']['na_value'] is None:
-            df = df.dropna()
-        else:
-            df = df.fillna(task['formatting']['na_value'])
+            metadata['resample'] = task['formatting']['resample']['freq']
+        writer = eF.columnarWriter(output_format,dout,eF.timeColumn(task),eF.traceColumns(task),metadata)
 
-        # Format filename and save output
-        dates = Range_index.strftime('%Y%m%d%H%M')
-        if kwargs['nameTimeStamp'] == True:
-            fn = f"{siteID}_{name}_{dates[0]}_{dates[1]}"
+    # Without resampling, rows are independent so the output is written one year at a time to limit memory use
+    # Resampled outputs are written in one block since the aggregation periods can span years
+    if 'resample' in task['formatting']:
+        blocks = [(Range_index,0,DT.shape[0])]
+    else:
+        blocks,pos = [],0
+        for YYYY,i0,n in slices:
+            if n > 0:
+                Y0 = pd.Timestamp(f'{YYYY}-01-01')
+                blocks.append((pd.DatetimeIndex([Y0+(i0+1)*resolution,Y0+(i0+n)*resolution]),pos,n))
+            pos += n
+    # Daily & monthly requests are answered from the aggregates if they are available (see traceAggregates.py)
+    resampled = None
+    if 'resample' in task['formatting'] and tA.enabled(config):
+        resampled = tA.resampleFromAggregates(siteID,task['stage'],list(task['traces'].keys()),DT,task['formatting']['resample']['freq'],
+                                              task['formatting']['resample']['agg'].split(','),root,config,catalog)
+    for b,(blockRange,pos,n) in enumerate(blocks):
+        # Read only the rows within the block
+        if resampled is None:
+            _,data = rTr.readTraces(siteID,task['stage'],task['traces'].keys(),blockRange,database=root,config=config,verbose=False,catalog=catalog)
         else:
-            fn = f"{siteID}_{name}"
-        if os.path.isdir(outputPath) == False:
-            os.makedirs(outputPath)
-        dout = f"{outputPath}/{fn}.csv"
-        df.to_csv(dout,index=False)
-
-        print(f'See output: {dout}')
-        results[name]=dout
-    return(results)
+            data = None
+        if output_format != 'csv':
+            blockDT,values = eF.columnarBlock(task,DT[pos:pos+n],data,missing,Range_index,resampled)
+            with prof.span(f'to_{output_format}'):
+                writer.write(blockDT,values)
+            prof.count('rows_emitted',blockDT.shape[0])
+            continue
+        df = exportBlock(task,DT[pos:pos+n],data,missing,columns_tuple,Range_index,resampled)
+        with prof.span('to_csv'):
+            if b == 0:
+                df.to_csv(dout,index=False)
+            else:
+                df.to_csv(dout,index=False,header=False,mode='a')
+        prof.count('rows_emitted',df.shape[0])
+    # A range without any rows on the grid still gives a csv, with only the header
+    if len(blocks) == 0 and output_format == 'csv':
+        data = {trace_name:np.empty(0,dtype=config['dbase_metadata']['traces']['dtype']) for trace_name in task['traces'].keys()}
+        exportBlock(task,DT,data,missing,columns_tuple,Range_index).to_csv(dout,index=False)
+    if output_format != 'csv':
+        with prof.span(f'to_{output_format}'):
+            writer.close()
+    prof.count('files_written')
+
+    print(f'See output: {dout}')
+    return(dout)
+
+# Create the output table for one block of rows
+@prof.timed('exportBlock')
+def exportBlock(task,DT,data,missing,columns_tuple,Range_index,resampled=None):
+    # resampled: (first timestamps, aggregates) if the request has already been resampled, e.g., from traceAggregates.resampleFromAggregates
+    if resampled is None:
+        # Create a dict of traces, loop through trace list for request
+        traces={}
+        for trace_name in task['traces'].keys():
+            if trace_name in missing:
+                traces[trace_name] = np.full(DT.shape,np.nan,dtype=data[trace_name].dtype)
+            else:
+                traces[trace_name] = data[trace_name]
+        # limit to requested timeframe
+        keep = (DT>=Range_index.min())&(DT<=Range_index.max())
+        DT = DT[keep]
+        traces = {trace_name:values[keep] for trace_name,values in traces.items()}
+    nTime = len(task['formatting']['time_vectors'].keys())
+    # Apply optional resampling (see resampleTraces.py)
+    # Each period is labelled by the text dates of its first timestamp
+    if 'resample' in task['formatting']:
+        aggregation = task['formatting']['resample']['agg'].split(',')
+        if resampled is None:
+            resampled = rsT.resampleTraces(DT,traces,task['formatting']['resample']['freq'],aggregation)
+        DT,rsmp = resampled
+        index = rsmp.index
+        traces = {(trace_name,agg):rsmp[(trace_name,agg)].values for trace_name in task['traces'].keys() for agg in aggregation}
+        header = [c+('',) for c in columns_tuple[:nTime]]
+        header += [c+(agg,) for c in columns_tuple[nTime:] for agg in aggregation]
+    else:
+        index = DT
+        header = columns_tuple
+    # Format the timestamps
+    columns = []
+    for formatting in task['formatting']['time_vectors'].values():
+        columns.append(formatTimestamps(DT.floor('Min'),formatting['fmt']))
+    columns += list(traces.values())
+    # dump traces to dataframe
+    df = pd.DataFrame(data=dict(enumerate(columns)),index=index)
+    # Add units to header (preferred) or exclude (dangerous)
+    if task['formatting']['units_in_header'] == True:
+        df.columns = pd.MultiIndex.from_tuples(header)
+    else:
+        df.columns = [c[0] for c in header]
+
+    # Set specified NaN value or drop from dataset
+    if task['formatting']['na_value'] is None:
+        df = df.dropna()
+    else:
+        df = df.fillna(task['formatting']['na_value'])
+    return(df)
+
+# Vectorized alternative to DatetimeIndex.strftime
+# Common directives are built from lookup tables of zero padded strings instead of formatting each timestamp individually
+# Falls back to strftime for any other directives
+directiveWidth = {'Y':4,'y':2,'m':2,'d':2,'H':2,'M':2,'S':2,'j':3}
+@prof.timed('formatTimestamps')
+def formatTimestamps(DT,fmt):
+    tokens = re.split(r'(%.)',fmt)
+    if DT.hasnans or any(t.startswith('%') and t[1:] not in directiveWidth and t != '%%' for t in tokens):
+        return(DT.strftime(fmt))
+    components = {
+        'Y':DT.year.values,'y':DT.year.values%100,'m':DT.month.values,'d':DT.day.values,
+        'H':DT.hour.values,'M':DT.minute.values,'S':DT.second.values,'j':DT.dayofyear.values
+        }
+    out = np.full(DT.shape,'',dtype='U1')
+    for t in tokens:
+        if t == '%%':
+            out = np.char.add(out,'%')
+        elif t.startswith('%'):
+            values = components[t[1]]
+            if values.size == 0:
+                continue
+            offset = values.min()
+            lookup = np.array([str(v).zfill(directiveWidth[t[1]]) for v in range(offset,values.max()+1)])
+            out = np.char.add(out,lookup[values-offset])
+        elif t != '':
+            out = np.char.add(out,t)
+    return(pd.Index(out.astype(object)))
 
 # If called from command line ...
 if __name__ == '__main__':
@@ -168,19 +317,34 @@ if __name__ == '__main__':
     for key,val in defaultArgs.items():
         dt = type(val)
         nargs = "?"
-        if dt == type({}):
+        const = None
+        # bool('False') is True, so parse the text (--catalog on its own means True)
+        if dt == type(True):
+            dt = lambda s: s.lower() in ['true','1','yes']
+            const = True
+        elif dt == type({}):
             dictArgs.append(key)
             dt = type('')
             val = '{}'
         elif dt == type([]):
             nargs = '+'
             dt = type('')
+        # Accept one or more sites
+        if key == 'siteID':
+            nargs = '+'
+            val = [val]
         
-        CLI.add_argument(f"--{key}",nargs=nargs,type=dt,default=val)
+        # --profile without a file name saves to csvFromBinary_profile.json
+        if key == 'profile':
+            CLI.add_argument(f"--{key}",nargs=nargs,type=dt,default=val,const='csvFromBinary_profile.json')
+        else:
+            CLI.add_argument(f"--{key}",nargs=nargs,type=dt,default=val,const=const)
 
     # parse the command line
     args = CLI.parse_args()
     kwargs = vars(args)
     for d in dictArgs:
         kwargs[d] = json.loads(kwargs[d])
+    if len(kwargs['siteID']) == 1:
+        kwargs['siteID'] = kwargs['siteID'][0]
     makeCSV(**kwargs)
\ No newline at end of file
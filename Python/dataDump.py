@@ -1,17 +1,18 @@
 
 from progressBar import progressbar
+from fileInventory import fileInventory
+from profiler import shared as prof
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import repeat
 import readConfig as rCfg
 import pandas as pd
-import subprocess
 import argparse
-import datetime
-import psutil
+import hashlib
 import shutil
+import time
 import json
-import sys
 import os
-import re
 
 defaultArgs = {
     'dOut':'',
@@ -24,56 +25,233 @@ defaultArgs = {
     'searchTag':'',
     'excludeTag':'',
     'timeShift':'',
+    'threads':8,
+    'link':'',
+    'hash':False,
+    'profile':'None',
 }
 
-def set_high_priority():
-    p = psutil.Process(os.getpid())
-    p.nice(psutil.HIGH_PRIORITY_CLASS)
+# Files are copied in-process on a pool of threads (copying many small files is dominated by I/O latency, not CPU)
+# link (only applies when source and destination are on the same filesystem):
+#   * 'hard': hard link the destination to the source (no data is copied)
+#   * 'reflink': copy-on-write clone where the filesystem supports it (e.g., btrfs, xfs), otherwise a regular copy
+# Destination files with the same size and modification time as the source are skipped
+# Files are written to a temporary name (dest.part) and only renamed once the copy has been verified
+#   * so a destination file is never partial, and a rerun after an interruption skips the files that were completed
+# hash: compare the contents (sha256) of new files against the inventory
+#   * files that are already in the inventory (or repeated within a run) under another name/folder are not copied again
+#   * copies are verified against the hash of the source (otherwise only the size is verified)
+
+# Linux ioctl to clone a file (copy-on-write)
+FICLONE = 0x40049409
+
+def sameFile(source,dest):
+    # True if dest exists and has the same size and modification time as source
+    try:
+        s,d = os.stat(source),os.stat(dest)
+    except FileNotFoundError:
+        return(False)
+    return(s.st_size == d.st_size and s.st_mtime_ns == d.st_mtime_ns)
+
+def copyData(source,dest,reflink=False):
+    # Copy the contents of source to dest in the kernel where possible
+    with open(source,'rb') as fsrc, open(dest,'wb') as fdst:
+        if reflink == True:
+            try:
+                import fcntl
+                fcntl.ioctl(fdst.fileno(),FICLONE,fsrc.fileno())
+                return
+            except (ImportError,OSError):
+                pass
+        if hasattr(os,'copy_file_range'):
+            size = os.fstat(fsrc.fileno()).st_size
+            copied = 0
+            try:
+                while copied < size:
+                    n = os.copy_file_range(fsrc.fileno(),fdst.fileno(),size-copied)
+                    if n == 0:
+                        break
+                    copied += n
+                if copied == size:
+                    return
+            except OSError:
+                pass
+            # Not supported for this pair of files, start over
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+        shutil.copyfileobj(fsrc,fdst,1024**2)
+
+# Directories modified within this many nanoseconds of a scan are listed again next time
+SETTLE_NS = 2*10**9
+
+def listDir(path,known,stamps,scanStart):
+    # List a directory with os.scandir, unless its mtime matches the last scan (known)
+    # Records the state of the directory in stamps
+    # Returns the files (None if the directory is unchanged) and the names of the subdirectories
+    mtime = os.stat(path).st_mtime_ns
+    prior = known.get(path)
+    if prior is not None and prior[0] == mtime:
+        stamps[path] = prior
+        return(None,prior[2])
+    files,subdirs = [],[]
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.name)
+            else:
+                files.append(entry.name)
+    if mtime > scanStart-SETTLE_NS:
+        mtime = None
+    stamps[path] = (mtime,len(files)+len(subdirs),subdirs)
+    return(files,subdirs)
+
+def scanDir(path,known,scanStart):
+    # Recursively scan a directory tree, only listing the directories that have changed since the last scan
+    # Returns a list of (directory, files) for the changed directories and the new state of all directories
+    changed,stamps = [],{}
+    stack = [path]
+    while len(stack)>0:
+        dir = stack.pop()
+        try:
+            files,subdirs = listDir(dir,known,stamps,scanStart)
+        except (FileNotFoundError,NotADirectoryError):
+            continue
+        if files is not None:
+            changed.append((dir,files))
+        stack += [os.path.join(dir,d) for d in subdirs[::-1]]
+    return(changed,stamps)
+
+def scanTree(root,known={},threads=8):
+    # Scan the top level directories of root in parallel
+    scanStart = time.time_ns()
+    stamps = {}
+    files,subdirs = listDir(root,known,stamps,scanStart)
+    changed = [] if files is None else [(root,files)]
+    with ThreadPoolExecutor(max_workers=max(threads,1)) as pool:
+        for c,s in pool.map(scanDir,[os.path.join(root,d) for d in subdirs],repeat(known),repeat(scanStart)):
+            changed += c
+            stamps.update(s)
+    return(changed,stamps)
+
+def fileHash(path,chunkSize=1024**2):
+    # sha256 of the contents of a file, read in chunks
+    h = hashlib.sha256()
+    with open(path,'rb') as f:
+        for chunk in iter(lambda: f.read(chunkSize),b''):
+            h.update(chunk)
+    return(h.hexdigest())
+
+def hashFiles(paths,threads=8):
+    # Hash a list of files on a pool of threads (hashlib releases the GIL while hashing)
+    with ThreadPoolExecutor(max_workers=max(threads,1)) as pool:
+        return(list(pool.map(fileHash,paths)))
+
+def copyFile(source,dest,link='',digest=None):
+    # Copy (or link) one file, preserving the modification time
+    # If digest is provided, the copy is verified against it (otherwise only the size is verified)
+    # Returns the size of the file, or None if dest was already up to date
+    source = os.path.abspath(source)
+    dest = os.path.abspath(dest)
+    if os.path.isdir(dest):
+        dest = os.path.join(dest,os.path.basename(source))
+    if sameFile(source,dest):
+        return(None)
+    stat = os.stat(source)
+    temp = dest+'.part'
+    if os.path.exists(temp):
+        os.remove(temp)
+    sameDevice = link != '' and os.stat(os.path.dirname(dest)).st_dev == stat.st_dev
+    if link == 'hard' and sameDevice:
+        os.link(source,temp)
+    else:
+        copyData(source,temp,reflink=(link == 'reflink' and sameDevice))
+        os.utime(temp,ns=(stat.st_atime_ns,stat.st_mtime_ns))
+        if os.stat(temp).st_size != stat.st_size or (digest is not None and fileHash(temp) != digest):
+            os.remove(temp)
+            raise OSError(f'Verification failed for {dest}')
+    os.replace(temp,dest)
+    return(stat.st_size)
 
 class copyFiles():
     def __init__(self,dIn=None,**kwargs):
-        self.dIn=dIn
+        self.dIn=os.path.abspath(dIn)
         # Apply defaults where not defined
         kwargs = defaultArgs | kwargs
         # add arguments as class attributes
         for k, v in kwargs.items():
             setattr(self, k, v)
+        # profile: path of a JSON file to save a summary of where the time was spent (see profiler.py)
+        if self.profile != 'None':
+            prof.enable()
         self.config = rCfg.set_user_configuration({'fileTypes':'config_files/ecFileFormats.yml'})
         if self.fileFormat !='':fileInfo=self.config['fileTypes'][self.fileFormat]
         else: fileInfo = None
         if self.dOut == '':
-            inventory = dIn+'/fileInventory.csv'
+            folder = dIn
         else:
             if os.path.isdir(self.dOut) == False:
                 os.makedirs(self.dOut)
-            inventory = self.dOut+'/fileInventory.csv'
-        if os.path.isfile(inventory) and self.reset == False:
-            self.fileInventory = pd.read_csv(inventory)
-        else:
-            self.fileInventory = pd.DataFrame(columns=['Interval','filename','dpath','source'])
+            folder = self.dOut
+        # Saved directory states only apply to scans with the same filters
+        filters = json.dumps([fileInfo,self.searchTag,self.excludeTag,self.parseDate],sort_keys=True,default=str)
+        self.fileInventory = fileInventory(folder,reset=self.reset,filters=hashlib.sha1(filters.encode()).hexdigest())
         self.buildInventory(fileInfo)
-        self.fileInventory.to_csv(inventory,index=False)        
+        self.fileInventory.close()
+        if self.profile != 'None':
+            prof.save(self.profile,{'script':'dataDump','dIn':self.dIn,'dOut':self.dOut})
+            prof.disable()
+
+    @prof.timed('parseIntervals')
+    def parseIntervals(self,fileList,fileInfo):
+        # Extract the timestamps from the filenames (all at once)
+        # Returns the Intervals, the (time shifted) filenames, and a mask of the files that could be parsed
+        names = pd.Series([f.rsplit('.',1)[0] for f in fileList],dtype=str)
+        srch = names.str.extract(f"(?P<match>{fileInfo['search']})",expand=True)['match']
+        Interval = pd.to_datetime(srch,format=fileInfo['format'],errors='coerce')
+        parsed = Interval.notna().values
+        if parsed.all() == False:
+            print(f"Could not parse a timestamp from {(~parsed).sum()} files, e.g., {fileList[(~parsed).argmax()]}")
+        srch,Interval = srch[parsed],pd.DatetimeIndex(Interval[parsed])
+        fileList = [f for f,keep in zip(fileList,parsed) if keep]
+        if self.timeShift != '':
+            Interval = Interval + pd.Timedelta(self.timeShift)
+            timeString = Interval.strftime(fileInfo['format'])
+            filename = [f.replace(s,t) for f,s,t in zip(fileList,srch,timeString)]
+        else:
+            filename = fileList
+        return(Interval,filename,parsed)
 
     def buildInventory(self,fileInfo):
-        for dir, _, fileList in os.walk(self.dIn):
-            fileList = [s for s in fileList if s not in self.fileInventory['source'].values]
+        toCopy = []
+        newFiles = []
+        unparsed = []
+        T1 = time.time()
+        with prof.span('scan'):
+            changed,stamps = scanTree(self.dIn,self.fileInventory.dirs,self.threads)
+        prof.count('dirs_scanned',len(stamps))
+        prof.count('dirs_listed',len(changed))
+        print(f'Scanned {len(stamps)} directories in {time.time()-T1:.1f} seconds, {len(changed)} have changed')
+        for dir, fileList in changed:
             if self.searchTag !='':
                 fileList = [s for s in fileList if sum(t in s for t in self.searchTag) == len(self.searchTag)]
             if self.excludeTag !='':
                 fileList = [s for s in fileList if sum(t in s for t in self.excludeTag) == 0]
             if fileInfo is not None:
                 fileList = [f for f in fileList if f.endswith(fileInfo['extension'])]
+            # Only consider files which are not in the inventory
             source = [os.path.abspath(dir+'/'+f) for f in fileList]
-            if self.parseDate == True: 
-                srch = [re.search(fileInfo['search'], f.rsplit('.',1)[0]).group(0) for f in fileList]
-                Interval = [datetime.datetime.strptime(s,fileInfo['format']) for s in srch]
-                if self.timeShift != '':
-                    Interval = [t + pd.Timedelta(self.timeShift) for t in Interval]
-                    timeString = [datetime.datetime.strftime(t,fileInfo['format']) for t in Interval]
-                    filename = [f.replace(s,t) for f,s,t in zip(fileList,srch,timeString)]
-                else:
-                    filename = fileList
-                Interval = pd.to_datetime(Interval)
+            new = [s not in self.fileInventory.source for s in source]
+            fileList = [f for f,n in zip(fileList,new) if n]
+            source = [s for s,n in zip(source,new) if n]
+            if self.parseDate == True and len(source)>0:
+                Interval,filename,parsed = self.parseIntervals(fileList,fileInfo)
+                source = [s for s,keep in zip(source,parsed) if keep]
+                # Listed again next time (e.g., once the search pattern is fixed)
+                if parsed.all() == False:
+                    unparsed.append(dir)
+            elif self.parseDate == True:
+                Interval,filename = pd.DatetimeIndex([]),[]
             else:
                 filename = fileList
                 Interval = [i for i in range(len(fileList))]
@@ -91,44 +269,86 @@ class copyFiles():
                 elif self.dOut == '':
                     dpath = source
                 else:
-                    dpath = [self.dOut for f in source]
+                    dpath = [f"{self.dOut}/{f}" for f in filename]
                 if self.dOut !='':
-                    pb = progressbar(len(source),f'copying: {dir.replace(self.dIn,"")}')
                     for s,p,f in zip(source,dpath,filename):
-                        if s not in self.fileInventory['source'] and p not in self.fileInventory['dpath']:
-                            if self.overWrite == True or f not in self.fileInventory['filename']:
-                                self.pasteWithSubprocess(s,p)
-                        pb.step()
-                    pb.close()
-                self.fileInventory=pd.concat([self.fileInventory,
-                        pd.DataFrame(data={
+                        if self.overWrite == True or (p not in self.fileInventory.dpath and f not in self.fileInventory.filename):
+                            toCopy.append((s,p))
+                newFiles.append(pd.DataFrame(data={
                             'Interval':Interval,
                             'filename':filename,
                             'dpath':dpath,
                             'source':source
-                        })],axis=0)
-        
-                
-    def pasteWithSubprocess(self,source, dest, option = 'copy',Verbose=False):
-        set_high_priority()
-        cmd=None
-        source = os.path.abspath(source)
-        dest = os.path.abspath(dest)
-        if sys.platform.startswith("darwin"): 
-            # These need to be tested/flushed out
-            if option == 'copy' or option == 'xcopy':
-                cmd=['cp', source, dest]
-            elif option == 'move':
-                cmd=['mv',source,dest]
-        elif sys.platform.startswith("win"): 
-            cmd=[option, source, dest]
-            if option == 'xcopy':
-                cmd.append('/s')
-        # print(cmd)
-        if cmd:
-            proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        if Verbose==True:
-            print(proc)
+                        }))
+        failed,digests = [],{}
+        if len(newFiles)>0:
+            newFiles = pd.concat(newFiles,axis=0,ignore_index=True)
+            if self.hash == True:
+                toCopy,digests = self.dropDuplicates(newFiles,toCopy)
+        if len(toCopy)>0:
+            failed = self.pasteFiles(toCopy,digests)
+        # Add all new files to the inventory at once (files that failed to copy are left out so they are retried next time)
+        if len(newFiles)>0:
+            prof.count('files_new',newFiles.shape[0])
+            with prof.span('inventory'):
+                self.fileInventory.add(newFiles.loc[~newFiles['source'].isin(failed)])
+        # Directories with files that failed to copy (or whose timestamp couldn't be parsed) will be listed again next time
+        for f in failed:
+            stamps.pop(os.path.dirname(f),None)
+        for dir in unparsed:
+            stamps.pop(dir,None)
+        self.fileInventory.updateDirs(stamps)
+
+    def dropDuplicates(self,newFiles,toCopy):
+        # Hash the new files and drop the copies of files whose contents are already in the inventory (or earlier in toCopy)
+        # Duplicates are recorded in the inventory with the dpath of the existing copy
+        T1 = time.time()
+        with prof.span('hash'):
+            newFiles['hash'] = hashFiles(newFiles['source'],self.threads)
+        prof.count('files_hashed',newFiles.shape[0])
+        print(f'Hashed {newFiles.shape[0]} files in {time.time()-T1:.1f} seconds')
+        digests = dict(zip(newFiles['source'],newFiles['hash']))
+        known = dict(self.fileInventory.hash)
+        unique,existing = [],{}
+        for s,p in toCopy:
+            h = digests[s]
+            if h in known:
+                existing[s] = known[h]
+            else:
+                known[h] = p
+                unique.append((s,p))
+        newFiles['dpath'] = newFiles['source'].map(existing).fillna(newFiles['dpath'])
+        if len(unique)<len(toCopy):
+            print(f'Skipping {len(toCopy)-len(unique)} files with the same contents as files already copied')
+        return(unique,digests)
+
+    @prof.timed('copy')
+    def pasteFiles(self,toCopy,digests={}):
+        # Copy a list of (source, dest) pairs on a pool of threads and report the throughput
+        # digests: optional {source:hash} to verify the copies against
+        T1 = time.time()
+        nBytes,nCopied,failed = 0,0,[]
+        pb = progressbar(len(toCopy),f'copying: {self.dIn}')
+        with ThreadPoolExecutor(max_workers=max(self.threads,1)) as pool:
+            futures = {pool.submit(copyFile,s,p,self.link,digests.get(s)):s for s,p in toCopy}
+            for future in as_completed(futures):
+                try:
+                    n = future.result()
+                    if n is not None:
+                        nBytes += n
+                        nCopied += 1
+                except OSError as e:
+                    failed.append(futures[future])
+                    print(f'Failed to copy {futures[future]}: {e}')
+                pb.step()
+        pb.close()
+        prof.count('files_copied',nCopied)
+        prof.count('bytes_copied',nBytes)
+        dT = max(time.time()-T1,1e-6)
+        print(f'Copied {nCopied} of {len(toCopy)} files ({nBytes/1024**2:.1f} MB) in {dT:.1f} seconds: {nBytes/1024**2/dT:.1f} MB/s, {len(toCopy)/dT:.1f} files/s')
+        if len(failed)>0:
+            print(f'{len(failed)} files failed to copy')
+        return(failed)
 
 if __name__ == '__main__':
     # Parse the arguments
@@ -147,7 +367,11 @@ if __name__ == '__main__':
         elif dt == type([]):
             nargs = '+'
             dt = type('')
-        CLI.add_argument(f"--{key}",nargs=nargs,type=dt,default=val)
+        # --profile without a file name saves to dataDump_profile.json
+        if key == 'profile':
+            CLI.add_argument(f"--{key}",nargs=nargs,type=dt,default=val,const='dataDump_profile.json')
+        else:
+            CLI.add_argument(f"--{key}",nargs=nargs,type=dt,default=val)
 
     # parse the command line
     args = CLI.parse_args()
@@ -0,0 +1,157 @@
+# Write the requests of csvFromBinary.py in columnar formats
+# Intended to be called by other scripts, e.g., csvFromBinary.py
+
+# Set output_format under the formatting of a request (in csv_from_binary.yml): csv (default), parquet, feather, arrow, or netcdf
+# Columnar formats write the float32 trace arrays directly, without converting each value to text:
+#   * the timestamps are stored as a native datetime column, named by the first time vector of the request (its fmt is not applied and other time vectors are not written)
+#   * units (and the source trace name) are stored as metadata of each column
+#   * NaNs are kept as NaN, the na_value of the request is stored in the file metadata; if na_value is blank, rows with any NaNs are dropped (same as csv)
+#   * resampled outputs are labelled by the first timestamp of each period (same as csv) and named output_name_agg when more than one agg is requested
+# The optional dependencies are only imported when a format needs them:
+#   * pyarrow for parquet, feather, and arrow (IPC file), e.g., pip install pyarrow
+#   * xarray (with netCDF4 or scipy) for netcdf, e.g., pip install xarray netCDF4
+# Reading the outputs:
+    # python: pd.read_parquet(file), pd.read_feather(file), xr.open_dataset(file)
+    # R: arrow::read_parquet(file), arrow::read_feather(file), arrow::read_ipc_file(file)
+
+import importlib
+import numpy as np
+import pandas as pd
+import resampleTraces as rsT
+from profiler import shared as prof
+
+extensions = {'csv':'.csv','parquet':'.parquet','feather':'.feather','arrow':'.arrow','netcdf':'.nc'}
+
+def requireModule(name,fmt,install=None):
+    try:
+        return(importlib.import_module(name))
+    except ImportError:
+        raise ImportError(f"{name} is required for output_format: {fmt}, e.g., pip install {install or name}")
+
+# Output name, units, and source trace of each numeric column of a request
+def traceColumns(task):
+    columns = {}
+    aggregation = None
+    if 'resample' in task['formatting']:
+        aggregation = task['formatting']['resample']['agg'].split(',')
+    for trace_name,trace_info in task['traces'].items():
+        if aggregation is None:
+            columns[trace_info['output_name']] = {'units':trace_info['units'],'trace':trace_name}
+        elif len(aggregation) == 1:
+            columns[trace_info['output_name']] = {'units':trace_info['units'],'trace':trace_name,'agg':aggregation[0]}
+        else:
+            for agg in aggregation:
+                columns[f"{trace_info['output_name']}_{agg}"] = {'units':trace_info['units'],'trace':trace_name,'agg':agg}
+    return(columns)
+
+# Name of the timestamp column of a request
+def timeColumn(task):
+    time_vectors = list(task['formatting']['time_vectors'].values())
+    if len(time_vectors) == 0:
+        return('timestamp')
+    return(time_vectors[0]['output_name'])
+
+# Columnar equivalent of csvFromBinary.exportBlock: returns the timestamps and {column:float32 array} for one block of rows
+# resampled: (first timestamps, aggregates) if the request has already been resampled, e.g., from traceAggregates.resampleFromAggregates
+@prof.timed('exportBlock')
+def columnarBlock(task,DT,data,missing,Range_index,resampled=None):
+    if resampled is None:
+        values = {}
+        for trace_name,trace_info in task['traces'].items():
+            if trace_name in missing:
+                values[trace_name] = np.full(DT.shape,np.nan,dtype='float32')
+            else:
+                values[trace_name] = data[trace_name]
+        # limit to requested timeframe
+        keep = (DT>=Range_index.min())&(DT<=Range_index.max())
+        DT = DT[keep]
+        values = {name:v[keep] for name,v in values.items()}
+    if 'resample' in task['formatting']:
+        freq = task['formatting']['resample']['freq']
+        aggregation = task['formatting']['resample']['agg'].split(',')
+        # Label each period by its first timestamp
+        if resampled is None:
+            resampled = rsT.resampleTraces(DT,values,freq,aggregation)
+        DT,rsmp = resampled
+        output_names = {trace_name:trace_info['output_name'] for trace_name,trace_info in task['traces'].items()}
+        if len(aggregation) == 1:
+            values = {output_names[name]:rsmp[(name,aggregation[0])].values for name in output_names}
+        else:
+            values = {f"{output_names[name]}_{agg}":rsmp[(name,agg)].values for name in output_names for agg in aggregation}
+    else:
+        values = {task['traces'][name]['output_name']:v for name,v in values.items()}
+    values = {name:np.asarray(v,dtype='float32') for name,v in values.items()}
+    # Drop rows with any NaNs if no na_value is specified
+    if task['formatting']['na_value'] is None and len(values) > 0:
+        keep = ~np.isnan(np.vstack(list(values.values()))).any(axis=0)
+        DT = DT[keep]
+        values = {name:v[keep] for name,v in values.items()}
+    return(DT,values)
+
+# Writes the blocks of a request to one file, call write() for each block and close() once done
+class columnarWriter():
+    def __init__(self,fmt,path,timeName,columns,metadata={}):
+        # columns: {output_name:{'units':...,'trace':...}} (see traceColumns)
+        # metadata: file level attributes (e.g., siteID, stage, na_value)
+        if fmt not in extensions or fmt == 'csv':
+            raise ValueError(f"output_format: {fmt} is not a columnar format, expecting one of {[f for f in extensions if f != 'csv']}")
+        self.fmt,self.path,self.timeName,self.columns = fmt,path,timeName,columns
+        self.metadata = {k:'' if v is None else str(v) for k,v in metadata.items()}
+        self.rows = 0
+        if fmt == 'netcdf':
+            self.xr = requireModule('xarray',fmt,'xarray netCDF4')
+            self.blocks = []
+            return
+        self.pa = requireModule('pyarrow',fmt)
+        fields = [self.pa.field(timeName,self.pa.timestamp('ns'))]
+        for name,info in columns.items():
+            fields.append(self.pa.field(name,self.pa.float32(),metadata={k:str(v) for k,v in info.items()}))
+        self.schema = self.pa.schema(fields,metadata=self.metadata)
+        if fmt == 'parquet':
+            pq = requireModule('pyarrow.parquet',fmt,'pyarrow')
+            self.writer = pq.ParquetWriter(path,self.schema)
+        elif fmt == 'arrow':
+            self.sink = self.pa.OSFile(path,'wb')
+            self.writer = self.pa.ipc.new_file(self.sink,self.schema)
+        else:
+            # feather files are written in one go
+            self.batches = []
+
+    def write(self,DT,values):
+        self.rows += DT.shape[0]
+        if self.fmt == 'netcdf':
+            self.blocks.append((DT,values))
+            return
+        arrays = [self.pa.array(DT.values.astype('datetime64[ns]'))]+[self.pa.array(values[name]) for name in self.columns]
+        batch = self.pa.RecordBatch.from_arrays(arrays,schema=self.schema)
+        if self.fmt == 'feather':
+            self.batches.append(batch)
+        else:
+            self.writer.write_batch(batch)
+
+    def close(self):
+        if self.fmt == 'parquet':
+            self.writer.close()
+        elif self.fmt == 'arrow':
+            self.writer.close()
+            self.sink.close()
+        elif self.fmt == 'feather':
+            feather = requireModule('pyarrow.feather',self.fmt,'pyarrow')
+            feather.write_feather(self.pa.Table.from_batches(self.batches,schema=self.schema),self.path)
+        else:
+            if len(self.blocks) > 0:
+                DT = pd.DatetimeIndex(np.concatenate([b[0].values for b in self.blocks]))
+            else:
+                DT = pd.DatetimeIndex([])
+            variables = {}
+            for name,info in self.columns.items():
+                if len(self.blocks) > 0:
+                    data = np.concatenate([b[1][name] for b in self.blocks])
+                else:
+                    data = np.array([],dtype='float32')
+                variables[name] = ((self.timeName,),data,{k:str(v) for k,v in info.items()})
+            ds = self.xr.Dataset(variables,coords={self.timeName:DT},attrs=self.metadata)
+            # NaNs are written as the netCDF fill value
+            encoding = {name:{'_FillValue':np.float32(np.nan)} for name in self.columns}
+            ds.to_netcdf(self.path,encoding=encoding)
+        return(self.rows)
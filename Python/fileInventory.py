@@ -0,0 +1,87 @@
+# Inventory of the files found (and copied) by dataDump.py
+# Intended to be called by other scripts, e.g., dataDump.py
+
+# The inventory is stored in an SQLite database (fileInventory.db) in the output folder (or the input folder if there is no output folder)
+#   * one row per source file: Interval, filename, dpath, source (the primary key)
+#   * dpath and filename are indexed
+#   * hash (sha256 of the contents) is only filled when dataDump is run with hash=True, it is indexed to find files already in the inventory under another name
+# The keys are loaded into sets once, so checking if a file is already in the inventory doesn't require a scan
+# Each run only inserts the new rows
+# The directories that have been scanned are also stored: path, mtime_ns, entries (number of files and subdirectories), and subdirs (json list of names)
+#   * if a directory's mtime hasn't changed, no files have been added/removed/renamed in it, so it doesn't need to be listed again
+#   * mtime_ns is left empty for directories modified just before they were scanned (on filesystems with a coarse mtime resolution, e.g., network shares, more files could arrive within the same tick)
+#   * each directory is stored with the signature of the filters it was scanned with (file format, search/exclude tags), saved states from a scan with other filters are ignored
+#     since the files the other filters left out were never inventoried
+# If there is an existing fileInventory.csv (from older versions) and no database, it is imported on the first run (the csv is left as is)
+
+import os
+import json
+import sqlite3
+import pandas as pd
+
+columns = ['Interval','filename','dpath','source']
+
+class fileInventory():
+    def __init__(self,folder,reset=False,filters=''):
+        self.path = os.path.join(folder,'fileInventory.db')
+        csv = os.path.join(folder,'fileInventory.csv')
+        if reset == True and os.path.isfile(self.path):
+            os.remove(self.path)
+        migrate = reset == False and os.path.isfile(self.path) == False and os.path.isfile(csv)
+        self.con = sqlite3.connect(self.path)
+        self.con.execute('CREATE TABLE IF NOT EXISTS files (source TEXT PRIMARY KEY, filename TEXT, dpath TEXT, Interval TEXT)')
+        if 'hash' not in [c[1] for c in self.con.execute('PRAGMA table_info(files)')]:
+            self.con.execute('ALTER TABLE files ADD COLUMN hash TEXT')
+        self.con.execute('CREATE INDEX IF NOT EXISTS files_dpath ON files (dpath)')
+        self.con.execute('CREATE INDEX IF NOT EXISTS files_filename ON files (filename)')
+        self.con.execute('CREATE INDEX IF NOT EXISTS files_hash ON files (hash)')
+        self.con.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER, entries INTEGER, subdirs TEXT)')
+        if 'filters' not in [c[1] for c in self.con.execute('PRAGMA table_info(dirs)')]:
+            self.con.execute('ALTER TABLE dirs ADD COLUMN filters TEXT')
+        self.con.commit()
+        self.filters = filters
+        self.dirs = {p:(m,n,json.loads(s)) for p,m,n,s in self.con.execute('SELECT path, mtime_ns, entries, subdirs FROM dirs WHERE filters = ?',(filters,))}
+        self.source,self.filename,self.dpath,self.hash = set(),set(),set(),{}
+        for s,f,p,h in self.con.execute('SELECT source, filename, dpath, hash FROM files'):
+            self.source.add(s)
+            self.filename.add(f)
+            self.dpath.add(p)
+            # dpath of the first file with each hash
+            if h is not None and h not in self.hash:
+                self.hash[h] = p
+        if migrate == True:
+            print(f'Importing {csv}')
+            self.add(pd.read_csv(csv))
+
+    def add(self,df):
+        # Insert new rows (a dataframe with the inventory columns and optionally hash), rows with a known source are ignored
+        df = df.loc[~df['source'].isin(self.source)].drop_duplicates(subset='source')
+        if df.shape[0] == 0:
+            return
+        if 'hash' in df.columns:
+            hashes = df['hash'].tolist()
+        else:
+            hashes = [None]*df.shape[0]
+        rows = zip(df['source'],df['filename'],df['dpath'],df['Interval'].astype(str),hashes)
+        with self.con:
+            self.con.executemany('INSERT OR IGNORE INTO files (source, filename, dpath, Interval, hash) VALUES (?,?,?,?,?)',rows)
+        self.source.update(df['source'])
+        self.filename.update(df['filename'])
+        self.dpath.update(df['dpath'])
+        for h,p in zip(hashes,df['dpath']):
+            if h is not None and h not in self.hash:
+                self.hash[h] = p
+
+    def updateDirs(self,stamps):
+        # Save the state of the scanned directories, a dict of {path:(mtime_ns,entries,subdirs)}
+        rows = [(p,m,n,json.dumps(s),self.filters) for p,(m,n,s) in stamps.items()]
+        with self.con:
+            self.con.executemany('INSERT OR REPLACE INTO dirs (path, mtime_ns, entries, subdirs, filters) VALUES (?,?,?,?,?)',rows)
+        self.dirs.update(stamps)
+
+    def read(self):
+        # The full inventory as a dataframe
+        return(pd.read_sql('SELECT Interval, filename, dpath, source, hash FROM files',self.con))
+
+    def close(self):
+        self.con.close()
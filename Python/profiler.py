@@ -0,0 +1,118 @@
+# Lightweight instrumentation: named timing spans and counters
+# Intended to be called by other scripts, e.g., csvFromBinary.py, textFileToBinary.py, dataDump.py
+
+# Profiling is off by default:
+#   * span() returns a shared do-nothing context manager and count() returns immediately, so instrumented code runs at (almost) full speed
+# When on, each span accumulates the number of calls and total seconds under its name, and each counter accumulates a total
+#   * spans can be nested (e.g., readTraces within exportTask), the time is counted under both names
+# Totals are kept per process, worker processes can return their summary() to be merged into the main process
+# Basic call from other python scripts:
+    # from profiler import shared as prof
+    # prof.enable()
+    # with prof.span('readTraces'):
+    #     ...
+    # or time every call of a function:
+    # @prof.timed('readTraces')
+    # def readTraces(...):
+    # prof.count('bytes_read',nBytes)
+    # prof.save('profile.json')
+
+import json
+import time
+import functools
+import threading
+import contextlib
+from datetime import datetime
+
+class span():
+    def __init__(self,prof,name):
+        self.prof = prof
+        self.name = name
+
+    def __enter__(self):
+        self.T1 = time.perf_counter()
+        return(self)
+
+    def __exit__(self,*args):
+        self.prof.addSpan(self.name,time.perf_counter()-self.T1)
+        return(False)
+
+class profiler():
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.null = contextlib.nullcontext()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.spans = {}
+            self.counters = {}
+            self.started = time.perf_counter()
+            self.date = datetime.now().isoformat()
+
+    def enable(self):
+        self.enabled = True
+        self.reset()
+
+    def disable(self):
+        self.enabled = False
+
+    def span(self,name):
+        if self.enabled == False:
+            return(self.null)
+        return(span(self,name))
+
+    def timed(self,name):
+        # Decorator to time every call of a function under name
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args,**kwargs):
+                if self.enabled == False:
+                    return(func(*args,**kwargs))
+                with span(self,name):
+                    return(func(*args,**kwargs))
+            return(wrapper)
+        return(decorator)
+
+    def addSpan(self,name,seconds,calls=1):
+        with self.lock:
+            s = self.spans.setdefault(name,{'calls':0,'seconds':0.0})
+            s['calls'] += calls
+            s['seconds'] += seconds
+
+    def count(self,name,n=1):
+        if self.enabled == False:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name,0)+n
+
+    def summary(self):
+        with self.lock:
+            return({
+                'date':self.date,
+                'wall_seconds':time.perf_counter()-self.started,
+                'spans':{k:dict(v) for k,v in sorted(self.spans.items(),key=lambda s:-s[1]['seconds'])},
+                'counters':dict(self.counters),
+                })
+
+    def merge(self,summary):
+        # Add the spans and counters of another summary (e.g., from a worker process)
+        if self.enabled == False or summary is None:
+            return
+        for name,s in summary['spans'].items():
+            self.addSpan(name,s['seconds'],s['calls'])
+        with self.lock:
+            for name,n in summary['counters'].items():
+                self.counters[name] = self.counters.get(name,0)+n
+
+    def save(self,path,info={}):
+        # Write the summary (plus any extra info about the run) to a JSON file
+        summary = info | self.summary()
+        with open(path,'w') as f:
+            json.dump(summary,f,indent=2,default=str)
+        print(f'Profile saved to {path}')
+        return(summary)
+
+# Profiler shared by all callers within the process
+shared = profiler()
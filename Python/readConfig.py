@@ -2,41 +2,101 @@
 # Intended to be called by other scripts, not called by user directly
 # Written by June Skeeter
 
+# Paths are resolved without changing the working directory:
+#   * relative paths to config files (e.g., 'config_files/config.yml') are resolved against the current working directory first, then the directory of this script
+#   * relative rootDir paths in user_path_definitions.yml are resolved against the directory of this script
+# Parsed yaml files are cached by path, mtime & size, so each file is only parsed again if it changes
+# A configuration object holds the resolved paths only, so it is safe to share between threads and to pickle into worker processes
+# Basic call from other python scripts:
+    # import readConfig as rCfg
+    # config = rCfg.set_user_configuration({'tasks':'config_files/csv_from_binary.yml'})
+# Or keep the configuration object and call get() whenever the (current) settings are needed:
+    # cfg = rCfg.configuration({'tasks':'config_files/csv_from_binary.yml'})
+    # config = cfg.get()
+
 import os
+import re
 import sys
+import copy
 import yaml # Note: you need to install the "pyyaml" package, e.g., pip install pyyaml
 import argparse
+import threading
+from profiler import shared as prof
 
+moduleDir = os.path.dirname(os.path.abspath(__file__))
 
-def set_user_configuration(auxilary={}):
-    wd = os.getcwd()
-    os.chdir(os.path.split(__file__)[0])
-    # Parse the config settings
-    with open('config_files/config.yml') as yml:
-        config = yaml.safe_load(yml)
-        if os.path.isfile('config_files/user_path_definitions.yml'):
-            with open('config_files/user_path_definitions.yml') as yml:
-                config.update(yaml.safe_load(yml))
-        else:
-            with open('config_files/user_path_definitions_template.yml') as yml:
-                config.update(yaml.safe_load(yml))
-            print(f"WARNING: missing {'config_files/user_path_definitions.yml'}")
-            print("Proceeding with template paths from {'config_files/user_path_definitions_template.yml'}")
-            print("These are likely to cause issues, please create your own path definition file")
-
-    # Import the user specified configurations (exit if they don't exist)
-    if auxilary != {}:
+# Parsed yaml files {path:((mtime_ns,size),contents)}, shared by all threads in a process
+yamlCache = {}
+yamlLock = threading.Lock()
+warned = []
+
+def resolvePath(path):
+    # Absolute path of a config file, or None if it doesn't exist
+    if os.path.isabs(path):
+        if os.path.isfile(path):
+            return(path)
+        return(None)
+    for root in [os.getcwd(),moduleDir]:
+        fn = os.path.abspath(os.path.join(root,path))
+        if os.path.isfile(fn):
+            return(fn)
+    return(None)
+
+def loadYAML(path):
+    # Parse a yaml file, or get it from the cache if it hasn't changed
+    # The cached contents are shared, so don't modify them (configuration.get() returns a copy)
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns,stat.st_size)
+    with yamlLock:
+        entry = yamlCache.get(path)
+    if entry is not None and entry[0] == stamp:
+        return(entry[1])
+    with prof.span('parseYAML'), open(path) as yml:
+        contents = yaml.safe_load(yml)
+    prof.count('yaml_parsed')
+    with yamlLock:
+        yamlCache[path] = (stamp,contents)
+    return(contents)
+
+class configuration():
+    def __init__(self,auxilary={}):
+        # auxilary: {key:file or [files]} of user specified configurations to add under each key (exit if they don't exist)
+        self.config = resolvePath('config_files/config.yml')
+        self.userPaths = resolvePath('config_files/user_path_definitions.yml')
+        if self.userPaths is None:
+            self.userPaths = resolvePath('config_files/user_path_definitions_template.yml')
+            if len(warned) == 0:
+                warned.append(True)
+                print(f"WARNING: missing {'config_files/user_path_definitions.yml'}")
+                print("Proceeding with template paths from {'config_files/user_path_definitions_template.yml'}")
+                print("These are likely to cause issues, please create your own path definition file")
+        self.auxilary = {}
         for key,value in auxilary.items():
-            config[key] = {}
             if isinstance(value,str):value=[value]
+            self.auxilary[key] = []
             for req in value:
-                if os.path.isfile(req):
-                    with open(req) as yml:
-                        config[key].update(yaml.safe_load(yml))
-                else:
+                fn = resolvePath(req)
+                if fn is None:
                     sys.exit(f"Missing {req}")
-            os.chdir(wd)
-    return(config)
+                self.auxilary[key].append(fn)
+
+    def get(self):
+        # The full configuration (a new copy on each call)
+        config = copy.deepcopy(loadYAML(self.config))
+        config.update(copy.deepcopy(loadYAML(self.userPaths)))
+        if 'rootDir' in config:
+            for key,value in config['rootDir'].items():
+                # Windows drive paths (e.g., C:/Database/) are absolute on any platform
+                if isinstance(value,str) and not os.path.isabs(value) and re.match('^[A-Za-z]:[/\\\\]',value) is None:
+                    config['rootDir'][key] = os.path.join(moduleDir,value)
+        for key,files in self.auxilary.items():
+            config[key] = {}
+            for fn in files:
+                config[key].update(copy.deepcopy(loadYAML(fn)))
+        return(config)
+
+def set_user_configuration(auxilary={}):
+    return(configuration(auxilary).get())
 
 # If called from command line ...
 if __name__ == '__main__':
@@ -53,4 +113,4 @@ if __name__ == '__main__':
     # Parse the args and make the call
     args = CLI.parse_args()
 
-    set_user_configuration(args.tasks)
\ No newline at end of file
+    set_user_configuration({'tasks':args.tasks})
\ No newline at end of file
@@ -0,0 +1,104 @@
+# Read slices of traces from the binary database
+# Intended to be called by other scripts, e.g., csvFromBinary.py
+
+# Each Database/YYYY/SiteID/Stage/ folder holds one file per trace on a fixed time grid (see dbase_metadata in config.yml)
+#   * row 0 is YYYY-01-01 00:30 and the last row is YYYY+1-01-01 00:00 (for the default 30min resolution)
+#   * so the byte offset of any timestamp can be computed directly, without reading the file
+# Traces are memory-mapped so only the rows within the requested date range are read from disk
+# Rows that have been read are kept in an in-process cache (see traceCache.py) so repeated requests are served from memory
+# Traces missing (or with an invalid size) in some years are filled with NaNs for those years only
+#   * with a catalog (see traceCatalog.py), only the files listed as valid are opened
+# Basic call from other python scripts:
+    # import readTraces as rTr
+    # tv,traces = rTr.readTraces(siteID="BBS",stage="Second",traces=["TA_1_1_1","RH_1_1_1"],dateRange=["2023-12-20 00:00","2024-01-10 23:59"])
+
+import os
+import numpy as np
+import pandas as pd
+import timeGrid as tg
+import readConfig as rCfg
+from traceCache import shared as sharedCache
+from profiler import shared as prof
+
+def yearSlices(dateRange,resolution):
+    # Get the row slice of each year file that falls within the dateRange (inclusive of end points)
+    # Returns a list of (year, first row, number of rows)
+    Range_index = pd.DatetimeIndex(dateRange)
+    start,end = Range_index.min(),Range_index.max()
+    slices = []
+    for YYYY in range(start.year,end.year+1):
+        nRows = tg.yearBounds(YYYY,resolution)[2]
+        first,last = tg.rowIndex([start,end],YYYY,resolution)
+        i0 = max(int(np.ceil(first)),0)
+        i1 = min(int(np.floor(last)),nRows-1)
+        slices.append((YYYY,i0,max(i1-i0+1,0)))
+    return(slices)
+
+def readSlice(path,dtype,i0,n):
+    # Memory-map the file and copy out rows i0:i0+n
+    # raises FileNotFoundError if the trace does not exist and ValueError if it is too short
+    dtype = np.dtype(dtype)
+    if n == 0:
+        return(np.empty(0,dtype=dtype))
+    mm = np.memmap(path,dtype=dtype,mode='r',offset=i0*dtype.itemsize,shape=(n,))
+    data = np.array(mm)
+    prof.count('bytes_read',data.nbytes)
+    # release the file handle (important on network drives/windows)
+    del mm
+    return(data)
+
+def decodeTimestamps(tv,tsInfo):
+    # Convert matlab datenums to a datetime array
+    return(tg.fromDatenum(tv,tsInfo['base'],tsInfo['base_unit']))
+
+@prof.timed('readTraces')
+def readTraces(siteID,stage,traces,dateRange,database=None,config=None,verbose=True,cache=True,decode=False,catalog=None):
+    # Read the timestamp vector and a list of traces over the dateRange
+    # Returns the clean_tv slice (or a DatetimeIndex if decode is True) and a dict of trace arrays
+    # Traces are NaN over the years where they are missing
+    # catalog: a traceCatalog of the database, the requested traces it hasn't stat'ed yet are stat'ed first
+    if config is None:
+        config = rCfg.set_user_configuration()
+    if database is None:
+        database = config['rootDir']['database']
+    if stage in config['stage'].keys():
+        stage = config['stage'][stage]
+    if 'trace_cache' in config:
+        sharedCache.resize(config['trace_cache']['max_bytes'])
+    tsInfo = config['dbase_metadata']['timestamp']
+    trInfo = config['dbase_metadata']['traces']
+    slices = yearSlices(dateRange,tsInfo['resolution'])
+
+    def read(name,dtype,YYYY,i0,n,decoded=False):
+        path = os.path.join(database,str(YYYY),siteID,stage,name)
+        if decoded == True:
+            loader = lambda j0,m: decodeTimestamps(readSlice(path,dtype,j0,m),tsInfo)
+            name = name+':decoded'
+        else:
+            loader = lambda j0,m: readSlice(path,dtype,j0,m)
+        if n == 0 or cache == False:
+            return(loader(i0,n))
+        return(sharedCache.get((database,siteID,stage,YYYY,name),path,i0,n,loader))
+
+    tv = np.concatenate([read(tsInfo['name'],tsInfo['dtype'],YYYY,i0,n,decode) for YYYY,i0,n in slices],axis=0)
+    if decode == True:
+        tv = pd.DatetimeIndex(tv)
+    if catalog is not None:
+        available = catalog.available(siteID,stage,[YYYY for YYYY,i0,n in slices if n > 0],refresh=False,traces=traces)
+    data = {}
+    prof.count('traces_read',len(traces))
+    for trace_name in traces:
+        trace,missing = [],[]
+        for YYYY,i0,n in slices:
+            try:
+                if catalog is not None and n > 0 and trace_name not in available[YYYY]:
+                    raise FileNotFoundError
+                trace.append(read(trace_name,trInfo['dtype'],YYYY,i0,n))
+            # give NaN for the years where the trace does not exist
+            except (OSError,ValueError):
+                missing.append(YYYY)
+                trace.append(np.full(n,np.nan,dtype=trInfo['dtype']))
+        if len(missing) > 0 and verbose == True:
+            print(f"{trace_name} missing in {missing}, outputting NaNs")
+        data[trace_name] = np.concatenate(trace,axis=0)
+    return(tv,data)
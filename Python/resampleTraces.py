@@ -0,0 +1,134 @@
+# Resample traces from the binary database
+# Intended to be called by other scripts, e.g., csvFromBinary.py, exportFormats.py
+
+# Gives the same periods, labels, and dtypes as pandas DataFrame.resample(freq).agg(aggregation) for mean, std, min, max, sum, and count (NaNs are skipped)
+#   * fixed frequencies (e.g., D, 6h, 7D) of regular data (e.g., 48 half-hours/day) are computed by reshaping each trace into (periods x slots)
+#     the first and last periods are padded with NaNs to a full number of slots
+#   * other frequencies (e.g., calendar months) or data with gaps get the bins from pandas, then each period is reduced in place (numpy ufunc.reduceat)
+#   * any other aggregation (e.g., median) is passed to pandas
+# All aggregations are computed in float64 in one pass over the stacked traces, then cast back to the dtype of each trace (count is int64), same as pandas
+#   * pandas accumulates float32 traces in float32, so means & sums can differ from pandas in the last digit (these are rounded from the float64 result)
+# Basic call from other python scripts:
+    # import resampleTraces as rsT
+    # first,rsmp = rsT.resampleTraces(DT,{'TA_1_1_1':ta,'RH_1_1_1':rh},'D',['mean','max'])
+
+import numpy as np
+import pandas as pd
+from profiler import shared as prof
+
+aggregations = ['mean','std','min','max','sum','count']
+
+def fixedBins(DT,freq):
+    # Position of the first row within its period and the number of rows per period (slots) if the bins can be reshaped, otherwise None
+    try:
+        offset = pd.tseries.frequencies.to_offset(freq)
+    except (ValueError,TypeError):
+        return(None)
+    if not isinstance(offset,pd.offsets.Tick) or DT.shape[0] < 2:
+        return(None)
+    period = pd.Timedelta(offset).value
+    ns = DT.asi8
+    step = ns[1]-ns[0]
+    if step <= 0 or period % step != 0 or not (np.diff(ns) == step).all():
+        return(None)
+    # pandas bins fixed frequencies from midnight of the first day (origin='start_day')
+    origin = DT[0].normalize().value
+    if (ns[0]-origin) % step != 0:
+        return(None)
+    first = (ns[0]-origin)//period
+    lead = int(((ns[0]-origin)%period)//step)
+    return(origin+first*period,period,lead,int(period//step))
+
+def reduce(X,aggregation,reshaped,starts=None):
+    # Aggregate X (traces x rows) over each period, X is (traces x periods x slots) if reshaped or split at starts otherwise
+    # Returns {agg:(traces x periods)}
+    valid = ~np.isnan(X)
+    if reshaped == True:
+        count = valid.sum(axis=-1)
+        total = np.add.reduce(X,axis=-1,where=valid)
+    else:
+        count = np.add.reduceat(valid,starts,axis=-1,dtype='int64')
+        total = np.add.reduceat(np.where(valid,X,0.0),starts,axis=-1)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        mean = total/count
+    results = {}
+    for agg in aggregation:
+        if agg == 'mean':
+            results[agg] = mean
+        elif agg == 'sum':
+            results[agg] = total
+        elif agg == 'count':
+            results[agg] = count
+        elif agg in ['min','max']:
+            # fmin/fmax skip NaNs (all NaN periods stay NaN)
+            func = np.fmin if agg == 'min' else np.fmax
+            if reshaped == True:
+                results[agg] = func.reduce(X,axis=-1)
+            else:
+                results[agg] = func.reduceat(X,starts,axis=-1)
+        elif agg == 'std':
+            if reshaped == True:
+                deviation = X-mean[...,np.newaxis]
+                squares = np.add.reduce(deviation*deviation,axis=-1,where=valid)
+            else:
+                lengths = np.diff(np.append(starts,X.shape[-1]))
+                deviation = np.where(valid,X-np.repeat(mean,lengths,axis=-1),0.0)
+                squares = np.add.reduceat(deviation*deviation,starts,axis=-1)
+            with np.errstate(invalid='ignore',divide='ignore'):
+                results[agg] = np.where(count > 1,np.sqrt(squares/(count-1)),np.nan)
+    return(results)
+
+@prof.timed('resample')
+def resampleTraces(DT,values,freq,aggregation):
+    # DT: DatetimeIndex of the rows, values: {name:array}, aggregation: list of aggregation names
+    # Returns the first timestamp of each period and a dataframe of the aggregates with (name, agg) columns, indexed by the start of each period
+    names = list(values.keys())
+    if any(agg not in aggregations for agg in aggregation):
+        first = pd.Series(DT,index=DT).resample(freq).first()
+        rsmp = pd.DataFrame(values,index=DT).resample(freq).agg(aggregation)
+        return(pd.DatetimeIndex(first.values),rsmp)
+    bins = fixedBins(DT,freq)
+    if bins is not None:
+        prof.count('resample_reshaped')
+        start,period,lead,slots = bins
+        nPeriods = -(-(lead+DT.shape[0])//slots)
+        X = np.full((len(names),nPeriods*slots),np.nan)
+        for i,name in enumerate(names):
+            X[i,lead:lead+DT.shape[0]] = values[name]
+        results = reduce(X.reshape(len(names),nPeriods,slots),aggregation,True)
+        labels = pd.DatetimeIndex(start+period*np.arange(nPeriods,dtype='int64'))
+        firstRow = np.maximum(np.arange(nPeriods)*slots-lead,0)
+        first = DT[firstRow]
+    else:
+        X = np.empty((len(names),DT.shape[0]),dtype='float64')
+        for i,name in enumerate(names):
+            X[i] = values[name]
+        # Bins (e.g., calendar months) from pandas: the first row of each period, NaN for periods without rows
+        prof.count('resample_segments')
+        bins = pd.Series(np.arange(DT.shape[0],dtype='float64'),index=DT).resample(freq).first()
+        labels = bins.index
+        filled = ~np.isnan(bins.values)
+        starts = bins.values[filled].astype('int64')
+        first = np.full(labels.shape,np.datetime64('NaT'),dtype='datetime64[ns]')
+        first[filled] = DT.values[starts]
+        first = pd.DatetimeIndex(first)
+        results = {}
+        if starts.size > 0:
+            for agg,r in reduce(X,aggregation,False,starts).items():
+                full = np.full((len(names),labels.shape[0]),0 if agg in ['sum','count'] else np.nan,dtype=r.dtype)
+                full[:,filled] = r
+                results[agg] = full
+        else:
+            for agg in aggregation:
+                results[agg] = np.full((len(names),labels.shape[0]),0 if agg in ['sum','count'] else np.nan)
+    columns = {}
+    for i,name in enumerate(names):
+        dtype = np.asarray(values[name]).dtype
+        for agg in aggregation:
+            if agg == 'count':
+                columns[(name,agg)] = results[agg][i].astype('int64')
+            else:
+                columns[(name,agg)] = results[agg][i].astype(dtype)
+    rsmp = pd.DataFrame(columns,index=labels)
+    rsmp.columns = pd.MultiIndex.from_tuples(columns.keys())
+    return(first,rsmp)
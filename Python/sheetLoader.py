@@ -0,0 +1,143 @@
+# Fetch & parse published (html) google sheets, with a disk cache
+# Intended to be called by other scripts, e.g., textFileToBinary.py
+
+# Several requests often point to different tables (subtable_id) of the same published document, so:
+#   * each distinct link is downloaded once per run, links are fetched concurrently
+#   * each document is parsed once (pd.read_html gives every table), each request then picks its table
+# The html and the parsed tables are kept in config_files/sheet_cache/ along with the ETag & Last-Modified headers of the response
+#   * later runs send a conditional request (If-None-Match/If-Modified-Since), if the sheet hasn't changed (304) the cached tables are loaded without downloading or parsing
+#   * if the link can't be reached, the cached copy is used (with a warning) if there is one
+# Any http(s) link works, e.g., a local server standing in for google sheets when testing
+# Basic call from other python scripts:
+    # import sheetLoader as sL
+    # sheets = sL.sheetLoader()
+    # sheets.fetch([link])
+    # Data = sheets.tables(link,header=[1])[0]
+
+import io
+import os
+import json
+import hashlib
+import threading
+import pandas as pd
+import urllib.error
+import urllib.request
+from profiler import shared as prof
+from concurrent.futures import ThreadPoolExecutor
+
+defaultCache = os.path.join(os.path.dirname(os.path.abspath(__file__)),'config_files','sheet_cache')
+
+class sheetLoader():
+    def __init__(self,cacheDir=defaultCache,threads=8,timeout=60):
+        self.cacheDir = cacheDir
+        self.threads = threads
+        self.timeout = timeout
+        # Documents fetched in this run {link:html}
+        self.documents = {}
+        # Tables parsed in this run {(link,header):[DataFrame]}
+        self.parsed = {}
+        # Links that were changed since they were last cached
+        self.changed = set()
+        self.lock = threading.Lock()
+
+    def path(self,link,suffix):
+        key = hashlib.sha1(link.encode()).hexdigest()[:16]
+        return(os.path.join(self.cacheDir,key+suffix))
+
+    def readMeta(self,link):
+        if os.path.isfile(self.path(link,'.json')) and os.path.isfile(self.path(link,'.html')):
+            with open(self.path(link,'.json')) as f:
+                return(json.load(f))
+        return({})
+
+    def write(self,fn,content):
+        # Write to a temporary file then rename, so an interrupted run never leaves a partial cache file
+        # The cache folder is only created when needed, if it can't be written (e.g., read-only install) the run carries on without caching
+        try:
+            os.makedirs(self.cacheDir,exist_ok=True)
+            if isinstance(content,str):
+                with open(fn+'.tmp','w',encoding='utf-8') as f:
+                    f.write(content)
+            else:
+                pd.to_pickle(content,fn+'.tmp')
+            os.replace(fn+'.tmp',fn)
+        except OSError as e:
+            print(f'Warning: could not write {fn} ({e})')
+
+    def readCached(self,link):
+        with open(self.path(link,'.html'),encoding='utf-8') as f:
+            return(f.read())
+
+    def fallback(self,link,meta,error):
+        # Use the cached copy if the link can't be fetched
+        if len(meta) == 0:
+            raise error
+        print(f'Warning: could not fetch {link} ({error}), using the cached copy from {meta["fetched"]}')
+        return(self.readCached(link))
+
+    @prof.timed('fetchSheet')
+    def fetchOne(self,link):
+        # Download a document (if it has changed), returns the html
+        meta = self.readMeta(link)
+        request = urllib.request.Request(link)
+        if 'etag' in meta:
+            request.add_header('If-None-Match',meta['etag'])
+        if 'last_modified' in meta:
+            request.add_header('If-Modified-Since',meta['last_modified'])
+        try:
+            with urllib.request.urlopen(request,timeout=self.timeout) as response:
+                body = response.read()
+                charset = response.headers.get_content_charset() or 'utf-8'
+                headers = response.headers
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                return(self.fallback(link,meta,e))
+            prof.count('sheets_not_modified')
+            return(self.readCached(link))
+        except (urllib.error.URLError,OSError) as e:
+            return(self.fallback(link,meta,e))
+        prof.count('sheets_downloaded')
+        prof.count('bytes_read',len(body))
+        html = body.decode(charset,errors='replace')
+        with self.lock:
+            self.changed.add(link)
+        # Parsed tables of the old version are out of date
+        key = os.path.basename(self.path(link,''))
+        if os.path.isdir(self.cacheDir):
+            for fn in os.listdir(self.cacheDir):
+                if fn.startswith(key) and fn.endswith('.pkl'):
+                    os.remove(os.path.join(self.cacheDir,fn))
+        self.write(self.path(link,'.html'),html)
+        meta = {'link':link,'fetched':pd.Timestamp.now().isoformat(timespec='seconds')}
+        if headers.get('ETag') is not None:
+            meta['etag'] = headers.get('ETag')
+        if headers.get('Last-Modified') is not None:
+            meta['last_modified'] = headers.get('Last-Modified')
+        self.write(self.path(link,'.json'),json.dumps(meta,indent=1))
+        return(html)
+
+    def fetch(self,links):
+        # Fetch each distinct link once, concurrently
+        links = [link for link in dict.fromkeys(links) if link not in self.documents]
+        if len(links) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=min(self.threads,len(links))) as pool:
+            for link,html in zip(links,pool.map(self.fetchOne,links)):
+                self.documents[link] = html
+
+    @prof.timed('parseSheet')
+    def tables(self,link,header=None):
+        # All the tables of a document, parsed once per header setting
+        key = (link,json.dumps(header))
+        if key in self.parsed:
+            return(self.parsed[key])
+        if link not in self.documents:
+            self.fetch([link])
+        fn = self.path(link,'_'+hashlib.sha1(key[1].encode()).hexdigest()[:8]+'.pkl')
+        if link not in self.changed and os.path.isfile(fn):
+            prof.count('sheets_cached')
+            self.parsed[key] = pd.read_pickle(fn)
+        else:
+            self.parsed[key] = pd.read_html(io.StringIO(self.documents[link]),header=header)
+            self.write(fn,self.parsed[key])
+        return(self.parsed[key])
@@ -0,0 +1,34 @@
+# Shared fixtures for the tests, run from the Python folder with: python -m pytest tests
+import os
+import sys
+import pytest
+import numpy as np
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import timeGrid as tg
+import readConfig as rCfg
+import validateTimestamps as vT
+
+@pytest.fixture(autouse=True)
+def records(tmp_path,monkeypatch):
+    # Keep the records of checked clean_tv files out of config_files/, each test starts like a fresh process
+    monkeypatch.setattr(vT,'recordDir',str(tmp_path/'manifests'))
+    monkeypatch.setattr(vT,'checked',{})
+
+@pytest.fixture
+def config():
+    return(rCfg.set_user_configuration())
+
+@pytest.fixture
+def database(tmp_path,config):
+    # A small database: site XX, Second stage, 2023, with a clean_tv and two traces
+    tsInfo = config['dbase_metadata']['timestamp']
+    folder = tmp_path/'Database'/'2023'/'XX'/config['stage']['Second']
+    folder.mkdir(parents=True)
+    np.asarray(tg.yearDatenums(2023,tsInfo['resolution'],tsInfo['base'],tsInfo['base_unit']),dtype=tsInfo['dtype']).tofile(folder/tsInfo['name'])
+    rng = np.random.default_rng(0)
+    nRows = tg.yearBounds(2023,tsInfo['resolution'])[2]
+    for name in ['TA_1_1_1','RH_1_1_1']:
+        rng.normal(size=nRows).astype(config['dbase_metadata']['traces']['dtype']).tofile(folder/name)
+    return(str(tmp_path/'Database'))
@@ -0,0 +1,49 @@
+# The vectorized conversions must give the same times as the previous element-wise pytz calls, in particular around DST transitions
+import pytz
+import pytest
+import numpy as np
+import pandas as pd
+import TzFuncs
+
+def reference(Input_Time,zone,DST,from_UTC):
+    # The previous (element-wise pytz) conversion, returns Standard_Time and UTC_Time
+    Time_Zone = pytz.timezone(zone)
+    Input_Time = pd.DatetimeIndex(Input_Time).to_series()
+    if from_UTC == True:
+        UTC_Time = Input_Time.apply(lambda x: pytz.utc.localize(x,is_dst=DST))
+        Local_Time = UTC_Time.apply(lambda x: x.astimezone(Time_Zone).replace(tzinfo=None))
+    else:
+        Local_Time = Input_Time
+    offset = Local_Time.apply(lambda x: Time_Zone.dst(x,is_dst=DST))
+    if DST == True:
+        Standard_Time = pd.DatetimeIndex(Local_Time-offset)
+        Local_Time = Local_Time.apply(lambda x: Time_Zone.localize(x,is_dst=DST))
+    else:
+        Standard_Time = pd.DatetimeIndex(Local_Time)
+        Local_Time = (Local_Time+offset).apply(lambda x: Time_Zone.localize(x,is_dst=DST))
+    if from_UTC == True:
+        return(Standard_Time,pd.DatetimeIndex(UTC_Time))
+    UTC_Time = pd.DatetimeIndex(Local_Time.apply(lambda x: x.astimezone(pytz.utc)))
+    return(Standard_Time,UTC_Time)
+
+def edges(zone,start='2008-01-01',end='2026-01-01',n=8):
+    # Local times every 15 minutes from 3 hours before to 3 hours after the first n transitions (in utc offset) of a timezone
+    utc = pd.date_range(start,end,freq='h',tz='UTC').tz_convert(zone)
+    offset = utc.tz_localize(None).asi8-utc.asi8
+    transitions = utc[1:][np.diff(offset) != 0].tz_localize(None)[:n]
+    times = [pd.date_range('2023-06-01','2023-06-02',freq='6h')]
+    times += [pd.date_range(t-pd.Timedelta('3h'),t+pd.Timedelta('3h'),freq='15min') for t in transitions]
+    return(pd.DatetimeIndex(np.unique(np.concatenate([t.values for t in times]))))
+
+zones = ['America/Vancouver','America/New_York','America/Regina','Europe/London','Australia/Sydney','Australia/Lord_Howe','Pacific/Chatham','Pacific/Apia','Asia/Kolkata']
+
+@pytest.mark.parametrize('zone',zones)
+@pytest.mark.parametrize('DST',[True,False])
+@pytest.mark.parametrize('from_UTC',[False,True])
+def test_matches_reference(zone,DST,from_UTC):
+    times = edges(zone)
+    tz = TzFuncs.Tzfuncs(Time_Zone=zone,DST=DST,from_UTC=from_UTC,to_UTC=True)
+    tz.convert(times)
+    Standard_Time,UTC_Time = reference(times,zone,DST,from_UTC)
+    np.testing.assert_array_equal(tz.Standard_Time.values,Standard_Time.values)
+    np.testing.assert_array_equal(tz.UTC_Time.tz_convert('UTC').asi8,UTC_Time.tz_convert('UTC').asi8)
@@ -0,0 +1,35 @@
+# csv exports from the binary database
+import os
+import pandas as pd
+import csvFromBinary as cfb
+
+task = '''T:
+  stage: Second
+  formatting:
+    units_in_header: False
+    na_value:
+    time_vectors:
+      TIMESTAMP:
+        output_name: TIMESTAMP
+        fmt: '%Y-%m-%d %H%M'
+        units: yyyy-mm-dd HHMM
+  traces:
+    TA_1_1_1:
+      units: degC
+      output_name: Ta
+'''
+
+def export(tmp_path,database,dateRange):
+    (tmp_path/'task.yml').write_text(task)
+    return(cfb.makeCSV(siteID='XX',dateRange=dateRange,database=database,outputPath=str(tmp_path/'out'),tasks=[str(tmp_path/'task.yml')])['T'])
+
+def test_rows(tmp_path,database):
+    df = pd.read_csv(export(tmp_path,database,['2023-06-01 00:00','2023-06-01 02:00']))
+    assert df['TIMESTAMP'].tolist() == ['2023-06-01 0000','2023-06-01 0030','2023-06-01 0100','2023-06-01 0130','2023-06-01 0200']
+
+def test_no_rows_in_range(tmp_path,database):
+    # No rows on the grid between 00:10 and 00:20, the file only has the header
+    dout = export(tmp_path,database,['2023-01-01 00:10','2023-01-01 00:20'])
+    assert os.path.isfile(dout)
+    with open(dout) as f:
+        assert f.read() == 'TIMESTAMP,Ta\n'
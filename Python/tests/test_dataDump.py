@@ -0,0 +1,34 @@
+# Incremental scans of dataDump.py: saved directory states must not hide files from scans with other filters
+import os
+import time
+import dataDump as dd
+
+def makeTree(tmp_path,files):
+    for f in files:
+        (tmp_path/'in'/'sub').mkdir(parents=True,exist_ok=True)
+        (tmp_path/'in'/'sub'/f).write_text('x')
+    # Old enough for the directory states to be saved
+    old = time.time()-100
+    for d in [tmp_path/'in'/'sub',tmp_path/'in']:
+        os.utime(d,(old,old))
+    return(str(tmp_path/'in'),str(tmp_path/'out'))
+
+def test_other_file_format(tmp_path):
+    dIn,dOut = makeTree(tmp_path,['A_2023-06-01T000000.ghg','A_2023_06_01_0030.dat'])
+    dd.copyFiles(dIn,dOut=dOut,fileFormat='ghg')
+    dd.copyFiles(dIn,dOut=dOut,fileFormat='dat')
+    assert sorted(os.listdir(dOut)) == ['A_2023-06-01T000000.ghg','A_2023_06_01_0030.dat','fileInventory.db']
+
+def test_other_search_tag(tmp_path):
+    dIn,dOut = makeTree(tmp_path,['A_2023_06_01_0030.dat','B_2023_06_01_0030.dat'])
+    dd.copyFiles(dIn,dOut=dOut,fileFormat='dat',searchTag=['A_'])
+    dd.copyFiles(dIn,dOut=dOut,fileFormat='dat')
+    assert 'B_2023_06_01_0030.dat' in os.listdir(dOut)
+
+def test_unparsed_are_listed_again(tmp_path,capsys):
+    dIn,dOut = makeTree(tmp_path,['A_2023_06_01_0030.dat','B_2023_06_0x_0100.dat'])
+    dd.copyFiles(dIn,dOut=dOut,fileFormat='dat')
+    capsys.readouterr()
+    dd.copyFiles(dIn,dOut=dOut,fileFormat='dat')
+    # Only the folder with the file that couldn't be parsed is listed
+    assert '1 have changed' in capsys.readouterr().out
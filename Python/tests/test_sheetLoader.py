@@ -0,0 +1,83 @@
+# sheetLoader against a local http server standing in for a published google sheet
+import hashlib
+import threading
+import urllib.error
+import pytest
+import pandas as pd
+import sheetLoader as sL
+from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+
+pytest.importorskip('lxml')
+
+def table(values):
+    rows = ['<tr><td></td><td>A</td><td>B</td></tr>','<tr><td>1</td><td>Year</td><td>WT</td></tr>']
+    rows += [f'<tr><td>{i+2}</td><td>2023</td><td>{v}</td></tr>' for i,v in enumerate(values)]
+    return('<table>'+''.join(rows)+'</table>')
+
+@pytest.fixture
+def server():
+    # Serves document['html'] with an ETag, answers If-None-Match with 304, counts the responses
+    document = {'html':'<html><body>'+table([1.5,2.5])+table([3.5])+'</body></html>','codes':[]}
+    class handler(BaseHTTPRequestHandler):
+        def log_message(self,*args):
+            pass
+        def do_GET(self):
+            body = document['html'].encode()
+            etag = '"'+hashlib.md5(body).hexdigest()+'"'
+            if self.headers.get('If-None-Match') == etag:
+                document['codes'].append(304)
+                self.send_response(304)
+                self.end_headers()
+                return
+            document['codes'].append(200)
+            self.send_response(200)
+            self.send_header('ETag',etag)
+            self.send_header('Content-Type','text/html; charset=utf-8')
+            self.send_header('Content-Length',str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    httpd = ThreadingHTTPServer(('127.0.0.1',0),handler)
+    threading.Thread(target=httpd.serve_forever,daemon=True).start()
+    document['link'] = f'http://127.0.0.1:{httpd.server_address[1]}/pubhtml'
+    document['httpd'] = httpd
+    yield document
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_no_cache_folder_until_written(tmp_path):
+    sL.sheetLoader(cacheDir=str(tmp_path/'cache'))
+    assert not (tmp_path/'cache').exists()
+
+def test_fetch_once_then_not_modified(server,tmp_path,monkeypatch):
+    cache = str(tmp_path/'cache')
+    sheets = sL.sheetLoader(cacheDir=cache)
+    sheets.fetch([server['link'],server['link']])
+    tables = sheets.tables(server['link'],header=[1])
+    assert server['codes'] == [200]
+    assert len(tables) == 2
+    assert tables[0]['WT'].tolist() == [1.5,2.5]
+    # A later run gets a 304 and loads the parsed tables from the cache, without parsing
+    monkeypatch.setattr(pd,'read_html',lambda *args,**kwargs: pytest.fail('parsed again'))
+    sheets = sL.sheetLoader(cacheDir=cache)
+    sheets.fetch([server['link']])
+    assert server['codes'] == [200,304]
+    assert sheets.tables(server['link'],header=[1])[1]['WT'].tolist() == [3.5]
+
+def test_changed_sheet_is_parsed_again(server,tmp_path):
+    cache = str(tmp_path/'cache')
+    sL.sheetLoader(cacheDir=cache).tables(server['link'],header=[1])
+    server['html'] = '<html><body>'+table([9.5])+'</body></html>'
+    tables = sL.sheetLoader(cacheDir=cache).tables(server['link'],header=[1])
+    assert server['codes'] == [200,200]
+    assert len(tables) == 1 and tables[0]['WT'].tolist() == [9.5]
+
+def test_fallback_to_cached_copy(server,tmp_path):
+    cache = str(tmp_path/'cache')
+    sL.sheetLoader(cacheDir=cache).tables(server['link'],header=[1])
+    server['httpd'].shutdown()
+    server['httpd'].server_close()
+    tables = sL.sheetLoader(cacheDir=cache,timeout=5).tables(server['link'],header=[1])
+    assert tables[0]['WT'].tolist() == [1.5,2.5]
+    # Without a cached copy the error is raised
+    with pytest.raises(urllib.error.URLError):
+        sL.sheetLoader(cacheDir=str(tmp_path/'empty'),timeout=5).fetch([server['link']])
@@ -0,0 +1,33 @@
+# Ingesting text files into the binary database
+import numpy as np
+import textFileToBinary as tfb
+
+task = '''XX_csv:
+  site:
+    ID: XX
+  stage: Met
+  fileList:
+  - {file}
+  formatting:
+    header: 0
+    timestamp:
+      date_cols:
+      - year
+      - month
+      - day
+      - hour
+      - minute
+'''
+
+def test_timestamp_columns(tmp_path,config):
+    # A task with date columns (no subtables or autoDate)
+    file = tmp_path/'in.csv'
+    file.write_text('year,month,day,hour,minute,TA\n2023,6,1,0,30,1.5\n2023,6,1,1,0,2.5\n')
+    (tmp_path/'task.yml').write_text(task.format(file=file))
+    tfb.writeBinaryTraces(tasks=[str(tmp_path/'task.yml')],processes=1,rootDir={'Database':str(tmp_path/'Database')})
+    folder = tmp_path/'Database'/'2023'/'XX'/config['stage']['Met']
+    TA = np.fromfile(folder/'TA',dtype=config['dbase_metadata']['traces']['dtype'])
+    # Rows are labelled by the end of each half hour, the first row of a year is 00:30 on Jan 1
+    i = (31+28+31+30+31)*48
+    assert TA[i] == 1.5 and TA[i+1] == 2.5
+    assert np.isnan(TA[i-1]) and np.isnan(TA[i+2])
@@ -0,0 +1,78 @@
+import os
+import json
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import asyncio
+import pytest
+import numpy as np
+import traceServer as ts
+
+async def cancelAll():
+    tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks,return_exceptions=True)
+
+@pytest.fixture
+def server(database):
+    s = ts.traceServer(database=database,port=0,threads=2)
+    ready = threading.Event()
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever,daemon=True)
+    thread.start()
+    asyncio.run_coroutine_threadsafe(s.serve(ready),loop)
+    ready.wait(10)
+    yield s
+    asyncio.run_coroutine_threadsafe(cancelAll(),loop).result(10)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(10)
+    s.pool.shutdown()
+
+def get(server,path,**params):
+    url = f'http://{server.host}:{server.port}{path}?{urllib.parse.urlencode(params)}'
+    try:
+        with urllib.request.urlopen(url,timeout=10) as r:
+            return(r.status,dict(r.headers),r.read())
+    except urllib.error.HTTPError as e:
+        return(e.code,dict(e.headers),e.read())
+
+def query(**params):
+    return({'siteID':'XX','stage':'Second','traces':'TA_1_1_1','start':'2023-06-01 00:30','end':'2023-06-01 02:00'}|params)
+
+def test_traces(server,database):
+    code,headers,body = get(server,'/traces',**query())
+    assert code == 200
+    assert headers['X-Rows'] == '4'
+    ta = np.frombuffer(body,dtype='<f4',offset=4*8)
+    expected = np.fromfile(os.path.join(database,'2023','XX','Clean','SecondStage','TA_1_1_1'),dtype='float32')
+    np.testing.assert_array_equal(ta,expected[7248:7252])
+
+@pytest.mark.parametrize('params',[
+    {'traces':'../../../../secret'},
+    {'traces':'TA_1_1_1,../secret'},
+    {'traces':'/etc/passwd'},
+    {'traces':'..\\secret'},
+    {'siteID':'../XX'},
+    {'siteID':'XX/..'},
+    {'stage':'../../..'},
+    ])
+def test_rejects_paths(server,database,params):
+    # A file of the right size outside of the database can't be read
+    np.zeros(17520,dtype='float32').tofile(os.path.join(os.path.dirname(database),'secret'))
+    code,headers,body = get(server,'/traces',**query(**params))
+    assert code == 400
+    assert 'Invalid' in json.loads(body)['error']
+
+def test_rejects_links(server,database):
+    # Links within the database can't point outside of it
+    secret = os.path.join(os.path.dirname(database),'secret')
+    np.zeros(17520,dtype='float32').tofile(secret)
+    os.symlink(secret,os.path.join(database,'2023','XX','Clean','SecondStage','LINK'))
+    code,headers,body = get(server,'/traces',**query(traces='LINK'))
+    assert code == 400
+
+def test_catalog_rejects_paths(server):
+    code,headers,body = get(server,'/catalog',siteID='../..',stage='Second',years='2023')
+    assert code == 400
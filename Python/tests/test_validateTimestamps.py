@@ -0,0 +1,33 @@
+# clean_tv checks of validateTimestamps.py, and the record that lets later runs skip them
+import os
+import pytest
+import numpy as np
+import validateTimestamps as vT
+
+def noReads(monkeypatch):
+    monkeypatch.setattr(np,'fromfile',lambda *args,**kwargs: pytest.fail('clean_tv was read'))
+
+def test_record_skips_later_runs(database,config,monkeypatch):
+    stage = config['stage']['Second']
+    assert vT.validate('XX',stage,2023,database,config) == 0
+    assert os.path.isfile(vT.recordPath(os.path.abspath(database)))
+    # A later run (with the catalog off) doesn't read the file
+    monkeypatch.setattr(vT,'checked',{})
+    with monkeypatch.context() as m:
+        noReads(m)
+        assert vT.validate('XX',stage,2023,database,config) == 0
+
+def test_modified_file_is_checked_again(database,config,monkeypatch):
+    stage = config['stage']['Second']
+    vT.validate('XX',stage,2023,database,config)
+    path = os.path.join(database,'2023','XX',stage,config['dbase_metadata']['timestamp']['name'])
+    tv = np.fromfile(path,dtype=config['dbase_metadata']['timestamp']['dtype'])
+    tv[10] += 1
+    tv.tofile(path)
+    monkeypatch.setattr(vT,'checked',{})
+    with pytest.raises(ValueError):
+        vT.validate('XX',stage,2023,database,config)
+    assert vT.validate('XX',stage,2023,database,config,policy='regenerate') == 1
+    monkeypatch.setattr(vT,'checked',{})
+    noReads(monkeypatch)
+    assert vT.validate('XX',stage,2023,database,config) == 0
@@ -1,18 +1,142 @@
 import os
 import re
+import json
+import hashlib
 import TzFuncs
+import timeGrid as tg
 import argparse
-import datetime
+import numpy as np
 import pandas as pd
+import binaryFromText as bft
+import sheetLoader as sL
+import traceAggregates as tA
 from glob import glob
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 import readConfig as rCfg
+from profiler import shared as prof
 
 template = ['config_files/gsheet_to_binary.yml','config_files/dat_to_binary.yml']
-os.chdir(os.path.split(__file__)[0])
+
+def fileHash(file,chunkSize=2**20):
+    # sha256 of a file, read in chunks
+    h = hashlib.sha256()
+    with open(file,'rb') as f:
+        for chunk in iter(lambda: f.read(chunkSize),b''):
+            h.update(chunk)
+    return(h.hexdigest())
+
+def readOptions(task):
+    # read_csv options derived from the task definition
+    options = {'header':task['formatting']['header']}
+    if 'subtables' in task:
+        # Mixed array files: the array ID and date columns come first, the remaining columns are read as floats
+        nCols = max(len(subtable['columns']) for subtable in task['subtables'].values())
+        nKeys = 1+len(task['formatting']['timestamp']['date_cols'])
+        options['dtype'] = {i:'float32' for i in range(nKeys,nCols)}
+    elif type(options['header']) == int and 'exclude' in task:
+        # Skip excluded columns (not supported by pandas for multi-row headers)
+        options['usecols'] = lambda c: c not in task['exclude']
+    return(options)
+
+@prof.timed('parseFile')
+def parseAsciiFile(file,task,resolution):
+    # Read one file into a dataframe indexed by timestamp
+    # Module level (rather than a method) so it can be run in a process pool
+    prof.count('files_parsed')
+    options = readOptions(task)
+    if 'autoDate' in task['formatting']:
+        df = pd.read_csv(file,**options)
+        df.columns = df.columns.get_level_values(0)
+        df['datetime'] = pd.to_datetime(df[task['formatting']['autoDate']])
+        df.set_index('datetime',inplace=True)
+        df = df.drop(columns=[task['formatting']['autoDate']])
+    elif 'subtables' in task:
+        df = readMixedArray(file,task,resolution)
+    else:
+        df = parseTimeStamp(pd.read_csv(file,**options),task['formatting']['timestamp'],resolution)
+    prof.count('rows_parsed',df.shape[0])
+    return(df)
+
+def parseWorker(file,task,resolution,profile=False):
+    # Parse a file in a worker process, the profile of the worker is returned to be merged by the main process
+    # (merged spans are summed over all workers, so they can add up to more than the wall time)
+    if profile == True:
+        prof.enable()
+    return(parseAsciiFile(file,task,resolution),prof.summary() if profile == True else None)
+
+def readMixedArray(file,task,resolution,chunksize=100000):
+    # Split a mixed array (e.g., CR10X) file into its subtables
+    # The file is read in chunks and the rows of each chunk are split by array ID (first column) in one grouped pass
+    TimeStamp = task['formatting']['timestamp']
+    subtables = {subtable['ID']:subtable for subtable in task['subtables'].values()}
+    rows = {ID:[] for ID in subtables.keys()}
+    for chunk in pd.read_csv(file,chunksize=chunksize,**readOptions(task)):
+        for ID,group in chunk.groupby(0,sort=False):
+            if ID in rows:
+                rows[ID].append(group)
+    sub_dfs = []
+    for ID,subtable in subtables.items():
+        if len(rows[ID]) == 0:
+            continue
+        sub_df = pd.concat(rows[ID])
+        rn = {i:name for i,name in enumerate(subtable['columns'])}
+        sub_df = sub_df.rename(columns=rn)
+        # drop any dangling/unwanted columns named with an integer
+        drop = [i for i in sub_df.columns if type(i) == int]
+        sub_df = sub_df.drop(columns = drop)
+        sub_df = parseTimeStamp(sub_df,TimeStamp,resolution)
+        sub_dfs.append(sub_df)
+    if len(sub_dfs) == 0:
+        return(pd.DataFrame())
+    return(pd.concat(sub_dfs))
+
+def decodeDayOfYear(Data,date_cols):
+    # Decode year, day of year and (optionally) HHMM columns arithmetically
+    # HHMM = 2400 rolls over to 00:00 of the next day
+    Y = Data[date_cols[0]].to_numpy(dtype='int64')
+    ns = (Y-1970).astype('datetime64[Y]').astype('datetime64[ns]').view('int64')
+    ns = ns+(Data[date_cols[1]].to_numpy(dtype='int64')-1)*tg.NS_PER_DAY
+    if len(date_cols) > 2:
+        HHMM = Data[date_cols[2]].to_numpy(dtype='int64')
+        ns = ns+(HHMM//100*60+HHMM%100)*60*10**9
+    return(pd.DatetimeIndex(ns.view('datetime64[ns]')))
+
+@prof.timed('parseTimeStamp')
+def parseTimeStamp(Data,TimeStamp,resolution,lat_lon=None):
+    if 'format' not in TimeStamp:
+        Data['datetime'] = pd.to_datetime(Data[TimeStamp['date_cols']]).dt.round(resolution)
+    elif 'zFillDates' in TimeStamp and TimeStamp['format'] in ['%Y%j%H%M','%Y%j'] and Data[TimeStamp['date_cols']].notna().all().all():
+        Data['datetime'] = decodeDayOfYear(Data,TimeStamp['date_cols']).round(resolution)
+    else:
+        Data['datetime'] = ''
+        for i,col in enumerate(TimeStamp['date_cols']):
+            if 'zFillDates' in TimeStamp:
+                if i > 1:
+                    Data.loc[Data[col]==2400,col] = 2359
+                Data['datetime'] = Data['datetime'].str.cat(Data[col].astype(str).str.zfill(len(col)),sep='')
+        Data['datetime'] = pd.to_datetime(Data['datetime'],format=TimeStamp['format']).dt.round(resolution)
+    Data = Data.drop(columns=TimeStamp['date_cols'])
+    Data.set_index('datetime',inplace=True)
+    if 'is_dst' in TimeStamp and TimeStamp['is_dst'] == True:
+        tzf = TzFuncs.Tzfuncs(lat_lon=lat_lon,DST=True)
+        tzf.convert(Data.index)
+        Data = Data.set_index(tzf.Standard_Time)
+    return(Data)
 
 class writeBinaryTraces():
-    def __init__(self,tasks=template):
-        self.config = rCfg.set_user_configuration(tasks)
+    def __init__(self,tasks=template,processes=None,rootDir={},profile=None):
+        # processes: number of worker processes used to parse files (None uses all cores)
+        # rootDir: paths to use in place of those in user_path_definitions.yml, e.g., {'Database':'C:/Database/'}
+        # profile: path of a JSON file to save a summary of where the time was spent (see profiler.py)
+        if profile is not None:
+            prof.enable()
+        self.processes = processes
+        self.config = rCfg.set_user_configuration({'tasks':tasks})
+        self.config['rootDir'].update(rootDir)
+        # Each google sheet is fetched once, concurrently, before the tasks are run (see sheetLoader.py)
+        self.sheets = sL.sheetLoader()
+        self.sheets.fetch([task['link'] for name,task in self.config['tasks'].items() if name.endswith('gsheet')])
         for name,task in self.config['tasks'].items():
             if 'prefix' in task['site']: self.prefix = task['site']['prefix']
             else: self.prefix=''
@@ -23,54 +147,101 @@ class writeBinaryTraces():
             if name.endswith('gsheet'):
                 self.readGoogleSheet(task)
             else:
-                self.readGenericAscii(task)
+                self.readGenericAscii(task,name)
+        if profile is not None:
+            prof.save(profile,{'script':'textFileToBinary','tasks':tasks})
+            prof.disable()
     
-    def readGenericAscii(self,task):
+    def readGenericAscii(self,task,name=None):
         if 'recursiveSearch' in task:
             if 'fileNameMatch' in task['recursiveSearch']:
                 fileNameMatch = '*'+task['recursiveSearch']['fileNameMatch']+'*'+task['recursiveSearch']['fileExtension']
             else:
                 fileNameMatch = '*'+task['recursiveSearch']['fileExtension']
             search_path = os.path.abspath(os.path.join(self.config['rootDir'][task['recursiveSearch']['rootDir']],task['recursiveSearch']['subDir'],'**',fileNameMatch))
-            fileList = glob(search_path, recursive=True)
+            with prof.span('findFiles'):
+                fileList = glob(search_path, recursive=True)
         else:
             fileList = task['fileList']
+
+        # Optionally, only parse files that are new or have changed since the last run
+        if 'manifest' in task and name is not None:
+            manifest = self.readManifest(name)
+            fileList,updates = self.checkManifest(fileList,manifest,task['manifest'])
+            if len(fileList) == 0:
+                print(f'No new or modified files for {name}')
+                self.writeManifest(name,manifest|updates)
+                return
         
-        Data = pd.DataFrame()
         if task['formatting']['header'] == 'None':task['formatting']['header']=None
+        resolution = self.config['dbase_metadata']['timestamp']['resolution']
+        # Parse the files concurrently, then combine them once
+        if self.processes != 1 and len(fileList) > 1:
+            with ProcessPoolExecutor(max_workers=self.processes) as pool:
+                results = list(pool.map(parseWorker,fileList,repeat(task),repeat(resolution),repeat(prof.enabled),chunksize=max(1,len(fileList)//(4*(self.processes or os.cpu_count())))))
+            frames = [df for df,_ in results]
+            for _,summary in results:
+                prof.merge(summary)
+        else:
+            frames = [parseAsciiFile(file,task,resolution) for file in fileList]
+        # Files are stacked in reverse order, so where files overlap the first file in the list takes precedence
+        with prof.span('combine'):
+            Data = pd.concat(frames[::-1]) if len(frames) > 0 else pd.DataFrame()
+            if 'exclude' in task:
+                Data = Data.drop(columns=task['exclude'],errors='ignore')
+            Data = Data.resample(self.config['dbase_metadata']['timestamp']['resolution']).last()
+        if 'manifest' in task and name is not None:
+            # Merge into the existing traces, only the years covered by the new files are re-written
+            self.writeByYear(Data,mode='repfill')
+            self.writeManifest(name,manifest|updates)
+        else:
+            self.writeByYear(Data)
+
+    def manifestPath(self,name):
+        # One manifest per task and Database, so running a task against another Database (e.g., a test database) starts a new record
+        database = hashlib.sha256(os.path.abspath(self.config['rootDir']['Database']).encode()).hexdigest()[:12]
+        return(os.path.join(os.path.dirname(os.path.abspath(__file__)),'config_files','manifests',f'{name}_{database}.json'))
+
+    def readManifest(self,name):
+        # Record of the files ingested by a task: {path: {size, mtime, hash}}
+        if os.path.isfile(self.manifestPath(name)):
+            with open(self.manifestPath(name)) as f:
+                return(json.load(f))
+        return({})
+
+    def writeManifest(self,name,manifest):
+        fn = self.manifestPath(name)
+        os.makedirs(os.path.dirname(fn),exist_ok=True)
+        with open(fn+'.tmp','w') as f:
+            json.dump(manifest,f,indent=1)
+        os.replace(fn+'.tmp',fn)
+
+    def checkManifest(self,fileList,manifest,settings):
+        # Return the files that are new or modified, and their updated manifest entries
+        # A file is modified if its size or mtime differ, and if hash: True, its content hash also differs
+        if settings is None: settings = {}
+        changed,updates = [],{}
         for file in fileList:
-            if 'autoDate' in task['formatting']:
-                df = pd.read_csv(file,header=task['formatting']['header'])
-                df.columns = df.columns.get_level_values(0)
-                df['datetime'] = pd.to_datetime(df[task['formatting']['autoDate']])
-                df.set_index('datetime',inplace=True)
-                df = df.drop(columns=[task['formatting']['autoDate']])
-            else:
-                TimeStamp = task['formatting']['timestamp']
-                df = pd.read_csv(file,header=task['formatting']['header'])
-                if 'subtables' in task:
-                    full_df = pd.DataFrame()
-                    for subtable in task['subtables'].values():
-                        sub_df = df.loc[df[0] == subtable['ID']]
-                        rn = {i:name for i,name in enumerate(subtable['columns'])}
-                        sub_df = sub_df.rename(columns=rn)
-                        # drop any dangling/unwanted columns named with an integer
-                        drop = [i for i in sub_df.columns if type(i) == int]
-                        sub_df = sub_df.drop(columns = drop)
-                        sub_df = self.parseTimeStamp(sub_df,TimeStamp)
-                        full_df = pd.concat([full_df,sub_df])
-                df = full_df
-            Data = pd.concat([df,Data])
-        if 'exclude' in task:
-            Data = Data.drop(columns=task['exclude'])
-        Data = Data.resample(self.config['dbase_metadata']['timestamp']['resolution']).last()
-        self.writeByYear(Data)
+            file = os.path.abspath(file)
+            stat = os.stat(file)
+            entry = {'size':stat.st_size,'mtime':stat.st_mtime}
+            old = manifest.get(file)
+            if old is not None and old['size'] == entry['size'] and old['mtime'] == entry['mtime']:
+                continue
+            if settings.get('hash') == True:
+                entry['hash'] = fileHash(file)
+                if old is not None and old.get('hash') == entry['hash']:
+                    updates[file] = entry
+                    continue
+            changed.append(file)
+            updates[file] = entry
+        return(changed,updates)
         
 
     def readGoogleSheet(self,task):
         TimeStamp = task['formatting']['timestamp']
         # Read the sheet
-        Data = pd.read_html(task['link'],header=task['formatting']['header'])[task['subtable_id']]
+        Data = self.sheets.tables(task['link'],header=task['formatting']['header'])[task['subtable_id']].copy()
         Data = self.parseTimeStamp(Data,TimeStamp,task['site']['lat_lon'])
         # Google sheets don't handle dates well, so best practice is to have separate columns for year,month,day, etc.
         Data = Data.drop(columns=['1'])
@@ -80,51 +251,43 @@ class writeBinaryTraces():
         self.writeByYear(Data)
 
     def parseTimeStamp(self,Data,TimeStamp,lat_lon=None):
-        if 'format' not in TimeStamp:
-            Data['datetime'] = pd.to_datetime(Data[TimeStamp['date_cols']]).dt.round(self.config['dbase_metadata']['timestamp']['resolution'])
-        else:
-            Data['datetime'] = ''
-            for i,col in enumerate(TimeStamp['date_cols']):
-                if 'zFillDates' in TimeStamp:
-                    if i > 1:
-                        Data.loc[Data[col]==2400,col] = 2359
-                    Data['datetime'] = Data['datetime'].str.cat(Data[col].astype(str).str.zfill(len(col)),sep='')
-            Data['datetime'] = pd.to_datetime(Data['datetime'],format=TimeStamp['format']).dt.round(self.config['dbase_metadata']['timestamp']['resolution'])
-        Data = Data.drop(columns=TimeStamp['date_cols'])
-        Data.set_index('datetime',inplace=True)
-        if 'is_dst' in TimeStamp and TimeStamp['is_dst'] == True:
-            tzf = TzFuncs.Tzfuncs(lat_lon=lat_lon,DST=True)
-            tzf.convert(Data.index)
-            Data = Data.set_index(tzf.Standard_Time)
-        return(Data)
-
-    def writeByYear(self,Data):
+        return(parseTimeStamp(Data,TimeStamp,self.config['dbase_metadata']['timestamp']['resolution'],lat_lon))
+
+    @prof.timed('writeByYear')
+    def writeByYear(self,Data,mode='overwrite'):
         # write binary files by year following the Biomet format with a matlab datenum index
+        # mode='repfill' merges Data into existing traces instead of overwriting them (see binaryFromText.mergeTrace)
+        tsInfo = self.config['dbase_metadata']['timestamp']
         for y in Data.index.year.unique():
             dout = os.path.abspath(os.path.join(self.config['rootDir']['Database'],str(y),self.siteID,self.stage))
             os.makedirs(dout,exist_ok=True)
-            Year = pd.DataFrame(data={'datetime':pd.date_range(start = f'{y}01010030',end=f'{y+1}01010001',freq='30T')})
-            Year.set_index('datetime',inplace=True)
-            Year = Year.join(Data)
-            timeVector = self.config['dbase_metadata']['timestamp']['name']
-            Year[timeVector] = self.toMatlabTimeVector(Year.index)
+            Year = tg.padYear(Data,y,tsInfo['resolution'])
+            timeVector = tsInfo['name']
+            Year[timeVector] = tg.yearDatenums(y,tsInfo['resolution'],tsInfo['base'],tsInfo['base_unit'])
             for traceName in Year.columns:
                 if traceName == timeVector:
-                    dtype = self.config['dbase_metadata']['timestamp']['dtype']
+                    dtype = tsInfo['dtype']
                 else:
                     dtype = self.config['dbase_metadata']['traces']['dtype']
                 Trace = Year[traceName].astype(dtype).values
                 traceName = self.prefix+re.sub(r'\W+', '_', traceName)+self.suffix
-                with open(f'{dout}/{traceName}','wb') as out:
-                    print(f'Writing: {dout}/{traceName}')
-                    Trace.tofile(out)
+                print(f'Writing: {dout}/{traceName}')
+                if mode != 'overwrite' and os.path.isfile(f'{dout}/{traceName}') and os.path.getsize(f'{dout}/{traceName}') == Trace.nbytes:
+                    Trace = bft.mergeTrace(np.fromfile(f'{dout}/{traceName}',dtype),Trace,mode)
+                    bft.atomicWrite(Trace,f'{dout}/{traceName}')
+                else:
+                    with open(f'{dout}/{traceName}','wb') as out:
+                        Trace.tofile(out)
+                # Daily & monthly aggregates (see traceAggregates.py)
+                if tA.enabled(self.config):
+                    tA.update(f'{dout}/{traceName}',y,self.config['dbase_metadata'],values=Trace)
+                prof.count('traces_written')
+                prof.count('bytes_written',Trace.nbytes)
                 
     
     def toMatlabTimeVector(self,datetime_in):
-            unix_base = datetime.datetime(1970,1,1,0,0)
-            matlab_base = self.config['dbase_metadata']['timestamp']['base']
-            seconds = (datetime_in-datetime_in.floor('D')).seconds/(24*60*60)
-            return((datetime_in-unix_base).days+matlab_base+seconds)
+            tsInfo = self.config['dbase_metadata']['timestamp']
+            return(tg.toDatenum(datetime_in,tsInfo['base'],tsInfo['base_unit']))
 
 # If called from command line ...
 if __name__ == '__main__':
@@ -138,9 +301,25 @@ if __name__ == '__main__':
         default=template,
         )
       
+    CLI.add_argument(
+        "--processes", 
+        nargs='?',
+        type=int,
+        default=None,
+        )
+
+    # --profile without a file name saves to textFileToBinary_profile.json
+    CLI.add_argument(
+        "--profile", 
+        nargs='?',
+        type=str,
+        default=None,
+        const='textFileToBinary_profile.json',
+        )
+      
     # Parse the args and make the call
     args = CLI.parse_args()
 
     # Call 
-    writeBinaryTraces(args.tasks)
+    writeBinaryTraces(args.tasks,args.processes,profile=args.profile)
     
\ No newline at end of file
@@ -0,0 +1,87 @@
+# Shared time grid functions for the binary database
+# Intended to be called by other scripts, e.g., csvFromBinary.py, binaryFromText.py, textFileToBinary.py
+
+# Timestamps in the database are matlab datenums (days since 0000-01-00) marking the end of each interval
+# All conversions here are done with int64 nanoseconds, so they are exact and vectorized
+# The full-year grids (and their datenums) only depend on the year and the settings in config.yml dbase_metadata
+# so they are computed once and reused (returned arrays are read-only)
+# Basic call from other python scripts:
+    # import timeGrid as tg
+    # tsInfo = config['dbase_metadata']['timestamp']
+    # tv = tg.toDatenum(DatetimeIndex,tsInfo['base'],tsInfo['base_unit'])
+
+import numpy as np
+import pandas as pd
+from functools import lru_cache
+
+NS_PER_DAY = 86400*10**9
+
+def toNanoseconds(DT):
+    # int64 nanoseconds since 1970-01-01
+    return(np.asarray(DT,dtype='datetime64[ns]').view('int64'))
+
+@lru_cache(maxsize=None)
+def nsPer(unit):
+    # nanoseconds per unit/resolution, e.g., 'D' or '30min'
+    if isinstance(unit,str) and not any(c.isdigit() for c in unit):
+        unit = '1'+unit
+    return(pd.Timedelta(unit).value)
+
+def toDatenum(DT,base=719529,base_unit='D'):
+    # Encode datetimes as datenums
+    # Whole and fractional units are computed separately from integers, then summed
+    ns = toNanoseconds(DT)
+    unit = nsPer(base_unit)
+    return((ns//unit+base)+(ns%unit)/unit)
+
+def fromDatenum(tv,base=719529,base_unit='D'):
+    # Decode datenums to datetime64[ns], rounded to the nearest second
+    seconds = np.round((np.asarray(tv,dtype='float64')-base)*(nsPer(base_unit)/10**9))
+    return((seconds.astype('int64')*10**9).view('datetime64[ns]'))
+
+@lru_cache(maxsize=None)
+def yearBounds(year,resolution='30min'):
+    # Nanoseconds of YYYY-01-01 00:00, the resolution, and the number of rows in a year file
+    Y0 = toNanoseconds(np.datetime64(f'{year}-01-01'))[()]
+    Y1 = toNanoseconds(np.datetime64(f'{year+1}-01-01'))[()]
+    res = nsPer(resolution)
+    return(Y0,res,int((Y1-Y0)//res))
+
+@lru_cache(maxsize=64)
+def yearGrid(year,resolution='30min'):
+    # Timestamps of each row in a year file: YYYY-01-01 00:30 to YYYY+1-01-01 00:00 for 30min data
+    Y0,res,nRows = yearBounds(year,resolution)
+    ns = Y0+res*np.arange(1,nRows+1,dtype='int64')
+    ns.flags.writeable = False
+    return(pd.DatetimeIndex(ns.view('datetime64[ns]')))
+
+@lru_cache(maxsize=64)
+def yearDatenums(year,resolution='30min',base=719529,base_unit='D'):
+    # The clean_tv of a year file
+    tv = toDatenum(yearGrid(year,resolution),base,base_unit)
+    tv.flags.writeable = False
+    return(tv)
+
+def rowIndex(DT,year,resolution='30min'):
+    # Row of each timestamp within a year file
+    # Returns the (fractional) row, rows on the grid are whole numbers
+    Y0,res,nRows = yearBounds(year,resolution)
+    return((toNanoseconds(DT)-Y0)/res-1)
+
+def gridPositions(DT,year,resolution='30min'):
+    # Integer rows of the timestamps which fall exactly on the grid of a year file
+    # Returns the rows and a mask of the timestamps they correspond to
+    Y0,res,nRows = yearBounds(year,resolution)
+    offset = toNanoseconds(DT)-Y0
+    rows = offset//res-1
+    mask = (offset%res == 0)&(rows >= 0)&(rows < nRows)
+    return(rows[mask],mask)
+
+def padYear(df,year,resolution='30min'):
+    # Place the rows of df onto the full grid of a year file, with NaNs where there is no data
+    # Rows that fall outside the year or off the grid are dropped (if there are duplicates, the last is kept)
+    grid = yearGrid(year,resolution)
+    rows,mask = gridPositions(df.index,year,resolution)
+    values = np.full((grid.shape[0],df.shape[1]),np.nan)
+    values[rows] = df.to_numpy(dtype='float64')[mask]
+    return(pd.DataFrame(data=values,index=grid,columns=df.columns))
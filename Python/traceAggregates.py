@@ -0,0 +1,326 @@
+# Daily & monthly aggregates of the traces in the binary database
+# Intended to be called by other scripts, e.g., binaryFromText.py, textFileToBinary.py, csvFromBinary.py
+
+# Enabled by aggregates: enabled: True in config.yml
+# Each trace gets two sidecar files in Database/YYYY/SiteID/Stage/.aggregates/: trace.D (daily) and trace.M (monthly)
+#   * periods are calendar days/months of the timestamps (same bins as pandas resample D, ME, or MS), so the last row of a year file (YYYY+1-01-01 00:00) is its own period
+#   * each period holds sufficient statistics: valid count, sum, M2 (sum of squared deviations from the mean), min, max (float64)
+#     mean, std, min, max, sum, and count of any set of periods can be computed by merging them (Chan et al. parallel algorithm)
+#   * the header of each file holds the size & mtime of the trace the aggregates were computed from; if the trace has been changed since (e.g., by another program) the aggregates are not used
+# The sidecars are updated when traces are written by binaryFromText.writeTraces and textFileToBinary.writeBinaryTraces
+#   * when only a range of rows changed (and the sidecar was up to date), only the days covering those rows are computed again
+# makeCSV answers resample requests with freq D, ME/M, or MS and agg among mean, std, min, max, sum, count from the aggregates
+#   * only the periods cut by the start or end of the dateRange are computed from the half-hourly data
+#   * if the aggregates of any trace are missing or out of date, the request is resampled from the half-hourly data as usual
+# Build (or rebuild) the aggregates of existing traces from the command line:
+    # py traceAggregates.py --siteID BB BBS --stage Second --years 2023 2024
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import timeGrid as tg
+import readConfig as rCfg
+import readTraces as rTr
+from profiler import shared as prof
+
+folderName = '.aggregates'
+version = 1
+nHeader = 5
+aggregations = ['mean','std','min','max','sum','count']
+NS_PER_DAY = tg.NS_PER_DAY
+
+def enabled(config):
+    return(config.get('aggregates',{}).get('enabled',False) == True)
+
+def level(freq):
+    # The aggregate level that matches a resample frequency: D, M, or None
+    try:
+        offset = pd.tseries.frequencies.to_offset(freq)
+    except (ValueError,TypeError):
+        return(None)
+    if offset.n != 1:
+        return(None)
+    if isinstance(offset,pd.offsets.Day):
+        return('D')
+    if isinstance(offset,(pd.offsets.MonthEnd,pd.offsets.MonthBegin)):
+        return('M')
+    return(None)
+
+def periodStarts(first,last,lvl):
+    # Start (int64 ns) of each period from the period holding first to the period holding last (inclusive)
+    first,last = pd.Timestamp(first),pd.Timestamp(last)
+    if lvl == 'D':
+        return(pd.date_range(first.normalize(),last.normalize(),freq='D').asi8)
+    return(pd.date_range(first.normalize().replace(day=1),last.normalize().replace(day=1),freq='MS').asi8)
+
+def yearPeriods(YYYY,lvl,resolution):
+    # Start of each period of a year file and the period of each row
+    Y0,res,nRows = tg.yearBounds(YYYY,resolution)
+    starts = periodStarts(pd.Timestamp(Y0+res),pd.Timestamp(Y0+res*nRows),lvl)
+    rows = np.searchsorted(starts,Y0+res*np.arange(1,nRows+1,dtype='int64'),side='right')-1
+    return(starts,rows)
+
+def compute(values,groups,nGroups):
+    # Sufficient statistics (nGroups x 5) of values, grouped by the (sorted) group index of each value
+    valid = ~np.isnan(values)
+    x = np.where(valid,values,0.0).astype('float64')
+    stats = np.zeros((nGroups,5))
+    stats[:,0] = np.bincount(groups,weights=valid,minlength=nGroups)
+    stats[:,1] = np.bincount(groups,weights=x,minlength=nGroups)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        mean = stats[:,1]/stats[:,0]
+    deviation = np.where(valid,x-mean[groups],0.0)
+    stats[:,2] = np.bincount(groups,weights=deviation*deviation,minlength=nGroups)
+    stats[:,3:] = np.nan
+    starts = np.flatnonzero(np.diff(groups,prepend=-1))
+    if starts.size > 0:
+        values = values.astype('float64')
+        stats[groups[starts],3] = np.fmin.reduceat(values,starts)
+        stats[groups[starts],4] = np.fmax.reduceat(values,starts)
+    return(stats)
+
+def merge(a,b):
+    # Merge two sets of sufficient statistics (same shape, ... x 5)
+    na,nb = a[...,0],b[...,0]
+    n = na+nb
+    with np.errstate(invalid='ignore',divide='ignore'):
+        delta = b[...,1]/nb-a[...,1]/na
+        extra = np.where((na > 0)&(nb > 0),delta*delta*na*nb/n,0.0)
+    merged = np.empty(np.broadcast_shapes(a.shape,b.shape))
+    merged[...,0] = n
+    merged[...,1] = a[...,1]+b[...,1]
+    merged[...,2] = a[...,2]+b[...,2]+extra
+    merged[...,3] = np.fmin(a[...,3],b[...,3])
+    merged[...,4] = np.fmax(a[...,4],b[...,4])
+    return(merged)
+
+def combine(stats,groups,nGroups):
+    # Merge rows of sufficient statistics into groups (e.g., days into months), groups must be sorted
+    n = np.bincount(groups,weights=stats[:,0],minlength=nGroups)
+    total = np.bincount(groups,weights=stats[:,1],minlength=nGroups)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        mean = stats[:,1]/stats[:,0]
+        deviation = np.where(stats[:,0] > 0,mean-(total/n)[groups],0.0)
+    out = np.zeros((nGroups,5))
+    out[:,0] = n
+    out[:,1] = total
+    out[:,2] = np.bincount(groups,weights=stats[:,2]+stats[:,0]*deviation*deviation,minlength=nGroups)
+    out[:,3:] = np.nan
+    starts = np.flatnonzero(np.diff(groups,prepend=-1))
+    if starts.size > 0:
+        out[groups[starts],3] = np.fmin.reduceat(stats[:,3],starts)
+        out[groups[starts],4] = np.fmax.reduceat(stats[:,4],starts)
+    return(out)
+
+def toAggregates(stats,aggregation):
+    # mean, std, min, max, sum, and count from sufficient statistics (same conventions as pandas)
+    n = stats[...,0]
+    results = {}
+    with np.errstate(invalid='ignore',divide='ignore'):
+        for agg in aggregation:
+            if agg == 'mean':
+                results[agg] = stats[...,1]/n
+            elif agg == 'std':
+                results[agg] = np.where(n > 1,np.sqrt(stats[...,2]/(n-1)),np.nan)
+            elif agg == 'min':
+                results[agg] = stats[...,3]
+            elif agg == 'max':
+                results[agg] = stats[...,4]
+            elif agg == 'sum':
+                results[agg] = stats[...,1]
+            elif agg == 'count':
+                results[agg] = n.astype('int64')
+    return(results)
+
+def sidecarPath(tracePath,lvl):
+    folder,name = os.path.split(tracePath)
+    return(os.path.join(folder,folderName,f'{name}.{lvl}'))
+
+def stampOf(tracePath):
+    stat = os.stat(tracePath)
+    return(stat.st_size,stat.st_mtime_ns)
+
+def readSidecar(tracePath,lvl,stamp=None):
+    # The sufficient statistics of a trace, or None if missing or out of date
+    # stamp: (size,mtime_ns) the sidecar must match, defaults to the current stamp of the trace
+    path = sidecarPath(tracePath,lvl)
+    if not os.path.isfile(path):
+        return(None)
+    if stamp is None:
+        stamp = stampOf(tracePath)
+    with open(path,'rb') as f:
+        header = np.fromfile(f,dtype='int64',count=nHeader)
+        stats = np.fromfile(f,dtype='float64')
+    if header.size < nHeader or header[0] != version or (header[1],header[2]) != tuple(stamp) or stats.size != header[3]*5:
+        return(None)
+    return(stats.reshape(-1,5))
+
+def writeSidecar(tracePath,lvl,stats,stamp):
+    path = sidecarPath(tracePath,lvl)
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    header = np.array([version,stamp[0],stamp[1],stats.shape[0],0],dtype='int64')
+    with open(path+'.tmp','wb') as f:
+        header.tofile(f)
+        np.ascontiguousarray(stats,dtype='float64').tofile(f)
+    os.replace(path+'.tmp',path)
+
+def removeSidecars(tracePath):
+    for lvl in ['D','M']:
+        if os.path.isfile(sidecarPath(tracePath,lvl)):
+            os.remove(sidecarPath(tracePath,lvl))
+
+@prof.timed('updateAggregates')
+def update(tracePath,YYYY,dbase_metadata,values=None,rows=None,stamp=None):
+    # Update the aggregates of a trace after it has been written
+    # values: the full trace (if already in memory), otherwise the trace is read from disk
+    # rows: (i0,i1) range of rows that changed and stamp: (size,mtime_ns) of the trace before the change
+    #   if the sidecar matches stamp, only the days covering the rows are computed again, otherwise all are
+    tsInfo = dbase_metadata['timestamp']
+    if os.path.basename(tracePath) == tsInfo['name']:
+        return
+    dtype = np.dtype(dbase_metadata['traces']['dtype'])
+    resolution = tsInfo['resolution']
+    nRows = tg.yearBounds(YYYY,resolution)[2]
+    newStamp = stampOf(tracePath)
+    if newStamp[0] != nRows*dtype.itemsize:
+        # Not a valid trace for this year, don't keep aggregates for it
+        removeSidecars(tracePath)
+        return
+    starts,periods = yearPeriods(YYYY,'D',resolution)
+    daily = None
+    if rows is not None and stamp is not None:
+        daily = readSidecar(tracePath,'D',stamp)
+    if daily is not None and daily.shape[0] == starts.shape[0]:
+        i0,i1 = rows
+        if i1 <= i0:
+            return
+        # Rows of the days that changed
+        p0,p1 = periods[i0],periods[i1-1]
+        r0 = np.searchsorted(periods,p0,side='left')
+        r1 = np.searchsorted(periods,p1,side='right')
+        if values is None:
+            chunk = rTr.readSlice(tracePath,dtype,r0,r1-r0)
+        else:
+            chunk = values[r0:r1]
+        daily[p0:p1+1] = compute(chunk,periods[r0:r1]-p0,p1-p0+1)
+    else:
+        if values is None:
+            values = np.fromfile(tracePath,dtype=dtype)
+        daily = compute(values,periods,starts.shape[0])
+    # Months are merged from the days
+    monthStarts,_ = yearPeriods(YYYY,'M',resolution)
+    monthly = combine(daily,np.searchsorted(monthStarts,starts,side='right')-1,monthStarts.shape[0])
+    writeSidecar(tracePath,'D',daily,newStamp)
+    writeSidecar(tracePath,'M',monthly,newStamp)
+    prof.count('aggregates_updated')
+
+@prof.timed('resampleFromAggregates')
+def resampleFromAggregates(siteID,stage,traces,DT,freq,aggregation,database,config,catalog=None):
+    # Resample the traces over the rows DT (the timestamps within the dateRange) from the aggregates
+    # Returns the first timestamp of each period and a dataframe of (trace, agg) columns indexed by the period labels, same as resampleTraces.resampleTraces
+    # Returns None if the request can't be answered from the aggregates
+    lvl = level(freq)
+    if lvl is None or any(agg not in aggregations for agg in aggregation) or DT.shape[0] == 0:
+        return(None)
+    tsInfo = config['dbase_metadata']['timestamp']
+    resolution = tsInfo['resolution']
+    res = tg.nsPer(resolution)
+    if NS_PER_DAY % res != 0:
+        return(None)
+    if stage in config['stage'].keys():
+        stage = config['stage'][stage]
+    t0,t1 = DT[0].value,DT[-1].value
+    P = periodStarts(DT[0],DT[-1],lvl)
+    if lvl == 'D':
+        nextStart = P[-1]+NS_PER_DAY
+    else:
+        nextStart = (pd.Timestamp(P[-1])+pd.offsets.MonthBegin(1)).value
+    # Periods cut by the dateRange are computed from the half-hourly data
+    partial = np.zeros(P.shape[0],dtype=bool)
+    partial[0] = t0 != P[0]
+    partial[-1] = partial[-1] or t1+res != nextStart
+    stats = np.zeros((len(traces),P.shape[0],5))
+    stats[...,3:] = np.nan
+    years = range(pd.Timestamp(P[0]).year-1,pd.Timestamp(P[-1]).year+1)
+    for k,trace_name in enumerate(traces):
+        for YYYY in years:
+            tracePath = os.path.join(database,str(YYYY),siteID,stage,trace_name)
+            if not os.path.isfile(tracePath):
+                continue
+            sidecar = readSidecar(tracePath,lvl)
+            if sidecar is None:
+                prof.count('aggregates_missing')
+                return(None)
+            starts,_ = yearPeriods(YYYY,lvl,resolution)
+            if sidecar.shape[0] != starts.shape[0]:
+                return(None)
+            pos = np.searchsorted(P,starts)
+            use = (pos < P.shape[0])
+            use[use] = (P[pos[use]] == starts[use])&~partial[pos[use]]
+            stats[k,pos[use]] = merge(stats[k,pos[use]],sidecar[use])
+    # The half-hourly rows of the partial periods
+    for p in np.flatnonzero(partial):
+        end = nextStart if p == P.shape[0]-1 else P[p+1]
+        rows = (DT.asi8 >= P[p])&(DT.asi8 < end)
+        if rows.sum() == 0:
+            continue
+        lo,hi = DT[rows][0],DT[rows][-1]
+        # Rows are looked up in the year files of the end points, start one row early so YYYY-01-01 00:00 (the last row of the previous year) is read
+        DTp,data = rTr.readTraces(siteID,stage,traces,[lo-pd.Timedelta(res),hi],database=database,config=config,verbose=False,decode=True,catalog=catalog)
+        keep = (DTp>=lo)&(DTp<=hi)
+        for k,trace_name in enumerate(traces):
+            stats[k,p] = compute(data[trace_name][keep],np.zeros(keep.sum(),dtype='int64'),1)[0]
+    # Label the periods the same way as pandas
+    first = pd.DatetimeIndex(np.maximum(P,t0).view('datetime64[ns]'))
+    labels = pd.Series(np.arange(P.shape[0]),index=first).resample(freq).first()
+    if labels.shape[0] != P.shape[0] or labels.isna().any():
+        return(None)
+    columns = {}
+    dtype = config['dbase_metadata']['traces']['dtype']
+    results = toAggregates(stats,aggregation)
+    for k,trace_name in enumerate(traces):
+        for agg in aggregation:
+            if agg == 'count':
+                columns[(trace_name,agg)] = results[agg][k].astype('int64')
+            else:
+                columns[(trace_name,agg)] = results[agg][k].astype(dtype)
+    rsmp = pd.DataFrame(columns,index=labels.index)
+    rsmp.columns = pd.MultiIndex.from_tuples(columns.keys())
+    prof.count('aggregate_requests')
+    return(first,rsmp)
+
+def buildFolder(folder,YYYY,dbase_metadata):
+    # Compute the aggregates of every trace in a Database/YYYY/SiteID/Stage/ folder
+    n = 0
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file() and not entry.name.startswith('.') and entry.name != dbase_metadata['timestamp']['name']:
+                update(entry.path,YYYY,dbase_metadata)
+                n += 1
+    return(n)
+
+# If called from command line ...
+if __name__ == '__main__':
+
+    CLI=argparse.ArgumentParser()
+
+    CLI.add_argument("--database",type=str,default='None')
+    CLI.add_argument("--siteID",nargs='+',type=str,default=[])
+    CLI.add_argument("--stage",nargs='+',type=str,default=['Second'])
+    CLI.add_argument("--years",nargs='+',type=int,default=[])
+
+    # Parse the args and make the call
+    args = CLI.parse_args()
+    config = rCfg.set_user_configuration()
+    if args.database == 'None':
+        args.database = config['rootDir']['database']
+    for YYYY in args.years:
+        for siteID in args.siteID:
+            for stage in args.stage:
+                stage = config['stage'].get(stage,stage)
+                folder = os.path.join(args.database,str(YYYY),siteID,stage)
+                if os.path.isdir(folder):
+                    print(f'{folder}: aggregated {buildFolder(folder,YYYY,config["dbase_metadata"])} traces')
+                else:
+                    print(f'{folder} does not exist')
@@ -0,0 +1,74 @@
+# In-process cache of arrays read from the binary database
+# Intended to be called by other scripts, e.g., readTraces.py
+
+# Entries are keyed by (root, siteID, stage, year, trace) and are only valid while the file's mtime & size are unchanged
+# Each entry holds a contiguous block of rows from a year file; requests that fall within the block are served from memory
+# Requests outside the block read the missing rows and extend it
+# The least recently used entries are dropped once the total size exceeds maxBytes
+# Each process (e.g., each worker in a process pool) holds its own cache
+
+import os
+import threading
+from collections import OrderedDict
+
+class traceCache():
+    def __init__(self,maxBytes=512*1024**2):
+        self.maxBytes = maxBytes
+        self.nBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+
+    def get(self,key,path,i0,n,loader):
+        # Return rows i0:i0+n of the file at path
+        # loader(i0,n) is called to read rows that are not already cached
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns,stat.st_size)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == stamp and entry[1] <= i0 and i0+n <= entry[1]+entry[2].shape[0]:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return(entry[2][i0-entry[1]:i0-entry[1]+n])
+            self.misses += 1
+        # Extend a valid entry to cover the union of both ranges, otherwise read the requested rows
+        if entry is not None and entry[0] == stamp:
+            j0 = min(i0,entry[1])
+            j1 = max(i0+n,entry[1]+entry[2].shape[0])
+        else:
+            j0,j1 = i0,i0+n
+        data = loader(j0,j1-j0)
+        data.flags.writeable = False
+        self.put(key,stamp,j0,data)
+        return(data[i0-j0:i0-j0+n])
+
+    def put(self,key,stamp,i0,data):
+        with self.lock:
+            self.drop(key)
+            if data.nbytes > self.maxBytes:
+                return
+            self.entries[key] = (stamp,i0,data)
+            self.nBytes += data.nbytes
+            while self.nBytes > self.maxBytes:
+                self.drop(next(iter(self.entries)))
+
+    def drop(self,key):
+        with self.lock:
+            entry = self.entries.pop(key,None)
+            if entry is not None:
+                self.nBytes -= entry[2].nbytes
+
+    def resize(self,maxBytes):
+        with self.lock:
+            self.maxBytes = maxBytes
+            while self.nBytes > self.maxBytes:
+                self.drop(next(iter(self.entries)))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nBytes = 0
+
+# Cache shared by all callers within the process
+shared = traceCache()
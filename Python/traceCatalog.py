@@ -0,0 +1,227 @@
+# Catalog of the traces in the binary database
+# Intended to be called by other scripts, e.g., csvFromBinary.py, readTraces.py
+
+# The catalog is stored in an SQLite database (traceCatalog.db) at the root of the database
+#   * one row per file: year, siteID, stage, name, size, mtime_ns, ok, first, last
+#   * ok is 1 if the size matches the dtype (clean_tv: float64, traces: float32) and the number of rows in the year (see timeGrid.py)
+#   * first & last are the first and last rows with valid (finite) data, empty if there are none or if the file hasn't been read yet
+#     only the command line (scanAll) reads the files to find them, other scans only stat the files
+# The size & mtime of the clean_tv files that match their time grid are kept in a second table (see validateTimestamps.py)
+# Each scan lists the Database/YYYY/SiteID/Stage/ folders (one directory listing per folder, instead of trying to open each trace), or stats only the requested traces
+#   * only files that are new or whose size or mtime have changed are updated, rows of files that were removed are deleted
+# If the catalog can't be created at the root of the database (e.g., read-only network drive), it is kept in memory instead
+# Basic call from other python scripts:
+    # import traceCatalog as tc
+    # catalog = tc.getCatalog(database,config['dbase_metadata'])
+    # available = catalog.available('BBS','Clean/SecondStage',[2023,2024])
+# Build (or update) the full catalog from the command line:
+    # py traceCatalog.py --database C:/Database/
+# Or only for some sites/years
+    # py traceCatalog.py --database C:/Database/ --siteID BB BBS --years 2023 2024
+
+import os
+import re
+import sqlite3
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+import timeGrid as tg
+import readConfig as rCfg
+from profiler import shared as prof
+
+# Catalogs opened by this process {database:traceCatalog}
+catalogs = {}
+catalogLock = threading.Lock()
+
+def getCatalog(database,dbase_metadata):
+    # The catalog of a database, opened once per process
+    key = os.path.abspath(database)
+    with catalogLock:
+        if key not in catalogs:
+            catalogs[key] = traceCatalog(database,dbase_metadata)
+        return(catalogs[key])
+
+class traceCatalog():
+    def __init__(self,database,dbase_metadata):
+        self.root = os.path.abspath(database)
+        self.tsInfo = dbase_metadata['timestamp']
+        self.trInfo = dbase_metadata['traces']
+        self.lock = threading.RLock()
+        # Folders scanned by this object
+        self.scanned = set()
+        self.path = os.path.join(self.root,'traceCatalog.db')
+        try:
+            self.con = sqlite3.connect(self.path,timeout=60,check_same_thread=False)
+            self.create()
+        except sqlite3.Error as e:
+            print(f'Could not open {self.path} ({e}), keeping the trace catalog in memory')
+            self.path = ':memory:'
+            self.con = sqlite3.connect(self.path,check_same_thread=False)
+            self.create()
+
+    def create(self):
+        with self.con:
+            self.con.execute('CREATE TABLE IF NOT EXISTS traces (year INTEGER, siteID TEXT, stage TEXT, name TEXT, size INTEGER, mtime_ns INTEGER, ok INTEGER, first INTEGER, last INTEGER, PRIMARY KEY (year, siteID, stage, name))')
+            self.con.execute('CREATE INDEX IF NOT EXISTS traces_name ON traces (siteID, stage, name)')
+            # clean_tv files that matched their time grid (see validateTimestamps.py)
+            self.con.execute('CREATE TABLE IF NOT EXISTS timestamps (year INTEGER, siteID TEXT, stage TEXT, size INTEGER, mtime_ns INTEGER, PRIMARY KEY (year, siteID, stage))')
+
+    def folder(self,siteID,stage,YYYY):
+        return(os.path.join(self.root,str(YYYY),siteID,stage))
+
+    def inspect(self,path,name,YYYY,size,full=False):
+        # Check the size of a file, and if full, read it to find its first & last valid rows
+        if name == self.tsInfo['name']:
+            dtype = np.dtype(self.tsInfo['dtype'])
+        else:
+            dtype = np.dtype(self.trInfo['dtype'])
+        nRows = tg.yearBounds(YYYY,self.tsInfo['resolution'])[2]
+        ok = int(size == nRows*dtype.itemsize)
+        if ok == 0:
+            print(f'Warning: {path} is {size} bytes, expecting {nRows*dtype.itemsize} ({nRows} x {dtype})')
+        if full == False or size % dtype.itemsize != 0:
+            return(ok,None,None)
+        valid = np.flatnonzero(np.isfinite(np.fromfile(path,dtype=dtype)))
+        prof.count('bytes_read',size)
+        if valid.size == 0:
+            return(ok,None,None)
+        return(ok,int(valid[0]),int(valid[-1]))
+
+    @prof.timed('scanCatalog')
+    def scan(self,siteID,stage,YYYY,names=None,full=False):
+        # Update the rows of one Database/YYYY/SiteID/Stage/ folder
+        # names: only stat these files instead of listing the folder
+        # full: read the files to find their first & last valid rows (also files that have only been stat'ed so far)
+        # Returns the number of files that were updated
+        folder = self.folder(siteID,stage,YYYY)
+        listed = {}
+        if names is not None:
+            for name in names:
+                try:
+                    stat = os.stat(os.path.join(folder,name))
+                except OSError:
+                    continue
+                listed[name] = (stat.st_size,stat.st_mtime_ns)
+        elif os.path.isdir(folder):
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_file() and not entry.name.startswith('.'):
+                        stat = entry.stat()
+                        listed[entry.name] = (stat.st_size,stat.st_mtime_ns)
+        with self.lock:
+            known = {n:((s,m),f) for n,s,m,f in self.con.execute('SELECT name, size, mtime_ns, first FROM traces WHERE year=? AND siteID=? AND stage=?',(YYYY,siteID,stage))}
+            if names is not None:
+                known = {n:k for n,k in known.items() if n in names}
+            rows = []
+            for name,(size,mtime_ns) in listed.items():
+                stamp,first = known.get(name,(None,None))
+                if stamp != (size,mtime_ns) or (full == True and first is None):
+                    try:
+                        ok,first,last = self.inspect(os.path.join(folder,name),name,YYYY,size,full)
+                    except OSError:
+                        continue
+                    rows.append((YYYY,siteID,stage,name,size,mtime_ns,ok,first,last))
+            removed = [(YYYY,siteID,stage,name) for name in known if name not in listed]
+            if len(rows) > 0 or len(removed) > 0:
+                with self.con:
+                    self.con.executemany('INSERT OR REPLACE INTO traces (year, siteID, stage, name, size, mtime_ns, ok, first, last) VALUES (?,?,?,?,?,?,?,?,?)',rows)
+                    self.con.executemany('DELETE FROM traces WHERE year=? AND siteID=? AND stage=? AND name=?',removed)
+            if names is None:
+                self.scanned.add(folder)
+            else:
+                self.scanned.update((folder,name) for name in names)
+        prof.count('catalog_files_updated',len(rows))
+        return(len(rows))
+
+    def scanAll(self,siteID=[],years=[],full=True):
+        # Update the catalog for every Database/YYYY/SiteID/Stage/ folder (optionally only some sites and/or years)
+        # full: read the files to find their first & last valid rows
+        # Stages can be nested (e.g., Clean/SecondStage), any (non-hidden) folder within a site holding files is treated as a stage
+        n = 0
+        for YYYY in sorted(os.listdir(self.root)):
+            if re.fullmatch(r'\d{4}',YYYY) is None or (len(years) > 0 and int(YYYY) not in years):
+                continue
+            for site in sorted(os.listdir(os.path.join(self.root,YYYY))):
+                if len(siteID) > 0 and site not in siteID:
+                    continue
+                siteDir = os.path.join(self.root,YYYY,site)
+                stages = []
+                for d,subdirs,files in os.walk(siteDir):
+                    # Skip hidden folders, e.g., .aggregates (see traceAggregates.py)
+                    subdirs[:] = [sd for sd in subdirs if not sd.startswith('.')]
+                    if d != siteDir and len(files) > 0:
+                        stages.append(os.path.relpath(d,siteDir).replace(os.sep,'/'))
+                for stage in stages:
+                    n += self.scan(site,stage,int(YYYY),full=full)
+        return(n)
+
+    def available(self,siteID,stage,years,refresh=True,traces=None):
+        # The names of the valid files in each year {YYYY:set(names)}
+        # refresh: scan each folder again, otherwise only folders that haven't been scanned by this object are scanned
+        # traces: only stat (and return) these traces instead of listing the whole folder
+        result = {}
+        for YYYY in years:
+            folder = self.folder(siteID,stage,YYYY)
+            if traces is None:
+                if refresh == True or folder not in self.scanned:
+                    self.scan(siteID,stage,YYYY)
+            else:
+                traces = list(traces)
+                if refresh == True or folder in self.scanned:
+                    stale = traces if refresh == True else []
+                else:
+                    stale = [name for name in traces if (folder,name) not in self.scanned]
+                if len(stale) > 0:
+                    self.scan(siteID,stage,YYYY,names=stale)
+            with self.lock:
+                result[YYYY] = {n for n, in self.con.execute('SELECT name FROM traces WHERE year=? AND siteID=? AND stage=? AND ok=1',(YYYY,siteID,stage))}
+            if traces is not None:
+                result[YYYY] &= set(traces)
+        return(result)
+
+    def validTimestamps(self,siteID,stage,YYYY,stamp):
+        # True if the clean_tv of a folder was found to match its time grid when it had this (size, mtime_ns)
+        with self.lock:
+            row = self.con.execute('SELECT size, mtime_ns FROM timestamps WHERE year=? AND siteID=? AND stage=?',(YYYY,siteID,stage)).fetchone()
+        return(row == tuple(stamp))
+
+    def markTimestamps(self,siteID,stage,YYYY,stamp):
+        with self.lock:
+            with self.con:
+                self.con.execute('INSERT OR REPLACE INTO timestamps (year, siteID, stage, size, mtime_ns) VALUES (?,?,?,?,?)',(YYYY,siteID,stage)+tuple(stamp))
+
+    def read(self,siteID=None):
+        # The full catalog (or one site) as a dataframe
+        with self.lock:
+            if siteID is None:
+                return(pd.read_sql('SELECT * FROM traces',self.con))
+            return(pd.read_sql('SELECT * FROM traces WHERE siteID=?',self.con,params=(siteID,)))
+
+    def close(self):
+        with catalogLock:
+            if catalogs.get(self.root) is self:
+                del catalogs[self.root]
+        self.con.close()
+
+# If called from command line ...
+if __name__ == '__main__':
+
+    CLI=argparse.ArgumentParser()
+
+    CLI.add_argument("--database",type=str,default='None')
+    CLI.add_argument("--siteID",nargs='+',type=str,default=[])
+    CLI.add_argument("--years",nargs='+',type=int,default=[])
+
+    # Parse the args and make the call
+    args = CLI.parse_args()
+    config = rCfg.set_user_configuration()
+    if args.database == 'None':
+        args.database = config['rootDir']['database']
+    catalog = traceCatalog(args.database,config['dbase_metadata'])
+    n = catalog.scanAll(args.siteID,args.years)
+    df = catalog.read()
+    print(f'Read {n} new or modified files, {df.shape[0]} files in {catalog.path}')
+    if df.shape[0] > 0:
+        print(df.groupby(['siteID','stage','year']).agg(traces=('name','count'),invalid=('ok',lambda x:(x==0).sum())))
+    catalog.close()
@@ -0,0 +1,268 @@
+# Local HTTP service for slices of traces from the binary database, e.g., to back the R Shiny dashboards
+
+# Runs on localhost (asyncio), reads are done on a pool of threads so slow reads don't hold up other requests
+#   * traces are read with readTraces.py, so rows are memory-mapped and hot slices are kept in memory (see traceCache.py, trace_cache in config.yml)
+#   * identical requests that arrive while one is being read wait for (and share) the same result
+#   * the stage names & dbase_metadata are taken from config.yml, the same as csvFromBinary.py
+#   * the trace catalog (see traceCatalog.py) is refreshed at most once every refresh seconds per folder, missing trace-years are NaNs
+#   * daily & monthly resample requests are answered from the aggregates if enabled (see traceAggregates.py)
+# Start the service from the command line:
+    # py traceServer.py
+    # py traceServer.py --database C:/Database/ --port 8765 --threads 8
+# Endpoints (GET):
+#   /traces?siteID=BB&stage=Second&traces=TA_1_1_1,RH_1_1_1&start=2023-01-01 00:30&end=2024-01-01 00:00
+#       * optional: resample=D&agg=mean (or agg=mean,max: columns named trace_agg), resampled rows are labelled by the first timestamp of each period
+#       * format=binary (default): the clean_tv datenums (float64) followed by each column (float32), little endian, n rows each
+#           - the column names and number of rows are given in the X-Columns & X-Rows headers
+#       * format=arrow: an Arrow IPC stream with a timestamp column and a float32 column per trace (requires pyarrow)
+#   /catalog?siteID=BB&stage=Second&years=2023,2024: json {year:[traces]}
+#   /status: json of the cache and request counts
+# siteID, stage & trace names must be plain names (no path separators or ..) and resolve to files within the database, otherwise the response is 400
+# Example call from R (binary format):
+    # r <- httr::GET("http://127.0.0.1:8765/traces", query = list(siteID = "BB", stage = "Second", traces = "TA_1_1_1,RH_1_1_1", start = "2023-01-01", end = "2023-12-31"))
+    # n <- as.integer(httr::headers(r)[["x-rows"]]); con <- rawConnection(httr::content(r, "raw"))
+    # tv <- readBin(con, double(), n = n); TA <- readBin(con, numeric(), n = n, size = 4); RH <- readBin(con, numeric(), n = n, size = 4)
+# Or with the arrow package: arrow::read_ipc_stream(httr::content(httr::GET(..., format = "arrow"), "raw"))
+
+import io
+import os
+import json
+import time
+import asyncio
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+import timeGrid as tg
+import readConfig as rCfg
+import readTraces as rTr
+import exportFormats as eF
+import traceCatalog as tc
+import traceAggregates as tA
+from traceCache import shared as sharedCache
+from profiler import shared as prof
+from urllib.parse import urlsplit,parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+# Default arguments
+defaultArgs = {
+    'database':'None',
+    'host':'127.0.0.1',
+    'port':8765,
+    'threads':8,
+    'refresh':60
+    }
+
+def checkName(name,what):
+    # Names from the query string are joined into file paths, so they can't point outside of the database
+    if name == '' or os.path.isabs(name) or '..' in name or any(c in name for c in [os.sep,'/','\\']):
+        raise ValueError(f'Invalid {what}: {name}')
+    return(name)
+
+reasons = {200:'OK',400:'Bad Request',404:'Not Found',405:'Method Not Allowed',500:'Internal Server Error'}
+
+class traceServer():
+    def __init__(self,**kwargs):
+        kwargs = defaultArgs | kwargs
+        self.host,self.port,self.refresh = kwargs['host'],kwargs['port'],kwargs['refresh']
+        self.cfg = rCfg.configuration()
+        config = self.cfg.get()
+        if kwargs['database'] == 'None':
+            self.database = config['rootDir']['database']
+        else: self.database = kwargs['database']
+        self.catalog = tc.getCatalog(self.database,config['dbase_metadata'])
+        self.pool = ThreadPoolExecutor(max_workers=kwargs['threads'])
+        # Time each catalog folder was last refreshed {(siteID,stage,YYYY):time}
+        self.scanned = {}
+        self.scanLock = threading.Lock()
+        # Requests being read {query:future}
+        self.inflight = {}
+        self.counts = {'requests':0,'shared':0,'errors':0}
+
+    def checkRequest(self,siteID,stage,traces,years,config):
+        # Check the names of a request and map the stage name, returns the stage folder
+        # Stages defined in config.yml (e.g., Second: Clean/SecondStage) are trusted, anything else must be a single folder name
+        checkName(siteID,'siteID')
+        if stage in config['stage'].keys():
+            stage = config['stage'][stage]
+        elif stage not in config['stage'].values():
+            checkName(stage,'stage')
+        for name in traces:
+            checkName(name,'trace')
+        # The files must also resolve (e.g., through links) to a path within the database
+        root = os.path.realpath(self.database)
+        for YYYY in years:
+            for name in traces+[config['dbase_metadata']['timestamp']['name']]:
+                path = os.path.realpath(os.path.join(self.database,str(YYYY),siteID,stage,name))
+                if os.path.commonpath([root,path]) != root:
+                    raise ValueError(f'Invalid trace: {name} is outside of the database')
+        return(stage)
+
+    def available(self,siteID,stage,years):
+        # Refresh the catalog folders that haven't been scanned within the last refresh seconds
+        with self.scanLock:
+            now = time.monotonic()
+            stale = [YYYY for YYYY in years if now-self.scanned.get((siteID,stage,YYYY),-np.inf) > self.refresh]
+            for YYYY in stale:
+                self.scanned[(siteID,stage,YYYY)] = now
+        if len(stale) > 0:
+            self.catalog.available(siteID,stage,stale)
+        return(self.catalog.available(siteID,stage,years,refresh=False))
+
+    def query(self,siteID,stage,traces,dateRange,resample=None,agg='mean'):
+        # Read the traces over the dateRange (optionally resampled)
+        # Returns the timestamps and {column:float32 array}
+        config = self.cfg.get()
+        Range_index = pd.DatetimeIndex(dateRange)
+        tsInfo = config['dbase_metadata']['timestamp']
+        slices = rTr.yearSlices(Range_index,tsInfo['resolution'])
+        stage = self.checkRequest(siteID,stage,traces,[YYYY for YYYY,i0,n in slices],config)
+        self.available(siteID,stage,[YYYY for YYYY,i0,n in slices if n > 0])
+        # Same handling as the columnar outputs of csvFromBinary.py, NaNs are kept
+        task = {'traces':{t:{'output_name':t,'units':''} for t in traces},'formatting':{'na_value':'NaN','time_vectors':{}}}
+        if resample is not None:
+            task['formatting']['resample'] = {'freq':resample,'agg':agg}
+            # Daily & monthly requests are answered from the aggregates if they are available (see traceAggregates.py)
+            if tA.enabled(config):
+                DT,_ = rTr.readTraces(siteID,stage,[],Range_index,database=self.database,config=config,verbose=False,decode=True)
+                resampled = tA.resampleFromAggregates(siteID,stage,traces,DT,resample,agg.split(','),self.database,config,self.catalog)
+                if resampled is not None:
+                    return(eF.columnarBlock(task,DT,None,[],Range_index,resampled))
+        DT,data = rTr.readTraces(siteID,stage,traces,Range_index,database=self.database,config=config,verbose=False,decode=True,catalog=self.catalog)
+        return(eF.columnarBlock(task,DT,data,[],Range_index))
+
+    def encode(self,DT,values,fmt,config):
+        # Body & headers of a /traces response
+        headers = {'X-Columns':','.join(values.keys()),'X-Rows':str(DT.shape[0])}
+        if fmt == 'arrow':
+            pa = eF.requireModule('pyarrow',fmt)
+            table = pa.table({'timestamp':pa.array(DT.values.astype('datetime64[ns]'))}|{name:pa.array(v) for name,v in values.items()})
+            sink = pa.BufferOutputStream()
+            with pa.ipc.new_stream(sink,table.schema) as writer:
+                writer.write_table(table)
+            headers['Content-Type'] = 'application/vnd.apache.arrow.stream'
+            return(sink.getvalue().to_pybytes(),headers)
+        tsInfo = config['dbase_metadata']['timestamp']
+        body = io.BytesIO()
+        body.write(np.asarray(tg.toDatenum(DT,tsInfo['base'],tsInfo['base_unit']),dtype='<f8').tobytes())
+        for v in values.values():
+            body.write(np.asarray(v,dtype='<f4').tobytes())
+        headers['Content-Type'] = 'application/octet-stream'
+        return(body.getvalue(),headers)
+
+    def traces(self,params):
+        # Handle /traces, the read & encoding are run once per distinct query
+        for p in ['siteID','stage','traces','start','end']:
+            if p not in params:
+                raise ValueError(f'Missing parameter: {p}')
+        fmt = params.get('format','binary')
+        if fmt not in ['binary','arrow']:
+            raise ValueError(f'Unknown format: {fmt}, expecting binary or arrow')
+        traces = [t for t in params['traces'].split(',') if t != '']
+        dateRange = [params['start'],params['end']]
+        resample = params.get('resample')
+        agg = params.get('agg','mean')
+        DT,values = self.query(params['siteID'],params['stage'],traces,dateRange,resample,agg)
+        prof.count('rows_emitted',DT.shape[0])
+        return(self.encode(DT,values,fmt,self.cfg.get()))
+
+    def catalogJSON(self,params):
+        # Handle /catalog
+        config = self.cfg.get()
+        if 'siteID' not in params or 'years' not in params:
+            raise ValueError('Missing parameter: siteID and years are required')
+        years = [int(y) for y in params['years'].split(',')]
+        stage = self.checkRequest(params['siteID'],params.get('stage','Second'),[],years,config)
+        available = self.available(params['siteID'],stage,years)
+        return(json.dumps({YYYY:sorted(names) for YYYY,names in available.items()}).encode(),{'Content-Type':'application/json'})
+
+    def status(self,params):
+        stats = self.counts|{'cache_bytes':sharedCache.nBytes,'cache_max_bytes':sharedCache.maxBytes,
+                             'cache_hits':sharedCache.hits,'cache_misses':sharedCache.misses,'database':self.database}
+        return(json.dumps(stats).encode(),{'Content-Type':'application/json'})
+
+    async def respond(self,path,params):
+        # Run the handler on the thread pool, requests for the same query share one result
+        handler = {'/traces':self.traces,'/catalog':self.catalogJSON,'/status':self.status}[path]
+        if path == '/status':
+            return(handler(params))
+        key = (path,tuple(sorted(params.items())))
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(self.pool,handler,params)
+            self.inflight[key] = future
+            future.add_done_callback(lambda f:self.inflight.pop(key,None))
+        else:
+            self.counts['shared'] += 1
+        return(await asyncio.shield(future))
+
+    async def handle(self,reader,writer):
+        # One client connection, kept open for further requests if the client allows (HTTP/1.1 keep-alive)
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError,asyncio.LimitOverrunError,ConnectionError):
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                method,target,version = (lines[0].split(' ')+['','',''])[:3]
+                headers = {k.strip().lower():v.strip() for k,_,v in (l.partition(':') for l in lines[1:] if ':' in l)}
+                keepAlive = headers.get('connection','').lower() != 'close' and version == 'HTTP/1.1'
+                url = urlsplit(target)
+                params = {k:v[-1] for k,v in parse_qs(url.query).items()}
+                self.counts['requests'] += 1
+                prof.count('requests')
+                code = 200
+                if method != 'GET':
+                    code,body,extra = 405,json.dumps({'error':f'{method} not supported'}).encode(),{'Content-Type':'application/json'}
+                elif url.path not in ['/traces','/catalog','/status']:
+                    code,body,extra = 404,json.dumps({'error':f'Unknown path {url.path}, expecting /traces, /catalog, or /status'}).encode(),{'Content-Type':'application/json'}
+                else:
+                    try:
+                        body,extra = await self.respond(url.path,params)
+                    except (ValueError,KeyError,ImportError) as e:
+                        code,body,extra = 400,json.dumps({'error':str(e)}).encode(),{'Content-Type':'application/json'}
+                    except Exception as e:
+                        code,body,extra = 500,json.dumps({'error':str(e)}).encode(),{'Content-Type':'application/json'}
+                if code != 200:
+                    self.counts['errors'] += 1
+                response = [f'HTTP/1.1 {code} {reasons[code]}',f'Content-Length: {len(body)}',f"Connection: {'keep-alive' if keepAlive else 'close'}"]
+                response += [f'{k}: {v}' for k,v in extra.items()]
+                writer.write(('\r\n'.join(response)+'\r\n\r\n').encode('latin-1')+body)
+                await writer.drain()
+                if keepAlive == False:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self,ready=None):
+        # ready: optional threading.Event, set once the server is listening (e.g., when run on a background thread)
+        server = await asyncio.start_server(self.handle,self.host,self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        print(f'Serving {self.database} on http://{self.host}:{self.port}')
+        if ready is not None:
+            ready.set()
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print('Stopped')
+        finally:
+            self.pool.shutdown()
+
+# If called from command line ...
+if __name__ == '__main__':
+
+    CLI=argparse.ArgumentParser()
+
+    for key,val in defaultArgs.items():
+        CLI.add_argument(f"--{key}",nargs="?",type=type(val),default=val)
+
+    # Parse the args and make the call
+    args = CLI.parse_args()
+    traceServer(**vars(args)).run()
@@ -0,0 +1,166 @@
+# Integrity check of the clean_tv files in the binary database
+# Intended to be called by other scripts, e.g., csvFromBinary.py
+
+# The clean_tv of a year file only depends on the year and dbase_metadata (see timeGrid.py)
+# so each file is checked with one vectorized comparison against the expected datenums (to within half a second)
+# policy: what to do when a clean_tv doesn't match its grid
+#   * fail: raise an error giving the file and the first row that doesn't match (default)
+#   * coerce: use the grid timestamps, the file is left as is (and checked again on the next run)
+#   * regenerate: rewrite the file from the grid, then use it
+# Files that check out are recorded by size & mtime, so later runs take the timestamps straight from the grid, without reading or decoding the file
+#   * the record is kept per Database in config_files/manifests/ (and in the trace catalog if one is given, see traceCatalog.py)
+# Basic call from other python scripts:
+    # import validateTimestamps as vT
+    # DT = vT.readTimestamps('BBS','Clean/SecondStage',["2023-06-01 00:00","2024-05-31 23:59"],database,config,policy='coerce')
+# Check (or repair) the clean_tv files from the command line:
+    # py validateTimestamps.py --siteID BB BBS --stage Second Third --years 2023 2024 --policy regenerate
+
+import os
+import json
+import hashlib
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+import timeGrid as tg
+import readConfig as rCfg
+import readTraces as rTr
+import traceCatalog as tc
+import binaryFromText as bft
+from profiler import shared as prof
+
+policies = ['fail','coerce','regenerate']
+
+# Files that checked out {database:{YYYY/siteID/stage:(size,mtime_ns)}}, loaded from the record of each Database on first use
+checked = {}
+checkedLock = threading.Lock()
+recordDir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'config_files','manifests')
+
+def recordPath(database):
+    # One record per Database, like the ingest manifests of textFileToBinary.py
+    key = hashlib.sha256(database.encode()).hexdigest()[:12]
+    return(os.path.join(recordDir,f'timestamps_{key}.json'))
+
+def readRecord(database):
+    fn = recordPath(database)
+    if os.path.isfile(fn):
+        try:
+            with open(fn) as f:
+                return({k:tuple(v) for k,v in json.load(f).items()})
+        except (OSError,ValueError):
+            print(f'Warning: could not read {fn}, the clean_tv files will be checked again')
+    return({})
+
+def writeRecord(database,record):
+    # Merged with the record on disk, other processes may have added to it
+    fn = recordPath(database)
+    temp = f'{fn}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(recordDir,exist_ok=True)
+        with open(temp,'w') as f:
+            json.dump(readRecord(database)|record,f,indent=1)
+        os.replace(temp,fn)
+    except OSError as e:
+        print(f'Warning: could not write {fn} ({e})')
+
+def stampOf(path):
+    stat = os.stat(path)
+    return((stat.st_size,stat.st_mtime_ns))
+
+def deviations(tv,expected,base_unit='D'):
+    # Rows of tv that don't match the expected datenums, rows missing from (or beyond the end of) the file count as deviations
+    n = min(tv.shape[0],expected.shape[0])
+    tolerance = 0.5*10**9/tg.nsPer(base_unit)
+    bad = np.ones(expected.shape[0],dtype=bool)
+    with np.errstate(invalid='ignore'):
+        bad[:n] = ~(np.abs(tv[:n]-expected[:n]) <= tolerance)
+    return(bad)
+
+@prof.timed('validateTimestamps')
+def validate(siteID,stage,YYYY,database,config,policy='fail',catalog=None):
+    # Check the clean_tv of one Database/YYYY/SiteID/Stage/ folder, returns the number of rows that didn't match
+    if policy not in policies:
+        raise ValueError(f'Unknown timestamp policy: {policy}, expecting one of {policies}')
+    tsInfo = config['dbase_metadata']['timestamp']
+    path = os.path.join(database,str(YYYY),siteID,stage,tsInfo['name'])
+    stamp = stampOf(path)
+    database = os.path.abspath(database)
+    key = f'{YYYY}/{siteID}/{stage}'
+    with checkedLock:
+        if database not in checked:
+            checked[database] = readRecord(database)
+        if checked[database].get(key) == stamp:
+            prof.count('timestamps_cached')
+            return(0)
+    nBad = 0
+    if catalog is not None and catalog.validTimestamps(siteID,stage,YYYY,stamp):
+        prof.count('timestamps_cached')
+    else:
+        expected = tg.yearDatenums(YYYY,tsInfo['resolution'],tsInfo['base'],tsInfo['base_unit'])
+        tv = np.fromfile(path,dtype=tsInfo['dtype'])
+        prof.count('bytes_read',tv.nbytes)
+        bad = deviations(tv,expected,tsInfo['base_unit'])
+        nBad = int(bad.sum())
+        if nBad > 0:
+            first = tg.yearGrid(YYYY,tsInfo['resolution'])[np.flatnonzero(bad)[0]]
+            message = f'{path} does not match the {tsInfo["resolution"]} grid of {YYYY}: {nBad} of {expected.shape[0]} rows differ (first at {first})'
+            if tv.shape[0] != expected.shape[0]:
+                message += f', {tv.shape[0]} rows found'
+            if policy == 'fail':
+                raise ValueError(message)
+            elif policy == 'coerce':
+                print(f'Warning: {message}, using the grid timestamps')
+                prof.count('timestamps_coerced')
+                return(nBad)
+            print(f'Warning: {message}, regenerating the file from the grid')
+            bft.atomicWrite(np.asarray(expected,dtype=tsInfo['dtype']),path)
+            prof.count('timestamps_regenerated')
+            stamp = stampOf(path)
+        if catalog is not None:
+            catalog.markTimestamps(siteID,stage,YYYY,stamp)
+    with checkedLock:
+        checked[database][key] = stamp
+        writeRecord(database,{key:stamp})
+    return(nBad)
+
+def readTimestamps(siteID,stage,dateRange,database,config,policy='fail',catalog=None):
+    # The timestamps of the rows within the dateRange, same as readTraces.readTraces(...,decode=True)
+    # Each year file's clean_tv is validated, the timestamps are then taken from the grid
+    if stage in config['stage'].keys():
+        stage = config['stage'][stage]
+    resolution = config['dbase_metadata']['timestamp']['resolution']
+    DT = []
+    for YYYY,i0,n in rTr.yearSlices(dateRange,resolution):
+        if n > 0:
+            validate(siteID,stage,YYYY,database,config,policy,catalog)
+            DT.append(tg.yearGrid(YYYY,resolution).asi8[i0:i0+n])
+    if len(DT) == 0:
+        return(pd.DatetimeIndex([],dtype='datetime64[ns]'))
+    return(pd.DatetimeIndex(np.concatenate(DT).view('datetime64[ns]')))
+
+# If called from command line ...
+if __name__ == '__main__':
+
+    CLI=argparse.ArgumentParser()
+
+    CLI.add_argument("--database",type=str,default='None')
+    CLI.add_argument("--siteID",nargs='+',type=str,default=['BB'])
+    CLI.add_argument("--stage",nargs='+',type=str,default=['Second'])
+    CLI.add_argument("--years",nargs='+',type=int,default=[pd.Timestamp.now().year])
+    CLI.add_argument("--policy",type=str,default='fail')
+
+    # Parse the args and make the call
+    args = CLI.parse_args()
+    config = rCfg.set_user_configuration()
+    if args.database == 'None':
+        args.database = config['rootDir']['database']
+    catalog = tc.getCatalog(args.database,config['dbase_metadata'])
+    for siteID in args.siteID:
+        for stage in args.stage:
+            stage = config['stage'].get(stage,stage)
+            for YYYY in args.years:
+                try:
+                    n = validate(siteID,stage,YYYY,args.database,config,args.policy,catalog)
+                    print(f'{YYYY}/{siteID}/{stage}: {"ok" if n == 0 else f"{n} rows differ"}')
+                except (OSError,ValueError) as e:
+                    print(f'{YYYY}/{siteID}/{stage}: {e}')